@@ -0,0 +1,42 @@
+"""Per call overhead of UserCalendar.add_event/patch_event with and without the
+calendar service pool."""
+from unittest import mock
+
+import google_auth_httplib2
+from googleapiclient.discovery import build
+
+from benchmarks.harness import bench, make_calendars, setup_database
+from cal_sync_magic.models import GoogleAccount
+from cal_sync_magic.services import calendar_services
+from tests.fake_google import FakeCalendarApi
+
+
+def main():
+    setup_database()
+    api = FakeCalendarApi()
+    calendar_services.http_factory = api.http
+    calendar = make_calendars()[0]
+    api.add_event(calendar.google_calendar_id, {"id": "bench", "summary": "Bench"})
+    event = {"id": "bench", "summary": "Bench"}
+
+    def unpooled_service(account):
+        # What calendar_service used to do, discovery build on every call.
+        authed_http = google_auth_httplib2.AuthorizedHttp(
+            account.get_credentials(), http=api.http())
+        return build("calendar", "v3", http=authed_http)
+
+    def add():
+        calendar.add_event({"summary": "Bench"})
+
+    def patch():
+        calendar.patch_event(event)
+
+    with mock.patch.object(GoogleAccount, "calendar_service", unpooled_service):
+        bench("add_event (build per call)", add)
+        bench("patch_event (build per call)", patch)
+    bench("add_event (pooled)", add)
+    bench("patch_event (pooled)", patch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Finding the busy events an invite overlaps, scanning every event versus the
+interval treap conflict_index keeps."""
+import random
+from datetime import datetime, timedelta
+
+from benchmarks.harness import bench
+from cal_sync_magic.conflicts import IntervalTreap
+
+EVENTS = 20000
+QUERIES = 100
+
+
+def main():
+    rng = random.Random(1)
+    start = datetime(2030, 1, 1)
+    busy = []
+    for i in range(EVENTS):
+        event_start = start + timedelta(minutes=15 * rng.randrange(EVENTS * 4))
+        busy.append((i, event_start, event_start + timedelta(minutes=rng.choice([30, 60, 90]))))
+    invites = [
+        (s, s + timedelta(hours=1)) for s in (
+            start + timedelta(minutes=15 * rng.randrange(EVENTS * 4)) for _ in range(QUERIES))]
+    tree = IntervalTreap()
+    for key, event_start, event_end in busy:
+        tree.add(key, event_start, event_end)
+
+    def scan():
+        for q_start, q_end in invites:
+            [key for key, s, e in busy if s < q_end and e > q_start]
+
+    def treap():
+        for q_start, q_end in invites:
+            tree.overlapping(q_start, q_end)
+
+    bench(f"{QUERIES} invites vs {EVENTS} events (scan)", scan, iterations=10, warmup=1)
+    bench(f"{QUERIES} invites vs {EVENTS} events (treap)", treap, iterations=10, warmup=1)
+
+    def build():
+        fresh = IntervalTreap()
+        for key, event_start, event_end in busy:
+            fresh.add(key, event_start, event_end)
+
+    bench(f"build a treap of {EVENTS} events", build, iterations=3, warmup=0)
+
+
+if __name__ == "__main__":
+    main()
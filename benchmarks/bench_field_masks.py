@@ -0,0 +1,67 @@
+"""Payload size and JSON decode time of events.list pages with and without the
+partial response field mask, on a large synthetic calendar."""
+import json
+
+from benchmarks.harness import bench
+from cal_sync_magic.services import field_mask
+from tests.fake_google import parse_fields, project
+
+EVENTS = 5000
+PAGE_SIZE = 250
+
+
+def make_event(i):
+    """An event shaped like a busy work calendar's, big descriptions, lots of people."""
+    return {
+        "kind": "calendar#event",
+        "etag": f'"{i:016d}"',
+        "id": f"event{i:08d}",
+        "status": "confirmed",
+        "htmlLink": f"https://www.google.com/calendar/event?eid=event{i:08d}",
+        "created": "2023-01-01T00:00:00.000Z",
+        "updated": "2023-01-02T00:00:00.000Z",
+        "summary": f"Meeting {i}",
+        "description": "Agenda:\n" + "Discuss the quarterly plan. " * 40,
+        "location": "Conference room 4",
+        "creator": {"email": "boss@example.com", "displayName": "Boss"},
+        "organizer": {"email": "boss@example.com", "displayName": "Boss"},
+        "start": {"dateTime": "2023-02-01T10:00:00-08:00", "timeZone": "America/Los_Angeles"},
+        "end": {"dateTime": "2023-02-01T11:00:00-08:00", "timeZone": "America/Los_Angeles"},
+        "iCalUID": f"event{i:08d}@google.com",
+        "sequence": 0,
+        "attendees": [
+            {"email": f"person{j}@example.com", "displayName": f"Person {j}",
+             "responseStatus": "accepted", "comment": "See you there"}
+            for j in range(30)],
+        "hangoutLink": "https://meet.google.com/abc-defg-hij",
+        "conferenceData": {
+            "entryPoints": [
+                {"entryPointType": "video", "uri": "https://meet.google.com/abc-defg-hij",
+                 "label": "meet.google.com/abc-defg-hij"},
+                {"entryPointType": "phone", "uri": "tel:+1-555-555-5555",
+                 "label": "+1 555-555-5555", "pin": "123456789"}],
+            "conferenceSolution": {"key": {"type": "hangoutsMeet"}, "name": "Google Meet",
+                                   "iconUri": "https://fonts.gstatic.com/s/i/meet.png"},
+            "conferenceId": "abc-defg-hij"},
+        "reminders": {"useDefault": True},
+        "eventType": "default",
+    }
+
+
+def main():
+    events = [make_event(i) for i in range(EVENTS)]
+    mask = parse_fields(field_mask("events.list"))
+    pages = [{"items": events[i:i + PAGE_SIZE], "nextPageToken": "x"}
+             for i in range(0, EVENTS, PAGE_SIZE)]
+    full = [json.dumps(page) for page in pages]
+    masked = [json.dumps(project(page, mask)) for page in pages]
+    full_bytes = sum(len(p) for p in full)
+    masked_bytes = sum(len(p) for p in masked)
+    print(f"{EVENTS} events: full {full_bytes / 1e6:.2f}MB masked {masked_bytes / 1e6:.2f}MB "
+          f"({100 * masked_bytes / full_bytes:.0f}%)")
+    bench("json decode, full pages", lambda: [json.loads(p) for p in full], iterations=20)
+    bench("json decode, masked pages", lambda: [json.loads(p) for p in masked], iterations=20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Per event cost of SyncConfigs.clean_event and the short notice allow list check,
+interpreting the raw config fields on every event versus the cached compiled plans."""
+import re
+from datetime import datetime, timedelta
+
+from benchmarks.harness import bench, make_calendars, setup_database
+from cal_sync_magic.models import SINK_EVENT_FIELDS, CalendarRules, SyncConfigs
+from cal_sync_magic.plans import rule_plans
+
+EVENTS = 5000
+ALLOW_LIST = ",".join(
+    [f"friend{i}@example.com" for i in range(50)] + ["*@beatles.com", "*.corp.example.com"])
+
+
+def make_events():
+    start = (datetime.utcnow() + timedelta(minutes=30)).isoformat() + "Z"
+    return [
+        {"id": f"event{i}",
+         "summary": f"[ext] {'Lunch' if i % 3 == 0 else 'Meeting'} {i}",
+         "creator": {"email": f"person{i % 200}@{'beatles.com' if i % 4 == 0 else 'example.com'}"},
+         "attendees": [{"email": f"a{j}@example.com"} for j in range(i % 8)],
+         "start": {"dateTime": start}}
+        for i in range(EVENTS)]
+
+
+def naive_clean_event(config, event):
+    """clean_event as it was, going back to the raw fields for every event."""
+    if (config.match_creator_regex and
+        re.search(config.match_creator_regex,
+                  event.get("creator", {}).get("email", "")) is None):
+        return None
+    if (config.invitee_skip_event_threshold is not None and
+        len(event.get("attendees", [])) > config.invitee_skip_event_threshold):
+        return None
+    cleaned_event = {k: event[k] for k in SINK_EVENT_FIELDS if k in event}
+    title = cleaned_event.get("summary", "")
+    if config.rewrite_regex:
+        title = re.sub(config.rewrite_regex, "", title)
+    if config.default_title is not None:
+        if (config.match_title_regex is not None and
+            re.search(config.match_title_regex, title) is None):
+            title = config.default_title
+    cleaned_event["summary"] = title
+    return cleaned_event
+
+
+def naive_allowed(rule, email):
+    """Splitting the allow list text on every event, with a wildcard domain check."""
+    domain = email.rpartition("@")[2]
+    for entry in rule.get_min_sched_allow():
+        entry = entry.strip().lower()
+        if entry == email.lower() or entry in (f"*@{domain}", f"@{domain}"):
+            return True
+        if entry.startswith("*.") and domain.endswith(entry[1:]):
+            return True
+    return False
+
+
+def main():
+    setup_database()
+    user = make_calendars()[0].user
+    config = SyncConfigs.objects.create(
+        user=user, rewrite_regex=r"\[.*?\]\s*", default_title="Busy",
+        match_title_regex="^Lunch", match_creator_regex=r"@(example|beatles)\.com$",
+        invitee_skip_event_threshold=6)
+    rule = CalendarRules.objects.create(
+        user=user, min_sched=timedelta(hours=2), allow_list_min_sched=ALLOW_LIST)
+    events = make_events()
+
+    def naive():
+        # A worker with many configs overflows re's own pattern cache.
+        re.purge()
+        for event in events:
+            naive_clean_event(config, event)
+            naive_allowed(rule, event["creator"]["email"])
+
+    def planned():
+        for event in events:
+            config.clean_event(event)
+            event["creator"]["email"] in rule_plans.get(rule).min_sched_allow
+
+    bench(f"{EVENTS} events (raw fields)", naive, iterations=20, warmup=2)
+    bench(f"{EVENTS} events (compiled plans)", planned, iterations=20, warmup=2)
+
+    for event in events:
+        before, after = naive_clean_event(config, event), config.clean_event(event)
+        assert (before is None) == (after is None)
+        assert before is None or before["summary"] == after["summary"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Cost of checking a page of changes against a calendar's rules, one event at a
+time versus the whole page at once (rule_eval)."""
+from datetime import datetime, timedelta
+
+from benchmarks.harness import bench, make_calendars, setup_database
+from cal_sync_magic.models import CalendarRules
+from cal_sync_magic.rule_eval import short_notice_events
+
+PAGE_SIZE = 250
+RULES = 5
+
+
+def make_page():
+    now = datetime.utcnow()
+    return [
+        {"id": f"event{i}",
+         "summary": f"Meeting {i}",
+         "creator": {"email": f"person{i % 50}@example.com"},
+         "start": {"dateTime": (now + timedelta(minutes=20 * i)).isoformat() + "-00:00"}}
+        for i in range(PAGE_SIZE)]
+
+
+def main():
+    setup_database()
+    user = make_calendars()[0].user
+    allow = ",".join(f"person{i}@example.com" for i in range(0, 50, 3))
+    rules = [
+        CalendarRules.objects.create(
+            user=user, min_sched=timedelta(hours=i + 1), allow_list_min_sched=allow)
+        for i in range(RULES)]
+    page = make_page()
+
+    def per_event():
+        for event in page:
+            for rule in rules:
+                rule.is_short_notice(event)
+
+    def per_page():
+        short_notice_events(rules, page)
+
+    bench(f"{PAGE_SIZE} events x {RULES} rules (per event)", per_event, iterations=50)
+    bench(f"{PAGE_SIZE} events x {RULES} rules (per page)", per_page, iterations=50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Events per second fanned out to sink calendars, one HTTP call per write versus
+Google batch requests. The fake API adds a fixed latency per HTTP round trip."""
+import time
+
+from benchmarks.harness import make_calendars, setup_database
+from cal_sync_magic.batch import SinkWrite, SinkWriteBatcher
+from cal_sync_magic.services import calendar_services
+from tests.fake_google import FakeCalendarApi
+
+EVENTS = 100
+SINKS = 5
+LATENCY = 0.02
+
+
+def main():
+    setup_database()
+    api = FakeCalendarApi(latency=LATENCY)
+    calendar_services.http_factory = api.http
+    sinks = make_calendars(SINKS)
+    events = [{"id": f"event{i:05d}", "summary": f"Event {i}"} for i in range(EVENTS)]
+
+    start = time.perf_counter()
+    for event in events:
+        for sink in sinks:
+            sink.add_event(dict(event, id=f"serial{event['id']}"))
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batcher = SinkWriteBatcher()
+    for event in events:
+        for sink in sinks:
+            batcher.add(SinkWrite(sink, "insert", event))
+    batcher.flush()
+    batched = time.perf_counter() - start
+
+    print(f"{EVENTS} events x {SINKS} sinks, {LATENCY * 1000:.0f}ms per round trip")
+    print(f"serial  {EVENTS / serial:8.1f} events/s ({serial:.2f}s)")
+    print(f"batched {EVENTS / batched:8.1f} events/s ({batched:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
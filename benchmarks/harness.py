@@ -0,0 +1,60 @@
+"""Shared setup for the benchmarks.
+
+Benchmarks are plain scripts, run them from the repo root with e.g.
+`python -m benchmarks.bench_calendar_service`. They use a throw away test database
+and the fake Google API from the tests so nothing leaves the machine."""
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testapp.settings")
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+
+from cal_sync_magic.models import GoogleAccount, UserCalendar
+from tests.test_credentials import make_credentials_json
+
+
+def setup_database():
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    # We're measuring our own overhead, not waiting on Google's quotas.
+    settings.GOOGLE_API_RATE_LIMITS = None
+
+
+def make_calendars(count=1, email="bench@example.com"):
+    User = get_user_model()
+    user, _ = User.objects.get_or_create(username="bench", email=email)
+    account = GoogleAccount.objects.create(
+        user=user,
+        google_user_email=email,
+        credentials=make_credentials_json(),
+        credential_expiry=datetime.utcnow() + timedelta(hours=1))
+    return [
+        UserCalendar.objects.create(
+            user=user,
+            google_account=account,
+            google_calendar_id=f"cal-{i}@example.com",
+            name=f"Calendar {i}")
+        for i in range(count)]
+
+
+def bench(name, fn, iterations=200, warmup=5):
+    """Run fn iterations times and report per call timings in ms."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"{name:<40} mean {statistics.mean(timings):8.3f}ms "
+          f"p50 {statistics.median(timings):8.3f}ms "
+          f"max {max(timings):8.3f}ms")
+    return timings
@@ -0,0 +1,30 @@
+from django.contrib import admin
+
+from cal_sync_magic.api_usage import api_usage_recorder, usage_summary
+from cal_sync_magic.models import ApiUsage
+
+
+@admin.register(ApiUsage)
+class ApiUsageAdmin(admin.ModelAdmin):
+    """API usage, with per account totals (for whatever's filtered) above the rows."""
+    list_display = ["day", "google_account", "calendar", "sync_config", "method", "error",
+                    "calls", "latency", "request_bytes", "response_bytes"]
+    list_filter = ["day", "method", "error"]
+    list_select_related = ["google_account", "calendar", "sync_config"]
+    date_hierarchy = "day"
+    ordering = ["-day", "-calls"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        api_usage_recorder.flush()
+        response = super().changelist_view(request, extra_context=extra_context)
+        changelist = getattr(response, "context_data", {}).get("cl")
+        if changelist is not None:
+            response.context_data["account_summary"] = usage_summary(
+                changelist.queryset, ["google_account_id", "google_account__google_user_email"])
+        return response
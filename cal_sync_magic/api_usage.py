@@ -0,0 +1,133 @@
+"""Google API usage accounting.
+
+api_usage_recorder is hooked into services.api_call_hooks (see apps.py) and keeps
+running totals in memory, every API_USAGE_FLUSH_INTERVAL seconds they're added to
+the ApiUsage table. That way usage from every process (web, sync workers, cron)
+ends up in one place for the metrics endpoint and the admin."""
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Sum
+
+from cal_sync_magic.models import ApiUsage, sink_write_coalescer
+
+COUNTERS = ("calls", "latency", "request_bytes", "response_bytes")
+
+
+class ApiUsageRecorder(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def __call__(self, call):
+        key = (datetime.utcnow().date(), call.account_id, call.calendar_id,
+               call.sync_config_id, call.method, call.error or "")
+        with self._lock:
+            totals = self._pending.setdefault(key, [0, 0.0, 0, 0])
+            totals[0] += call.calls
+            totals[1] += call.latency
+            totals[2] += call.request_bytes
+            totals[3] += call.response_bytes
+            due = (time.monotonic() - self._last_flush >=
+                   getattr(settings, "API_USAGE_FLUSH_INTERVAL", 10))
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Add what we've recorded since the last flush to the ApiUsage table."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        for (day, account_id, calendar_id, sync_config_id, method, error), totals in pending.items():
+            counters = dict(zip(COUNTERS, totals))
+            # In a savepoint, we may be called from inside someone else's transaction.
+            with transaction.atomic():
+                updated = ApiUsage.objects.filter(
+                    day=day,
+                    google_account_id=account_id,
+                    calendar_id=calendar_id,
+                    sync_config_id=sync_config_id,
+                    method=method,
+                    error=error,
+                ).update(**{k: F(k) + v for k, v in counters.items()})
+                if not updated:
+                    ApiUsage.objects.create(
+                        day=day,
+                        google_account_id=account_id,
+                        calendar_id=calendar_id,
+                        sync_config_id=sync_config_id,
+                        method=method,
+                        error=error,
+                        **counters)
+
+
+api_usage_recorder = ApiUsageRecorder()
+
+
+def usage_summary(usage, by):
+    """Totals of usage (an ApiUsage queryset) grouped by the by fields, the heaviest
+    users first. Each row also gets errors and mean_latency."""
+    rows = usage.values(*by).annotate(
+        total_calls=Sum("calls"),
+        total_latency=Sum("latency"),
+        total_request_bytes=Sum("request_bytes"),
+        total_response_bytes=Sum("response_bytes"),
+        errors=Sum("calls", filter=~Q(error="")),
+    ).order_by("-total_calls")
+    for row in rows:
+        row["errors"] = row["errors"] or 0
+        row["mean_latency"] = row["total_latency"] / row["total_calls"] if row["total_calls"] else 0
+    return list(rows)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = (
+    ("google_api_calls_total", "total_calls", "Google API calls made."),
+    ("google_api_call_seconds_total", "total_latency", "Seconds spent on Google API calls."),
+    ("google_api_request_bytes_total", "total_request_bytes", "Bytes sent to Google APIs."),
+    ("google_api_response_bytes_total", "total_response_bytes",
+     "Bytes received from Google APIs."),
+)
+
+COALESCER_METRICS = (
+    ("sink_writes_submitted_total", "submitted", "counter",
+     "Sink writes handed to this process's coalescer."),
+    ("sink_writes_coalesced_total", "coalesced", "counter",
+     "Sink writes replaced by a later write to the same event."),
+    ("sink_writes_sent_total", "sent", "counter", "Coalesced sink writes sent."),
+    ("sink_writes_pending", "pending", "gauge", "Sink writes waiting out their window."),
+)
+
+
+def render_metrics():
+    """All time API usage in the Prometheus text format, by account, method and error.
+    Calendars and sync configs are left out to keep the label cardinality down,
+    see the admin for those. The sink write coalescer's stats are for this
+    process only."""
+    api_usage_recorder.flush()
+    rows = usage_summary(ApiUsage.objects.all(), ["google_account_id", "method", "error"])
+    rows.sort(key=lambda r: (r["google_account_id"] or 0, r["method"], r["error"]))
+    lines = []
+    for name, field, help_text in METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for row in rows:
+            labels = ",".join(
+                f'{label}="{escape_label(value)}"' for label, value in (
+                    ("account", row["google_account_id"] or ""),
+                    ("method", row["method"]),
+                    ("error", row["error"])))
+            lines.append(f"{name}{{{labels}}} {row[field]}")
+    stats = sink_write_coalescer.stats()
+    for name, field, metric_type, help_text in COALESCER_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {stats[field]}")
+    return "\n".join(lines) + "\n"
@@ -1,5 +1,27 @@
+import atexit
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CalSyncMagicConf(AppConfig):
     name = "cal_sync_magic"
+
+    def ready(self):
+        # Connects the signal handlers.
+        from cal_sync_magic import signals  # noqa: F401
+        from cal_sync_magic.api_usage import api_usage_recorder
+        from cal_sync_magic.services import api_call_hooks
+
+        if getattr(settings, "GOOGLE_API_USAGE_TRACKING", True):
+            api_call_hooks.append(api_usage_recorder)
+            atexit.register(flush_api_usage)
+
+
+def flush_api_usage():
+    from cal_sync_magic.api_usage import api_usage_recorder
+
+    try:
+        api_usage_recorder.flush()
+    except Exception as e:
+        print(f"Couldn't save API usage on exit: {e}")
@@ -0,0 +1,192 @@
+import time
+
+from googleapiclient.errors import HttpError
+
+from cal_sync_magic.rate_limit import rate_limiter
+from cal_sync_magic.services import (
+    ApiCall,
+    api_call_context,
+    backoff_delay,
+    error_class,
+    execute,
+    field_mask,
+    is_rate_limited,
+    is_retryable,
+    rate_limit_scope,
+    report_api_call,
+)
+
+# Google recommends no more than 50 calls per calendar batch request.
+MAX_BATCH_SIZE = 50
+
+
+class SinkWrite(object):
+    """An insert, patch or delete of an event on a sink calendar.
+    link is the EventLink the write is for, once written the caller records it.
+    Once flushed done is set (and result, the written event, for inserts and
+    patches) or error is."""
+
+    def __init__(self, calendar, method, body, event_id=None, link=None):
+        self.calendar = calendar
+        self.method = method
+        self.body = body
+        self.event_id = event_id or body.get("id")
+        self.link = link
+        self.attempts = 0
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return f"SinkWrite({self.method} {self.event_id} on {self.calendar})"
+
+    def request(self, events_api):
+        if self.method == "insert":
+            return events_api.insert(
+                calendarId=self.calendar.google_calendar_id,
+                body=self.body,
+                sendUpdates="none",
+                fields=field_mask("events.write"))
+        elif self.method == "patch":
+            return events_api.patch(
+                calendarId=self.calendar.google_calendar_id,
+                eventId=self.event_id,
+                body=self.body,
+                sendUpdates="none",
+                fields=field_mask("events.write"))
+        elif self.method == "delete":
+            return events_api.delete(
+                calendarId=self.calendar.google_calendar_id,
+                eventId=self.event_id,
+                sendUpdates="none")
+        raise ValueError(f"Unknown sink write method {self.method}")
+
+
+class SinkWriteBatcher(object):
+    """Collects sink writes and sends them as Google batch requests, split by account
+    (a batch is sent with one account's credentials) and at most max_batch_size
+    writes per batch. Each write is retried on its own if its sub-response was a
+    rate limit or server error."""
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_attempts=3, backoff=1.0):
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.pending = []
+        # The widest rate limit bucket a sub-response told us to back off, if any.
+        self._rate_limit_scope = None
+
+    def add(self, write):
+        self.pending.append(write)
+
+    def flush(self):
+        """Send everything pending, returns the flushed writes."""
+        writes, self.pending = self.pending, []
+        by_account = {}
+        for write in writes:
+            by_account.setdefault(write.calendar.google_account_id, []).append(write)
+        for account_writes in by_account.values():
+            self._flush_account(account_writes)
+        self._mirror(writes)
+        return writes
+
+    def _flush_account(self, writes):
+        account = writes[0].calendar.google_account
+        attempt = 0
+        while writes:
+            retry, again = [], []
+            self._rate_limit_scope = None
+            service = account.calendar_service()
+            for i in range(0, len(writes), self.max_batch_size):
+                self._send(service, account.account_id, writes[i:i + self.max_batch_size],
+                           retry, again)
+            if retry:
+                # Jittered exponential backoff before trying the stragglers again.
+                delay = backoff_delay(attempt, self.backoff)
+                if self._rate_limit_scope is not None:
+                    # Have every process back off the account (or the project),
+                    # the rate limiter does the waiting.
+                    rate_limiter.back_off(account.account_id, delay, self._rate_limit_scope)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+            writes = retry + again
+
+    def _send(self, service, account_id, chunk, retry, again):
+        def callback(write):
+            def done(request_id, response, exception):
+                self._done(write, response, exception, retry, again)
+            return done
+
+        batch = service.new_batch_http_request()
+        for i, write in enumerate(chunk):
+            write.attempts += 1
+            request = write.request(service.events())
+            batch.add(request, callback=callback(write), request_id=str(i))
+        try:
+            # Each write in the batch counts against the quota. Failed writes are
+            # retried one by one below, not by execute.
+            execute(batch, account_id, cost=len(chunk), retries=0, http=request.http)
+        except HttpError as e:
+            # The whole batch failed, treat it as if every write did.
+            for write in chunk:
+                self._done(write, None, e, retry, again)
+
+    def _done(self, write, response, exception, retry, again):
+        """Record a write's sub-response, writes to retry after a backoff go on retry
+        and ones to send again straight away on again."""
+        self._report(write, exception)
+        if exception is None:
+            write.done = True
+            write.result = response or None
+            write.error = None
+        elif (write.method == "delete" and isinstance(exception, HttpError) and
+              exception.resp.status in (404, 410)):
+            # Already gone, which is what we wanted.
+            write.done = True
+            write.error = None
+        elif (write.method == "insert" and isinstance(exception, HttpError) and
+              exception.resp.status == 409 and write.attempts < self.max_attempts):
+            # Already there (e.g. we crashed after inserting) or a copy we deleted
+            # earlier, Google keeps deleted ids. Update it instead, and bring it
+            # back if it was deleted.
+            write.method = "patch"
+            write.body = dict(write.body, status="confirmed")
+            again.append(write)
+        elif (isinstance(exception, HttpError) and is_retryable(exception) and
+              write.attempts < self.max_attempts):
+            if is_rate_limited(exception) and self._rate_limit_scope != "project":
+                self._rate_limit_scope = rate_limit_scope(exception)
+            retry.append(write)
+        else:
+            write.error = exception
+
+    def _report(self, write, exception):
+        """Report a write to the API call hooks. The batch itself is reported by
+        execute with its latency and size, this is for the quota each write in
+        it used."""
+        labels = {"calendar_id": write.calendar.internal_calendar_id}
+        if write.link is not None:
+            labels["sync_config_id"] = write.link.sync_config_id
+        with api_call_context(**labels):
+            report_api_call(ApiCall(
+                f"calendar.events.{write.method}",
+                write.calendar.google_account_id,
+                latency=0,
+                error=None if exception is None else error_class(exception)))
+
+    def _mirror(self, writes):
+        """Record what we wrote in each sink calendar's local event mirror."""
+        by_calendar = {}
+        for write in writes:
+            if not write.done:
+                continue
+            if write.method == "delete":
+                result = {"id": write.event_id, "status": "cancelled"}
+            else:
+                result = write.result
+            if result is not None:
+                calendar_id = write.calendar.internal_calendar_id
+                by_calendar.setdefault(calendar_id, (write.calendar, []))[1].append(result)
+        for calendar, results in by_calendar.values():
+            calendar.mirror_events(results)
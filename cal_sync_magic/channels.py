@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+
+from cal_sync_magic.expiring import RunStats, process_expiring
+from cal_sync_magic.models import UserCalendar
+
+
+class RenewStats(RunStats):
+    """Counts for a channel renewal run."""
+    counted = ("renewed",)
+    succeeded = ("renewed",)
+
+
+def expiring_channel_calendar_ids(lead_time):
+    """Watched calendars whose channel expires within lead_time, soonest first.
+    Uses the channel_expiration index. Channels from before we stored their
+    expiration come first since we can't tell how long they have left."""
+    cutoff = datetime.utcnow() + lead_time
+    return list(UserCalendar.objects.filter(
+        Q(channel_expiration__lte=cutoff) | Q(channel_expiration__isnull=True),
+        webhook_enabled=True,
+        deleted=False,
+    ).order_by(F("channel_expiration").asc(nulls_first=True)).values_list(
+        "internal_calendar_id", flat=True))
+
+
+def renew_calendar_channel(calendar_id, address):
+    try:
+        calendar = UserCalendar.objects.select_related("google_account").get(
+            internal_calendar_id=calendar_id)
+        if not (calendar.channel_address or address):
+            return "no address"
+        calendar.renew_channel(calendar.channel_address or address)
+    except Exception as e:
+        print(f"Failed to renew the channel for calendar {calendar_id}: {e}")
+        raise
+    return "renewed"
+
+
+def renew_expiring_channels(lead_time=timedelta(hours=12), batch_size=100,
+                            concurrency=4, address=None, stats=None):
+    """Renew every channel expiring within lead_time, batch_size calendars at a
+    time with at most concurrency renewals in flight. address (default the
+    WEBHOOK_ADDRESS setting) is used for channels we don't have an address for."""
+    if stats is None:
+        stats = RenewStats()
+    if address is None:
+        address = getattr(settings, "WEBHOOK_ADDRESS", None)
+    return process_expiring(
+        expiring_channel_calendar_ids(lead_time), lambda c: renew_calendar_channel(c, address),
+        stats, batch_size=batch_size, concurrency=concurrency)
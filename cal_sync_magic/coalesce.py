@@ -0,0 +1,142 @@
+import atexit
+import threading
+import time
+
+from django.db import connection
+
+
+class WriteGroup(object):
+    """The writes one caller held with a coalescer, done is called once they have
+    all been sent and the caller has closed the group (right away on close if none
+    are still held). done runs on whichever thread sent the last write."""
+
+    def __init__(self, done):
+        self.done = done
+        self._lock = threading.Lock()
+        self._held = 0
+        self._closed = False
+
+    def hold(self):
+        with self._lock:
+            self._held += 1
+
+    def sent(self):
+        with self._lock:
+            self._held -= 1
+            finished = self._closed and not self._held
+        if finished:
+            self.done()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            finished = not self._held
+        if finished:
+            self.done()
+
+
+class WriteCoalescer(object):
+    """Holds sink writes for a short window per (sink calendar, event) so a burst of
+    changes to one event (someone dragging it around) becomes a single write of its
+    final state. send is called with the writes once their window is up.
+
+    Pending writes live in memory, they are flushed at exit but a crash loses them,
+    so keep the window short."""
+
+    def __init__(self, send, window=0):
+        self.send = send
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._thread = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def submit(self, write, window=None, group=None):
+        """Hold write for window seconds (the coalescer's window if not given).
+        If group (a WriteGroup) is given it hears when the write, or the later
+        write it was coalesced into, is sent."""
+        if window is None:
+            window = self.window
+        key = (write.calendar.internal_calendar_id, write.event_id)
+        groups = [] if group is None else [group]
+        if group is not None:
+            group.hold()
+        with self._cond:
+            self.submitted += 1
+            if key in self._pending:
+                self.coalesced += 1
+                due, previous, held_for = self._pending[key]
+                groups = held_for + groups
+                # The event hasn't made it to the sink yet, so this is still an insert.
+                if previous.method == "insert" and write.method == "patch":
+                    write.method = "insert"
+            else:
+                # Don't push the deadline back, a steady stream of changes still flushes.
+                due = time.monotonic() + window
+            self._pending[key] = (due, write, groups)
+            self._ensure_flusher()
+            self._cond.notify()
+
+    def _take_due(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._cond:
+            due = [k for k, (d, _, _) in self._pending.items() if d <= now]
+            taken = [self._pending.pop(k)[1:] for k in due]
+            self.sent += len(taken)
+        return taken
+
+    def take_due(self, now=None):
+        """Remove and return the writes whose window is up."""
+        return [write for write, _ in self._take_due(now)]
+
+    def flush_due(self, now=None):
+        taken = self._take_due(now)
+        writes = [write for write, _ in taken]
+        try:
+            if writes:
+                self.send(writes)
+        finally:
+            for _, groups in taken:
+                for group in groups:
+                    group.sent()
+        return writes
+
+    def flush_all(self):
+        return self.flush_due(now=float("inf"))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "sent": self.sent,
+                "pending": len(self._pending),
+            }
+
+    def _ensure_flusher(self):
+        if self._thread is None or not self._thread.is_alive():
+            if self._thread is None:
+                atexit.register(self.flush_all)
+            self._thread = threading.Thread(
+                target=self._run, name="sink-write-coalescer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                delay = min(d for d, _, _ in self._pending.values()) - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            try:
+                self.flush_due()
+            except Exception as e:
+                print(f"Error flushing coalesced sink writes {e}")
+            finally:
+                # We're on our own thread, don't leak its DB connection.
+                connection.close()
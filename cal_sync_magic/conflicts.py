@@ -0,0 +1,326 @@
+"""Finding the events an invite conflicts with, for decline_conflict and
+soft_maybe_conflict.
+
+conflict_index keeps, per user, the busy time on all of their rule calendars in an
+interval treap (a treap ordered by start time where each node also knows the
+latest end in its subtree). It's built from the CalendarEvent mirror the first
+time one of the user's rules needs it, mirror_events applies each page of changes
+to it as they come in, and it's rebuilt after CONFLICT_INDEX_TTL seconds to pick
+up changes another process mirrored.
+
+Inserts and removals are O(log n) expected. An overlap query skips any subtree
+whose latest end is before the start of the invite, and everything right of a
+node starting after the invite's end, so finding the first conflict is O(log n)
+expected, and that's all answering an invite needs (has_conflict stops there).
+Listing all k conflicts is O(k log n) in the worst case, not O(log n + k). That
+bound needs a structure we can't update cheaply. In practice k is a handful of
+events and each query touches little more than one root-to-leaf path per
+conflict."""
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from cal_sync_magic.models import (
+    CalendarEvent,
+    CalendarRules,
+    EventLink,
+    parse_google_datetime,
+)
+from cal_sync_magic.plans import rule_plans
+
+
+def busy_interval(event):
+    """The (start, end) an event keeps us busy for, or None if it doesn't (cancelled,
+    declined, free, not answered yet or all day). Our copies of events from other
+    calendars count, they're often the only sign of that busy time here."""
+    if event.get("status") == "cancelled" or event.get("transparency") == "transparent":
+        return None
+    for attendee in event.get("attendees") or []:
+        if attendee.get("self") and attendee.get("responseStatus") in ("declined", "needsAction"):
+            return None
+    start = parse_google_datetime(event.get("start", {}).get("dateTime"))
+    end = parse_google_datetime(event.get("end", {}).get("dateTime"))
+    if start is None or end is None or end <= start:
+        return None
+    return start, end
+
+
+def pending_response(event):
+    """Our attendee entry if event is an invite we haven't answered, else None."""
+    if event.get("status") == "cancelled" or (event.get("organizer") or {}).get("self"):
+        return None
+    for attendee in event.get("attendees") or []:
+        if attendee.get("self"):
+            return attendee if attendee.get("responseStatus") == "needsAction" else None
+    return None
+
+
+class _Node(object):
+    __slots__ = ("sort_key", "end", "value", "priority", "left", "right", "max_end")
+
+    def __init__(self, sort_key, end, value):
+        self.sort_key = sort_key
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+
+def _update(node):
+    node.max_end = node.end
+    if node.left is not None and node.left.max_end > node.max_end:
+        node.max_end = node.left.max_end
+    if node.right is not None and node.right.max_end > node.max_end:
+        node.max_end = node.right.max_end
+
+
+def _split(node, sort_key):
+    """Split into the nodes before sort_key and the rest."""
+    if node is None:
+        return None, None
+    if node.sort_key < sort_key:
+        node.right, rest = _split(node.right, sort_key)
+        _update(node)
+        return node, rest
+    before, node.left = _split(node.left, sort_key)
+    _update(node)
+    return before, node
+
+
+def _merge(left, right):
+    """Merge two treaps, everything in left sorting before everything in right."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _insert(node, new):
+    if node is None:
+        return new
+    if new.priority > node.priority:
+        new.left, new.right = _split(node, new.sort_key)
+        _update(new)
+        return new
+    if new.sort_key < node.sort_key:
+        node.left = _insert(node.left, new)
+    else:
+        node.right = _insert(node.right, new)
+    _update(node)
+    return node
+
+
+def _remove(node, sort_key):
+    if node is None:
+        return None
+    if sort_key == node.sort_key:
+        return _merge(node.left, node.right)
+    if sort_key < node.sort_key:
+        node.left = _remove(node.left, sort_key)
+    else:
+        node.right = _remove(node.right, sort_key)
+    _update(node)
+    return node
+
+
+class IntervalTreap(object):
+    """Half open [start, end) intervals, each with a unique (comparable) key."""
+
+    def __init__(self):
+        self._root = None
+        self._sort_keys = {}
+
+    def __len__(self):
+        return len(self._sort_keys)
+
+    def add(self, key, start, end, value=None):
+        """Add (or move) the interval for key."""
+        self.discard(key)
+        sort_key = (start, key)
+        self._root = _insert(self._root, _Node(sort_key, end, value))
+        self._sort_keys[key] = sort_key
+
+    def discard(self, key):
+        sort_key = self._sort_keys.pop(key, None)
+        if sort_key is not None:
+            self._root = _remove(self._root, sort_key)
+
+    def _iter_overlapping(self, start, end):
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            # Go left as far as anything there can still end after start.
+            while node is not None and node.max_end > start:
+                stack.append(node)
+                node = node.left
+            if not stack:
+                return
+            node = stack.pop()
+            node_start, key = node.sort_key
+            if node_start >= end:
+                # It and everything to its right start too late.
+                return
+            if node.end > start:
+                yield key, node_start, node.end, node.value
+            node = node.right
+
+    def overlapping(self, start, end):
+        """(key, start, end, value) of the intervals overlapping [start, end), in
+        start order."""
+        return list(self._iter_overlapping(start, end))
+
+    def any_overlap(self, start, end, predicate=None):
+        """Whether any interval overlapping [start, end) passes predicate(key, value)
+        (any at all without one). Stops at the first, so without a predicate this
+        is O(log n) expected however many overlap."""
+        for key, _, _, value in self._iter_overlapping(start, end):
+            if predicate is None or predicate(key, value):
+                return True
+        return False
+
+
+class UserConflicts(object):
+    def __init__(self, rule_calendars):
+        self.built = time.monotonic()
+        # {rule id: frozenset of its calendar ids}
+        self.rule_calendars = rule_calendars
+        self.calendar_ids = frozenset().union(*rule_calendars.values())
+        self.busy = IntervalTreap()
+
+    def apply(self, calendar_id, event_id, event):
+        key = (calendar_id, event_id)
+        interval = busy_interval(event)
+        if interval is None:
+            self.busy.discard(key)
+        else:
+            self.busy.add(key, interval[0], interval[1], event.get("summary"))
+
+
+def build_user_conflicts(user_id):
+    rule_calendars = {
+        rule.pk: frozenset(c.pk for c in rule.calendars.all())
+        for rule in CalendarRules.objects.filter(user_id=user_id).prefetch_related(
+            "calendars")}
+    conflicts = UserConflicts(rule_calendars)
+    mirrored = CalendarEvent.objects.filter(
+        calendar_id__in=conflicts.calendar_ids).values_list(
+        "calendar_id", "event_id", "payload")
+    for calendar_id, event_id, payload in mirrored.iterator():
+        conflicts.apply(calendar_id, event_id, payload)
+    return conflicts
+
+
+class ConflictIndex(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+
+    def _get(self, user_id):
+        ttl = getattr(settings, "CONFLICT_INDEX_TTL", 300)
+        with self._lock:
+            conflicts = self._users.get(user_id)
+        if conflicts is None or (ttl is not None and time.monotonic() - conflicts.built >= ttl):
+            conflicts = build_user_conflicts(user_id)
+            with self._lock:
+                self._users[user_id] = conflicts
+        return conflicts
+
+    def apply(self, calendar, events):
+        """Apply a page of changes to calendar (see UserCalendar.mirror_events) if
+        we have the calendar's user indexed."""
+        with self._lock:
+            conflicts = self._users.get(calendar.user_id)
+            if conflicts is None or calendar.pk not in conflicts.calendar_ids:
+                return
+            for event in events:
+                conflicts.apply(calendar.pk, event["id"], event)
+
+    def _query(self, rule, calendar, event, exclude):
+        """The user's conflicts, event's interval and a predicate for which busy keys
+        count against it, or None if event has no interval."""
+        start = parse_google_datetime(event.get("start", {}).get("dateTime"))
+        end = parse_google_datetime(event.get("end", {}).get("dateTime"))
+        if start is None or end is None:
+            return None
+        user_conflicts = self._get(rule.user_id)
+        calendar_ids = user_conflicts.rule_calendars.get(rule.pk, frozenset())
+        own_key = (calendar.pk, event["id"])
+
+        def counts(key, value=None):
+            return key[0] in calendar_ids and key != own_key and key not in exclude
+        return user_conflicts, start, end, counts
+
+    def conflicts(self, rule, calendar, event, exclude=()):
+        """The busy (calendar id, event id, start, end, summary) on rule's calendars
+        that overlap event (on calendar), leaving out event itself and the
+        (calendar id, event id) in exclude."""
+        query = self._query(rule, calendar, event, exclude)
+        if query is None:
+            return []
+        user_conflicts, start, end, counts = query
+        with self._lock:
+            overlapping = user_conflicts.busy.overlapping(start, end)
+        return [
+            (key[0], key[1], busy_start, busy_end, summary)
+            for key, busy_start, busy_end, summary in overlapping if counts(key)]
+
+    def has_conflict(self, rule, calendar, event, exclude=()):
+        """Whether conflicts() would find anything, stopping at the first."""
+        query = self._query(rule, calendar, event, exclude)
+        if query is None:
+            return False
+        user_conflicts, start, end, counts = query
+        with self._lock:
+            return user_conflicts.busy.any_overlap(start, end, counts)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+conflict_index = ConflictIndex()
+
+
+def conflict_responses(rules, calendar, events):
+    """What to answer to the pending invites in events (a page of changes on
+    calendar): {event id: (event, "declined" or "tentative")}. Invites from someone
+    on a rule's allow_list_conflict are left alone by that rule, and if several
+    rules apply declining wins."""
+    rules = [r for r in rules if r.decline_conflict or r.soft_maybe_conflict]
+    responses = {}
+    if not rules:
+        return responses
+    for event in events:
+        if pending_response(event) is None:
+            continue
+        inviter = (event.get("organizer") or event.get("creator") or {}).get("email")
+        # Our copies of the invite on other calendars don't conflict with it.
+        copies = None
+        for rule in rules:
+            if inviter in rule_plans.get(rule).conflict_allow:
+                continue
+            if copies is None:
+                copies = set(EventLink.objects.filter(
+                    source_calendar=calendar, source_event_id=event["id"],
+                ).values_list("sink_calendar_id", "sink_event_id"))
+            if not conflict_index.has_conflict(rule, calendar, event, exclude=copies):
+                continue
+            response = "declined" if rule.decline_conflict else "tentative"
+            if responses.get(event["id"], (None, None))[1] != "declined":
+                responses[event["id"]] = (event, response)
+    return responses
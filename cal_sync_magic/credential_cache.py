@@ -0,0 +1,56 @@
+import threading
+
+
+class CredentialCache(object):
+    """Process wide cache of google credentials keyed by account_id.
+
+    Entries are only handed back while the access token is still valid, so callers
+    never see an expired token out of the cache. Anything else (missing, expired or
+    stored credentials that changed underneath us) is a miss and the caller is expected
+    to go back to the database and `put` the result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refresh_locks = {}
+
+    def get_entry(self, account_id):
+        """Get the (stored credentials, credentials) pair if the token is still valid."""
+        with self._lock:
+            entry = self._entries.get(account_id)
+        if entry is None or not entry[1].valid:
+            return None
+        return entry
+
+    def get(self, account_id, stored_credentials=None):
+        """Get the cached credentials if they are still valid.
+        If stored_credentials is provided the entry must have been built from it."""
+        entry = self.get_entry(account_id)
+        if entry is None:
+            return None
+        source, credentials = entry
+        if stored_credentials is not None and source != stored_credentials:
+            return None
+        return credentials
+
+    def refresh_lock(self, account_id):
+        """Lock held while refreshing the account's token in this process."""
+        with self._lock:
+            if account_id not in self._refresh_locks:
+                self._refresh_locks[account_id] = threading.Lock()
+            return self._refresh_locks[account_id]
+
+    def put(self, account_id, stored_credentials, credentials):
+        with self._lock:
+            self._entries[account_id] = (stored_credentials, credentials)
+
+    def invalidate(self, account_id):
+        with self._lock:
+            self._entries.pop(account_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+credential_cache = CredentialCache()
@@ -0,0 +1,83 @@
+"""Refreshing things before they expire, on a thread pool.
+
+token_refresh keeps Google tokens fresh and channels renews watch channels. Both
+find what expires within a lead time (soonest first, from an index) and work
+through it with process_expiring, the refresh_google_tokens and renew_channels
+commands run them on an interval (see management/base.py)."""
+import functools
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+
+def pool_task(func):
+    """Close the DB connection func opened once it's done. Django opens one per
+    thread and pool threads outlive the task, so it would otherwise leak."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+    return wrapper
+
+
+class RunStats(object):
+    """Outcome counts and latencies for a run. Outcomes in counted are counted as
+    attributes of the same name, only those in succeeded aren't failures. Any
+    other outcome is an error."""
+    counted: tuple[str, ...] = ()
+    succeeded: tuple[str, ...] = ()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for outcome in self.counted:
+            setattr(self, outcome, 0)
+        self.errors = {}
+        self.latencies = []
+
+    def record(self, outcome, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            if outcome in self.counted:
+                setattr(self, outcome, getattr(self, outcome) + 1)
+            else:
+                self.errors[outcome] = self.errors.get(outcome, 0) + 1
+
+    @property
+    def failed(self):
+        return sum(getattr(self, o) for o in self.counted if o not in self.succeeded) + sum(
+            self.errors.values())
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        if latencies:
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            latency = (f"p50 {statistics.median(latencies) * 1000:.1f}ms "
+                       f"p95 {p95 * 1000:.1f}ms max {latencies[-1] * 1000:.1f}ms")
+        else:
+            latency = "none"
+        counts = " ".join(f"{o} {getattr(self, o)}" for o in self.counted)
+        return f"{counts} errors {self.errors} latency {latency}"
+
+
+def process_expiring(ids, handle, stats, batch_size=100, concurrency=4):
+    """Call handle(id) for each of ids, batch_size at a time with at most
+    concurrency calls in flight, and record the outcome it returns (or the
+    name of the exception it raised) in stats."""
+    @pool_task
+    def run(item_id):
+        start = time.perf_counter()
+        try:
+            outcome = handle(item_id)
+        except Exception as e:
+            outcome = type(e).__name__
+        stats.record(outcome, time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(0, len(ids), batch_size):
+            list(executor.map(run, ids[i:i + batch_size]))
+    return stats
@@ -0,0 +1,31 @@
+import abc
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class ExpiringCommand(BaseCommand, metaclass=abc.ABCMeta):
+    """A command that refreshes things before they expire (see expiring.py), once
+    or every --interval seconds. Subclasses set failure_message and implement
+    run_once(options), which returns the run's stats."""
+    failure_message = "failed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--interval", type=int, default=0,
+                            help="Seconds between scans, 0 to scan once and exit.")
+
+    @abc.abstractmethod
+    def run_once(self, options):
+        """Run one scan with the command's options, returns its RunStats."""
+
+    def handle(self, *args, **options):
+        while True:
+            stats = self.run_once(options)
+            self.stdout.write(stats.summary())
+            if stats.failed:
+                self.stderr.write(f"{stats.failed} {self.failure_message}")
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
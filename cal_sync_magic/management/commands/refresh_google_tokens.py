@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from cal_sync_magic.management.base import ExpiringCommand
+from cal_sync_magic.token_refresh import refresh_expiring_credentials
+
+
+class Command(ExpiringCommand):
+    help = "Refresh Google tokens before they expire so sync workers don't have to."
+    failure_message = "accounts failed to refresh."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lead-minutes", type=int, default=10,
+                            help="Refresh tokens expiring within this many minutes.")
+        super().add_arguments(parser)
+
+    def run_once(self, options):
+        return refresh_expiring_credentials(
+            lead_time=timedelta(minutes=options["lead_minutes"]),
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"])
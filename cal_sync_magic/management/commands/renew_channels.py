@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from cal_sync_magic.channels import renew_expiring_channels
+from cal_sync_magic.management.base import ExpiringCommand
+
+
+class Command(ExpiringCommand):
+    help = "Renew push notification channels before they expire."
+    failure_message = "channels failed to renew."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lead-hours", type=int, default=12,
+                            help="Renew channels expiring within this many hours.")
+        parser.add_argument("--address", default=None,
+                            help="Webhook address for channels we don't have one for.")
+        super().add_arguments(parser)
+
+    def run_once(self, options):
+        return renew_expiring_channels(
+            lead_time=timedelta(hours=options["lead_hours"]),
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"],
+            address=options["address"])
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cal_sync_magic.sync_queue import drain_queue, queue_depth, worker_name
+
+
+class Command(BaseCommand):
+    help = "Work through the calendar sync jobs queued by push notifications."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10,
+                            help="How many jobs to claim at a time.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Drain the queue once and exit.")
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+        while True:
+            succeeded, failed = drain_queue(worker, batch_size=options["batch_size"])
+            if succeeded or failed:
+                self.stdout.write(
+                    f"{worker}: {succeeded} synced, {failed} failed, "
+                    f"{queue_depth()} still queued.")
+            if options["once"]:
+                return
+            time.sleep(options["poll_interval"])
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cal_sync_magic.sync_workers import run_pool
+
+
+class Command(BaseCommand):
+    help = ("Work through queued calendar syncs with a pool of processes, "
+            "partitioned by google account. Stop with SIGTERM to drain gracefully.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=10,
+                            help="How many jobs a worker claims at a time.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds a worker waits when its queue is empty.")
+        parser.add_argument("--report-interval", type=float, default=60,
+                            help="Seconds between throughput reports.")
+
+    def handle(self, *args, **options):
+        if options["processes"] < 1:
+            raise CommandError("--processes must be at least 1")
+        run_pool(
+            options["processes"],
+            batch_size=options["batch_size"],
+            poll_interval=options["poll_interval"],
+            report_interval=options["report_interval"],
+            report=self.stdout.write)
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0022_remove_usercalendar_uuid_alter_calendarrules_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='googleaccount',
+            name='credential_expiry',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:48
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_calendars(apps, schema_editor):
+    """Fold duplicate (account, calendar id) rows into one before the constraint,
+    keeping the live row and moving the duplicates' sync configs and rules onto it."""
+    UserCalendar = apps.get_model('cal_sync_magic', 'UserCalendar')
+    SyncConfigs = apps.get_model('cal_sync_magic', 'SyncConfigs')
+    CalendarRules = apps.get_model('cal_sync_magic', 'CalendarRules')
+    links = [(SyncConfigs, 'src_calendars'), (SyncConfigs, 'sink_calendars'),
+             (CalendarRules, 'calendars')]
+    duplicated = (UserCalendar.objects.values('google_account', 'google_calendar_id')
+                  .annotate(rows=Count('pk')).filter(rows__gt=1))
+    for key in duplicated:
+        keep, *extras = UserCalendar.objects.filter(
+            google_account=key['google_account'],
+            google_calendar_id=key['google_calendar_id'],
+        ).order_by('deleted', 'pk')
+        for model, field in links:
+            for owner in model.objects.filter(**{f'{field}__in': extras}).distinct():
+                getattr(owner, field).add(keep)
+        UserCalendar.objects.filter(pk__in=[c.pk for c in extras]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0023_googleaccount_credential_expiry_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googleaccount',
+            name='calendar_list_sync_token',
+            field=models.CharField(blank=True, max_length=500, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_calendars, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='usercalendar',
+            constraint=models.UniqueConstraint(fields=('google_account', 'google_calendar_id'), name='unique_google_calendar'),
+        ),
+    ]
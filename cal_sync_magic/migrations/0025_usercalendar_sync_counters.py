@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0024_calendar_list_sync_token_unique_google_calendar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usercalendar',
+            name='delta_sync_events',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='delta_syncs',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='full_sync_events',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='full_syncs',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
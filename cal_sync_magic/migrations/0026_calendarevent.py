@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:51
+
+import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0025_usercalendar_sync_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=1024)),
+                ('updated', models.DateTimeField(blank=True, null=True)),
+                ('etag', models.CharField(blank=True, max_length=100, null=True)),
+                ('status', models.CharField(default='confirmed', max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('synced_at', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('calendar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='cal_sync_magic.usercalendar')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='calendarevent',
+            constraint=models.UniqueConstraint(fields=('calendar', 'event_id'), name='unique_calendar_event'),
+        ),
+    ]
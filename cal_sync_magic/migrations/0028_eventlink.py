@@ -0,0 +1,35 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0026_calendarevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventLink',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_event_id', models.CharField(max_length=1024)),
+                ('sink_event_id', models.CharField(max_length=1024)),
+                ('content_hash', models.CharField(blank=True, max_length=64, null=True)),
+                ('field_hashes', models.JSONField(default=dict)),
+                ('sink_calendar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sink_links', to='cal_sync_magic.usercalendar')),
+                ('source_calendar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='source_links', to='cal_sync_magic.usercalendar')),
+                ('sync_config', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cal_sync_magic.syncconfigs')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='eventlink',
+            index=models.Index(fields=['sink_calendar', 'sink_event_id'], name='event_link_sink_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='eventlink',
+            constraint=models.UniqueConstraint(fields=('sync_config', 'source_calendar', 'source_event_id', 'sink_calendar'), name='unique_event_link'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0029_syncjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='notifications',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='last_message_number',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='notifications',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='notifications_dropped',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='notifications_merged',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0030_notification_dedup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usercalendar',
+            name='channel_address',
+            field=models.CharField(blank=True, max_length=1000, null=True),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='channel_expiration',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='channel_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='usercalendar',
+            name='channel_resource_id',
+            field=models.CharField(blank=True, max_length=500, null=True),
+        ),
+    ]
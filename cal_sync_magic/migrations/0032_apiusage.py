@@ -0,0 +1,37 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0031_watch_channels'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('method', models.CharField(max_length=100)),
+                ('error', models.CharField(blank=True, default='', max_length=100)),
+                ('calls', models.PositiveBigIntegerField(default=0)),
+                ('latency', models.FloatField(default=0)),
+                ('request_bytes', models.PositiveBigIntegerField(default=0)),
+                ('response_bytes', models.PositiveBigIntegerField(default=0)),
+                ('calendar', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='cal_sync_magic.usercalendar')),
+                ('google_account', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='cal_sync_magic.googleaccount')),
+                ('sync_config', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='cal_sync_magic.syncconfigs')),
+            ],
+            options={
+                'verbose_name_plural': 'API usage',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='apiusage',
+            index=models.Index(fields=['day', 'google_account'], name='api_usage_day_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:41
+
+import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cal_sync_magic', '0032_apiusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShortNoticeWarning',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=1024)),
+                ('sent_at', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cal_sync_magic.calendarrules')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='shortnoticewarning',
+            constraint=models.UniqueConstraint(fields=('rule', 'event_id'), name='unique_short_notice_warning'),
+        ),
+    ]
@@ -1,20 +1,36 @@
+import base64
+import hashlib
 import json
+import random
 import uuid
 from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import F
 from django.utils.timezone import activate
 
 import google.auth.transport.requests
 import google.oauth2.credentials
 import pytz
 import requests
-from dateutil.relativedelta import relativedelta
+from dateutil.parser import isoparse
 from google.oauth2.credentials import exceptions
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from cal_sync_magic.batch import SinkWrite, SinkWriteBatcher
+from cal_sync_magic.coalesce import WriteCoalescer
+from cal_sync_magic.credential_cache import credential_cache
+from cal_sync_magic.plans import rule_plans, sync_plans
+from cal_sync_magic.routing import routing_index
+from cal_sync_magic.services import (
+    api_call_context,
+    calendar_services,
+    execute,
+    field_mask,
+)
 
 User = get_user_model()
 
@@ -33,8 +49,149 @@ scopes = {
     "read_email_scopes": [
         "https://www.googleapis.com/auth/gmail.readonly"]
     }
-API_SERVICE_NAME = "calendar"
-API_VERSION = "v3"
+
+# Events we write to sinks are tagged with this source so we don't sync them back.
+SYNC_SOURCE_URL = "https://www.pigscanfly.ca/calendars/"
+SYNC_SOURCE_TITLE = "Calendar Sync Magic"
+# Fields copied from a source event to the sinks.
+SINK_EVENT_FIELDS = ["summary", "description", "location", "start", "end",
+                     "transparency", "visibility"]
+# Fields kept in the local event mirror.
+MIRRORED_EVENT_FIELDS = ["summary", "start", "end", "status", "source", "creator",
+                         "organizer", "attendees", "transparency", "recurringEventId"]
+
+
+def is_synced_event(event):
+    """Check if an event is one we wrote."""
+    return event.get("source", {}).get("url") == SYNC_SOURCE_URL
+
+
+# Google event ids are base32hex (a-v, 0-9), hex digits are a subset of that.
+_BASE32_TO_BASE32HEX = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", "0123456789abcdefghijklmnopqrstuv")
+
+
+def make_sink_event_id(sync_config_id, source_calendar_id, source_event_id):
+    """The id of the sink copy of an event. Deterministic so inserts can be
+    retried without making duplicates."""
+    digest = hashlib.sha1(
+        f"{sync_config_id}:{source_calendar_id}:{source_event_id}".encode("utf-8")).digest()
+    return base64.b32encode(digest).decode("ascii").rstrip("=").translate(
+        _BASE32_TO_BASE32HEX)
+
+
+def hash_value(value):
+    """Stable hash of a JSON-able value."""
+    data = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def content_hashes(body):
+    """The (content hash, per field hashes) of a sink event body."""
+    return hash_value(body), {k: hash_value(v) for k, v in body.items()}
+
+
+def changed_fields(body, field_hashes, previous_field_hashes):
+    """The part of body which differs from what we previously wrote, fields we no
+    longer send are cleared."""
+    changed = {k: v for k, v in body.items()
+               if previous_field_hashes.get(k) != field_hashes[k]}
+    for k in previous_field_hashes:
+        if k not in body:
+            changed[k] = None
+    return changed
+
+
+def parse_google_datetime(value):
+    """Parse an RFC3339 timestamp from Google into a naive UTC datetime."""
+    if value is None:
+        return None
+    return isoparse(value).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def bulk_upsert(model, objs, unique_fields, update_fields):
+    """Insert objs, updating update_fields on the rows that already exist (matched
+    on unique_fields). One statement where the database supports upserts with a
+    conflict target (Postgres, SQLite), a row at a time where it doesn't (MySQL)."""
+    # Django < 4.1 has neither the feature flag nor update_conflicts.
+    if getattr(connection.features, "supports_update_conflicts_with_target", False):
+        model.objects.bulk_create(
+            objs, update_conflicts=True, unique_fields=unique_fields,
+            update_fields=update_fields)
+        return
+    attnames = {f: model._meta.get_field(f).attname for f in unique_fields + update_fields}
+    for obj in objs:
+        lookup = {attnames[f]: getattr(obj, attnames[f]) for f in unique_fields}
+        values = {attnames[f]: getattr(obj, attnames[f]) for f in update_fields}
+        with transaction.atomic():
+            if not model.objects.filter(**lookup).update(**values):
+                obj.save(force_insert=True)
+
+
+def revoke_token(token):
+    requests.post(
+        'https://oauth2.googleapis.com/revoke',
+        params={'token': token},
+        headers = {'content-type': 'application/x-www-form-urlencoded'},
+        timeout=30)
+
+
+def flush_sink_writes(batcher):
+    """Flush a SinkWriteBatcher, update the event links of what was written and note
+    any failures on the sink calendars."""
+    writes = batcher.flush()
+    written = {}
+    deleted = []
+    for w in writes:
+        if not w.done or w.link is None:
+            continue
+        if w.method == "delete":
+            if w.link.pk is not None:
+                deleted.append(w.link.pk)
+        else:
+            if w.result is not None:
+                w.link.sink_event_id = w.result.get("id", w.link.sink_event_id)
+            key = (w.link.sync_config_id, w.link.source_calendar_id,
+                   w.link.source_event_id, w.link.sink_calendar_id)
+            written[key] = w.link
+    if written:
+        bulk_upsert(
+            EventLink,
+            list(written.values()),
+            unique_fields=["sync_config", "source_calendar", "source_event_id",
+                           "sink_calendar"],
+            update_fields=["sink_event_id", "content_hash", "field_hashes"])
+    if deleted:
+        EventLink.objects.filter(pk__in=deleted).delete()
+    failed = [w for w in writes if w.error is not None]
+    for write in failed:
+        print(f"Failed {write}: {write.error}")
+    if failed:
+        UserCalendar.objects.filter(
+            internal_calendar_id__in={w.calendar.internal_calendar_id for w in failed},
+        ).update(last_error=datetime.now())
+    return writes
+
+
+def send_sink_writes(writes):
+    batcher = SinkWriteBatcher()
+    for write in writes:
+        batcher.add(write)
+    return flush_sink_writes(batcher)
+
+
+sink_write_coalescer = WriteCoalescer(send=send_sink_writes)
+
+
+def expires_within(credentials, window):
+    """Check if credentials expire (or have expired) within the window timedelta."""
+    if window is None or credentials.expiry is None:
+        return False
+    return credentials.expiry - window <= datetime.utcnow()
+
+
+def needs_refresh(credentials, min_validity=None):
+    return credentials.expired or expires_within(credentials, min_validity)
 
 
 class GoogleAccount(models.Model):
@@ -45,7 +202,8 @@ class GoogleAccount(models.Model):
     )
     google_user_email = models.CharField(max_length=250, null=False)
     credentials = models.CharField(max_length=5000, null=False)
-    credential_expiry = models.DateTimeField(null=True)
+    credential_expiry = models.DateTimeField(null=True, db_index=True)
+    calendar_list_sync_token = models.CharField(max_length=500, null=True, blank=True)
     last_refreshed = models.DateTimeField(default=datetime.now)
     unique_together = ["user", "google_user_email"]
     calendar_sync_enabled = models.BooleanField(default=True)
@@ -70,11 +228,32 @@ class GoogleAccount(models.Model):
             return ["Account re-add required."]
         return friendly_scopes
 
-    def get_credentials(self):
+    def get_credentials(self, min_validity=None):
         """Get the credentials, try and refresh if needed, and if we can't refresh.
-        delete the credentials so we can trigger a re-add."""
-        if self.credentials is None:
+        delete the credentials so we can trigger a re-add.
+        Valid credentials are served from the process wide credential cache and we
+        only write back to the DB when the token was actually refreshed.
+        min_validity (a timedelta) forces a refresh of tokens expiring within it."""
+        if not self.credentials:
             return None
+        cached = credential_cache.get(self.account_id, self.credentials)
+        if cached is not None and not needs_refresh(cached, min_validity):
+            return cached
+        user_credentials = self._load_credentials()
+        if not needs_refresh(user_credentials, min_validity):
+            credential_cache.put(self.account_id, self.credentials, user_credentials)
+            return user_credentials
+        # Single flight: only one thread per process gets to refresh, everyone else
+        # waits here and then picks up the result from the cache.
+        with credential_cache.refresh_lock(self.account_id):
+            entry = credential_cache.get_entry(self.account_id)
+            if entry is not None and not needs_refresh(entry[1], min_validity):
+                self.credentials = entry[0]
+                self.credential_expiry = entry[1].expiry
+                return entry[1]
+            return self._refresh_credentials(min_validity)
+
+    def _load_credentials(self):
         stored_creds = json.loads(self.credentials)
         # Get expirery so we can figure out if we need a refresh
         if self.credential_expiry is not None:
@@ -84,37 +263,100 @@ class GoogleAccount(models.Model):
 
         # Drop timezone info
         stored_creds["expiry"] = stored_creds["expiry"].replace(tzinfo=None)
-        user_credentials = google.oauth2.credentials.Credentials(**stored_creds)
-        try:
-            if user_credentials.expired:
+        return google.oauth2.credentials.Credentials(**stored_creds)
+
+    def _refresh_credentials(self, min_validity):
+        """Refresh holding a lock on our row so that across processes only one refresh
+        happens, the others block on the lock and then read the refreshed token."""
+        with transaction.atomic():
+            locked = GoogleAccount.objects.select_for_update().get(
+                account_id=self.account_id)
+            self.credentials = locked.credentials
+            self.credential_expiry = locked.credential_expiry
+            if not self.credentials:
+                return None
+            user_credentials = self._load_credentials()
+            if not needs_refresh(user_credentials, min_validity):
+                # Someone else refreshed while we were waiting on the lock.
+                credential_cache.put(self.account_id, self.credentials, user_credentials)
+                return user_credentials
+            try:
                 http_request = google.auth.transport.requests.Request()
                 user_credentials.refresh(http_request)
-        except exceptions.RefreshError:
-              revoke = requests.post(
-                  'https://oauth2.googleapis.com/revoke',
-                  params={'token': user_credentials.token},
-                  headers = {'content-type': 'application/x-www-form-urlencoded'})
-              self.credentials = None
-              self.save()
-              return None
-        self.credentials = user_credentials.to_json()
-        self.credential_expiry = user_credentials.expiry
-        self.save()
+            except exceptions.RefreshError:
+                credential_cache.invalidate(self.account_id)
+                calendar_services.invalidate(self.account_id)
+                # credentials can't be NULL, empty means the account needs a re-add.
+                self.credentials = ""
+                self.save(update_fields=["credentials"])
+                # Not while we're holding the row lock.
+                token = user_credentials.token
+                transaction.on_commit(lambda: revoke_token(token))
+                return None
+            self.credentials = user_credentials.to_json()
+            self.credential_expiry = user_credentials.expiry
+            self.last_refreshed = datetime.now()
+            self.save(update_fields=["credentials", "credential_expiry", "last_refreshed"])
+        credential_cache.put(self.account_id, self.credentials, user_credentials)
         return user_credentials
 
     def calendar_service(self):
-        return build(API_SERVICE_NAME, API_VERSION, credentials=self.get_credentials())
+        """Get a (pooled) calendar service for this account."""
+        return calendar_services.get(self.account_id, self.get_credentials())
 
     def refresh_calendars(self):
-        """Refresh the user calendars. Defined here so we can share refresh logic."""
-        current_cals = self.calendar_service().calendarList().list().execute()
-        for cal in current_cals['items']:
-            deleted = "deleted" in cal and cal["deleted"]
-            UserCalendar.objects.update_or_create(
+        """Refresh the user calendars. Defined here so we can share refresh logic.
+        After the first full listing we use the calendar list sync token so we only
+        fetch what changed, and write the changes with a single bulk upsert."""
+        calendar_list = self.calendar_service().calendarList()
+        try:
+            entries, sync_token = self._list_calendars(
+                calendar_list, self.calendar_list_sync_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            # Sync token is no good anymore, start over with a full listing.
+            entries, sync_token = self._list_calendars(calendar_list, None)
+        # Later entries win, a calendar can show up in more than one page.
+        entries = {cal["id"]: cal for cal in entries}
+        deleted_ids = [cal_id for cal_id, cal in entries.items() if cal.get("deleted")]
+        calendars = [
+            UserCalendar(
                 user=self.user,
                 google_account=self,
-                google_calendar_id=cal['id'],
-                defaults={"deleted": deleted, "name": cal['summary']})
+                google_calendar_id=cal["id"],
+                name=cal.get("summary"),
+                deleted=False)
+            for cal in entries.values() if not cal.get("deleted")]
+        with transaction.atomic():
+            if calendars:
+                bulk_upsert(
+                    UserCalendar,
+                    calendars,
+                    unique_fields=["google_account", "google_calendar_id"],
+                    update_fields=["name", "deleted"])
+            if deleted_ids:
+                UserCalendar.objects.filter(
+                    google_account=self,
+                    google_calendar_id__in=deleted_ids).update(deleted=True)
+            self.calendar_list_sync_token = sync_token
+            self.save(update_fields=["calendar_list_sync_token"])
+
+    def _list_calendars(self, calendar_list, sync_token):
+        """Page through the calendar list, returns the entries & the next sync token."""
+        if sync_token is None:
+            cal_req = calendar_list.list(
+                showDeleted=True, fields=field_mask("calendarList.list"))
+        else:
+            cal_req = calendar_list.list(
+                syncToken=sync_token, fields=field_mask("calendarList.list"))
+        entries = []
+        while cal_req is not None:
+            page = execute(cal_req, self.account_id)
+            entries += page.get("items", [])
+            sync_token = page.get("nextSyncToken", sync_token)
+            cal_req = calendar_list.list_next(cal_req, page)
+        return entries, sync_token
 
     class Meta:
         app_label = "cal_sync_magic"
@@ -137,96 +379,282 @@ class UserCalendar(models.Model):
     deleted = models.BooleanField(default=False)
     last_sync_token = models.CharField(max_length=500, null=True, blank=True)
     webhook_enabled = models.BooleanField(default=False) # See https://developers.google.com/calendar/api/guides/push
+    # The push notification channel we're watching the calendar with.
+    channel_id = models.CharField(max_length=64, null=True, blank=True)
+    channel_resource_id = models.CharField(max_length=500, null=True, blank=True)
+    channel_expiration = models.DateTimeField(null=True, blank=True, db_index=True)
+    channel_address = models.CharField(max_length=1000, null=True, blank=True)
+    # How big our incremental syncs are compared to full resyncs.
+    delta_syncs = models.PositiveIntegerField(default=0)
+    delta_sync_events = models.PositiveBigIntegerField(default=0)
+    full_syncs = models.PositiveIntegerField(default=0)
+    full_sync_events = models.PositiveBigIntegerField(default=0)
+    # Push notifications, and how many never needed a sync of their own.
+    last_message_number = models.BigIntegerField(null=True, blank=True)
+    notifications = models.PositiveBigIntegerField(default=0)
+    notifications_dropped = models.PositiveBigIntegerField(default=0)
+    notifications_merged = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        app_label = "cal_sync_magic"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["google_account", "google_calendar_id"],
+                name="unique_google_calendar"),
+        ]
 
     def __str__(self):
         if self.name is None:
             return "None"
         return self.name
 
-    def handle_event(self, event):
-        syncs = SyncConfigs.objects.filter(
-            user = self.user,
-            eventgroups__contains = self)
-        rules = CalendarRules.objects.filter(
-            user = self.user,
-            calendars__contains = self)
+    def handle_event(self, event, batcher=None):
+        """Apply our syncs and rules to an event. Sink writes are queued on batcher
+        if provided (and then it's up to the caller to flush) or sent right away."""
+        self.handle_page([event], batcher=batcher)
 
-        for s in sync:
-            s.handle_event(e)
-        for r in rules:
-            r.handle_event(e)
+    def handle_page(self, events, batcher=None):
+        """Apply our syncs to each of events, and our rules to them as a whole."""
+        route = routing_index.route(self)
+        for s, sinks in route.syncs:
+            s.handle_page(events, self, batcher=batcher, sinks=sinks)
+        if route.rules:
+            CalendarRules.evaluate_rules(route.rules, events, calendar=self)
 
-    def get_event(self, id):
+    def handle_sync_event(self, heartbeat=None, group=None):
+        """Handle a push notification for this calendar, one page of changes at a time.
+        The sink writes for a page go out together as batch requests, or if
+        SINK_WRITE_COALESCE_WINDOW is set they're held for that many seconds first
+        so a burst of notifications only writes each event's final state.
+        heartbeat, if given, is called after each page. Held writes are added to
+        group (a coalesce.WriteGroup) if given, to hear when they've gone out."""
+        window = getattr(settings, "SINK_WRITE_COALESCE_WINDOW", 0)
+        for page in self.iter_change_pages():
+            batcher = SinkWriteBatcher()
+            self.handle_page(page, batcher=batcher)
+            if window:
+                for write in batcher.pending:
+                    sink_write_coalescer.submit(write, window=window, group=group)
+            else:
+                flush_sink_writes(batcher)
+            if heartbeat is not None:
+                heartbeat()
+
+    def _execute(self, request):
+        """Execute an API request for this calendar."""
+        with api_call_context(calendar_id=self.internal_calendar_id):
+            return execute(request, self.google_account_id)
+
+    def get_event(self, id, fields="events.get"):
         calendar_service = self.google_account.calendar_service()
-        return calendar_service.events().get(
-            calendarId=self.google_calendar_id,
-            eventId=id)
-    
+        try:
+            return self._execute(calendar_service.events().get(
+                calendarId=self.google_calendar_id,
+                eventId=id,
+                fields=field_mask(fields)))
+        except HttpError as e:
+            if e.resp.status in (404, 410):
+                return None
+            raise
+
     def add_event(self, event):
         calendar_service = self.google_account.calendar_service()
-        calendar_service.events().insert(
+        return self._execute(calendar_service.events().insert(
             calendarId=self.google_calendar_id,
             body=event,
-            sendUpdates="none").execute()
+            sendUpdates="none",
+            fields=field_mask("events.write")))
 
     def patch_event(self, event):
         calendar_service = self.google_account.calendar_service()
-        calendar_service.events().patch(
+        return self._execute(calendar_service.events().patch(
             calendarId=self.google_calendar_id,
             eventId=event["id"],
             body=event,
-            sendUpdates="none").execute()
+            sendUpdates="none",
+            fields=field_mask("events.write")))
+
+    def respond_to_event(self, event, response):
+        """Answer an invite on this calendar with response (e.g. "declined").
+        The listed event's attendees are masked down and the patch replaces the whole
+        list, so the full attendees are fetched first."""
+        current = self.get_event(event["id"], fields="events.respond")
+        if current is None:
+            return None
+        attendees = [dict(a, responseStatus=response) if a.get("self") else a
+                     for a in current.get("attendees", [])]
+        return self.patch_event({"id": event["id"], "attendees": attendees})
 
     def get_changes(self):
         """Get the event changes since the last sync. This _may_ return all calendar events.
-        See https://developers.google.com/calendar/api/guides/sync"""
-        calendar_service = self.google_account.calendar_service()
-        # Make initial events request
+        See https://developers.google.com/calendar/api/guides/sync
+        Prefer iter_change_pages for anything which could be large."""
+        return [event for page in self.iter_change_pages() for event in page]
+
+    def iter_change_pages(self, commit_sync_token=True, fields="events.list"):
+        """Yield the changed events since the last sync one page at a time.
+        With a sync token this is just the delta, without one (or if Google tells us
+        the token is gone with a 410) it's a full resync of upcoming events.
+        The new sync token is only stored once the last page has been consumed, so a
+        caller which stops part way through will see the same changes again.
+        Read only callers (e.g. debug views) can skip storing it with commit_sync_token.
+        fields names the field mask to request the events with."""
+        events_api = self.google_account.calendar_service().events()
+        sync_token = self.last_sync_token
+        cal_req = self._events_list_request(events_api, sync_token, fields)
+        try:
+            events = self._execute(cal_req)
+        except HttpError as e:
+            if sync_token is None or e.resp.status != 410:
+                raise
+            # The sync token is no longer valid, wipe it and do a full resync.
+            sync_token = None
+            cal_req = self._events_list_request(events_api, None, fields)
+            events = self._execute(cal_req)
+        event_count = 0
+        synced_at = datetime.utcnow()
+        while True:
+            items = events.get("items", [])
+            event_count += len(items)
+            if commit_sync_token:
+                self.mirror_events(items, synced_at)
+            yield items
+            cal_req = events_api.list_next(cal_req, events)
+            if cal_req is None:
+                break
+            events = self._execute(cal_req)
+        if commit_sync_token and "nextSyncToken" in events:
+            if sync_token is None:
+                # A full resync saw every live event, anything else is stale.
+                CalendarEvent.objects.filter(
+                    calendar=self, synced_at__lt=synced_at).delete()
+                from cal_sync_magic.conflicts import conflict_index
+                conflict_index.invalidate(self.user_id)
+            self._commit_sync(events["nextSyncToken"], sync_token is None, event_count)
+
+    def mirror_events(self, events, synced_at=None):
+        """Bring the local event mirror up to date with a page of events."""
+        from cal_sync_magic.conflicts import conflict_index
+        if synced_at is None:
+            synced_at = datetime.utcnow()
+        # Later entries win, an event can show up more than once in a page.
+        events = {e["id"]: e for e in events}
+        cancelled = [event_id for event_id, e in events.items()
+                     if e.get("status") == "cancelled"]
+        mirrored = [CalendarEvent.from_event(self, e, synced_at)
+                    for e in events.values() if e.get("status") != "cancelled"]
+        if cancelled:
+            CalendarEvent.objects.filter(calendar=self, event_id__in=cancelled).delete()
+        if mirrored:
+            bulk_upsert(
+                CalendarEvent,
+                mirrored,
+                unique_fields=["calendar", "event_id"],
+                update_fields=["updated", "etag", "status", "payload", "synced_at"])
+        conflict_index.apply(self, events.values())
+
+    def _events_list_request(self, events_api, sync_token, fields):
+        page_size = getattr(settings, "CALENDAR_EVENTS_PAGE_SIZE", 250)
+        if sync_token is not None:
+            # Google rejects a sync token combined with timeMin/timeMax/orderBy etc.
+            # singleEvents has to match the full sync the token came from.
+            return events_api.list(
+                calendarId=self.google_calendar_id,
+                syncToken=sync_token,
+                maxResults=page_size,
+                singleEvents=True,
+                fields=field_mask(fields))
         now = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
-        timeMax = (datetime.utcnow() + relativedelta(years=50)).isoformat() + 'Z'
-        cal_req = calendar_service.events().list(
-            calendarId= self.google_calendar_id,
+        return events_api.list(
+            calendarId=self.google_calendar_id,
             timeMin=now,
-            timeMax=timeMax,
-            maxResults=5000,
-            # Expands re-occuring events out, required for startTime ordering.
+            maxResults=page_size,
+            # Expands re-occuring events out.
             singleEvents=True,
-            syncToken=self.last_sync_token,
-            orderBy='startTime')
-        try:
-            events = cal_req.execute()
-        except Exception:
-            cal_req = calendar_service.events().list(
-                calendarId=self.google_calendar_id,
-                timeMin=now,
-                timeMax=timeMax,
-                maxResults=5000,
-                singleEvents=True, # Expands re-occuring events out, required for startTime ordering.
-                orderBy='startTime')
-        collected_events = events["items"]
-        while "nextPageToken" in events:
-            cal_req = calendar_service.events().list(previous_request=cal_req, previous_response=exents)
-            events = cal_req.execute()
-            collected_events += events["items"]
-            self.last_sync_token = events["syncToken"]
-            self.save()
-        return collected_events
+            fields=field_mask(fields))
+
+    def _commit_sync(self, next_sync_token, full_sync, event_count):
+        """Store the new sync token along with the sync counters in one UPDATE.
+        We only move the token forward from the one we started with, if another sync
+        got there first we leave its (newer) token alone."""
+        if full_sync:
+            counters = {"full_syncs": F("full_syncs") + 1,
+                        "full_sync_events": F("full_sync_events") + event_count}
+        else:
+            counters = {"delta_syncs": F("delta_syncs") + 1,
+                        "delta_sync_events": F("delta_sync_events") + event_count}
+        UserCalendar.objects.filter(
+            pk=self.pk, last_sync_token=self.last_sync_token,
+        ).update(last_sync_token=next_sync_token, **counters)
+        self.last_sync_token = next_sync_token
 
     def make_channel_id(self):
+        """The id of the channel we're watching with. Channels from before we kept
+        track of them were always {internal id}-{google id}."""
+        if self.channel_id:
+            return self.channel_id
         return f"{self.internal_calendar_id}-{self.google_calendar_id}"
 
+    def new_channel_id(self):
+        # Channel ids must be unique (while both are live) and at most 64 characters.
+        return f"{self.internal_calendar_id}-{uuid.uuid4().hex}"
+
+    def watch(self, address, ttl=None):
+        """Open a new push notification channel for the calendar and remember it.
+        ttl defaults to WEBHOOK_CHANNEL_TTL, with some jitter so channels opened
+        together don't all come up for renewal together.
+        Returns the (channel id, resource id) of the channel it replaces."""
+        if ttl is None:
+            ttl = getattr(settings, "WEBHOOK_CHANNEL_TTL", 7 * 24 * 3600)
+            ttl = int(ttl * (0.9 + 0.1 * random.random()))
+        old = (self.make_channel_id(), self.channel_resource_id)
+        calendar_service = self.google_account.calendar_service()
+        channel = self._execute(calendar_service.events().watch(
+            calendarId = self.google_calendar_id,
+            body = {
+                "id": self.new_channel_id(),
+                "type": "web_hook",
+                "address": address,
+                "params": {"ttl": str(ttl)},
+            }))
+        expiration = channel.get("expiration")
+        if expiration is not None:
+            expiration = datetime.utcfromtimestamp(int(expiration) / 1000)
+        self.webhook_enabled = True
+        self.channel_id = channel["id"]
+        self.channel_resource_id = channel.get("resourceId")
+        self.channel_expiration = expiration
+        self.channel_address = address
+        # Message numbers are per channel.
+        self.last_message_number = None
+        UserCalendar.objects.filter(pk=self.pk).update(
+            webhook_enabled=True,
+            channel_id=self.channel_id,
+            channel_resource_id=self.channel_resource_id,
+            channel_expiration=self.channel_expiration,
+            channel_address=self.channel_address,
+            last_message_number=None)
+        return old
+
+    def stop_channel(self, channel_id, resource_id):
+        """Stop an (old) channel, it's fine if Google already forgot about it."""
+        calendar_service = self.google_account.calendar_service()
+        try:
+            self._execute(calendar_service.channels().stop(
+                body = {"id": channel_id, "resourceId": resource_id}))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+
+    def renew_channel(self, address=None):
+        """Open a replacement channel, then stop the old one."""
+        old_channel_id, old_resource_id = self.watch(address or self.channel_address)
+        if old_resource_id is not None:
+            self.stop_channel(old_channel_id, old_resource_id)
+
     def subscribe_if_needed(self, address):
         if not self.webhook_enabled:
-            self.webhook_enabled = True
-            calendar_service = self.google_account.calendar_service()
-            calendar_service.events().watch(
-                calendarId = self.google_calendar_id,
-                id = self.make_channel_id(),
-                address = address
-            ).execute()
-            self.save()
-    class Meta:
-        app_label = "cal_sync_magic"
+            self.watch(address)
 
 class SyncConfigs(models.Model):
     """
@@ -250,35 +678,178 @@ class SyncConfigs(models.Model):
     def __str__(self):
         return f"{self.src_calendars.all()} to {self.sink_calendars.all()}"
 
-    def handle_event(self, event):
+    def clean_event(self, event):
+        """Build the body we write to the sink calendars for a source event, or None
+        if this sync skips the event."""
+        plan = sync_plans.get(self)
+        if (plan.creator_regex is not None and
+            plan.creator_regex.search(event.get("creator", {}).get("email", "")) is None):
+            return None
+        if (plan.invitee_threshold is not None and
+            len(event.get("attendees", [])) > plan.invitee_threshold):
+            return None
+        cleaned_event = {k: event[k] for k in SINK_EVENT_FIELDS if k in event}
+        title = cleaned_event.get("summary", "")
+        if plan.rewrite_regex is not None:
+            title = plan.rewrite_regex.sub("", title)
+        if plan.default_title is not None:
+            if plan.title_regex is not None and plan.title_regex.search(title) is None:
+                title = plan.default_title
+        cleaned_event["summary"] = title
+        if plan.hide_details:
+            cleaned_event["description"] = "Magical synced calendar event."
+            cleaned_event.pop("location", None)
+        cleaned_event["privateCopy"] = True
+        cleaned_event["source"] = {"url": SYNC_SOURCE_URL, "title": SYNC_SOURCE_TITLE}
+        cleaned_event["attendees"] = []
+        return cleaned_event
+
+    def handle_event(self, event, source_calendar, batcher=None, sinks=None):
+        """Copy an event from source_calendar to our sinks (or remove the copies if it
+        was cancelled). Writes are queued on batcher if provided (the caller
+        flushes) otherwise they are sent before we return. sinks, if provided, are
+        our sink calendars (e.g. from the routing index) so we don't look them up."""
+        self.handle_page([event], source_calendar, batcher=batcher, sinks=sinks)
+
+    def handle_page(self, events, source_calendar, batcher=None, sinks=None):
+        """handle_event for a page of events, their links are read in one query."""
         # No self propegating loops.
-        if ("source" in cleaned_event
-            and cleaned_event["source"] == "https://www.pigscanfly.ca/calendars/"):
+        events = [event for event in events if not is_synced_event(event)]
+        if not events:
             return
-        for s in sink_calendars.filter(user=self.user):
-            cleaned_event = event
-            if self.default_title is not None:
-                if (self.match_title_regex is not None and
-                    re.search(self.match_title_regex, cleaned_event["title"]) is None):
-
-                    cleaned_event["title"] = default_title
-            if self.hide_details:
-                cleaned_event["description"] = "Magical synced calendar event."
-            cleaned_event["privateCopy"] = True
-            cleaned_event["source"] = "https://www.pigscanfly.ca/calendars/"
-            cleaned_event["attendees"] = []
-            current_event = s.get_event(id=event["id"])
-            if current_event is None:
-                s.add_event(cleaned_event)
+        own_batcher = batcher is None
+        if own_batcher:
+            batcher = SinkWriteBatcher()
+        links = {}
+        for link in EventLink.objects.filter(
+                sync_config=self,
+                source_calendar=source_calendar,
+                source_event_id__in={event["id"] for event in events},
+        ).select_related("sink_calendar__google_account"):
+            links.setdefault(link.source_event_id, {})[link.sink_calendar_id] = link
+        if sinks is None:
+            sinks = list(self.sink_calendars.filter(
+                user_id=self.user_id).select_related("google_account"))
+        for event in events:
+            self._queue_writes(
+                event, source_calendar, batcher, sinks, links.get(event["id"], {}))
+        if own_batcher:
+            flush_sink_writes(batcher)
+
+    def _queue_writes(self, event, source_calendar, batcher, sinks, links):
+        """Queue the writes for one event, links are its EventLinks by sink calendar."""
+        cleaned_event = None
+        if event.get("status") != "cancelled":
+            cleaned_event = self.clean_event(event)
+        if cleaned_event is None:
+            # Cancelled, or no longer something we sync, remove our copies.
+            for link in links.values():
+                batcher.add(SinkWrite(
+                    link.sink_calendar, "delete", None,
+                    event_id=link.sink_event_id, link=link))
+            return
+        cleaned_event["id"] = make_sink_event_id(
+            self.id, source_calendar.internal_calendar_id, event["id"])
+        content_hash, field_hashes = content_hashes(cleaned_event)
+        for s in sinks:
+            link = links.get(s.internal_calendar_id)
+            if link is None:
+                link = EventLink(
+                    sync_config=self,
+                    source_calendar=source_calendar,
+                    source_event_id=event["id"],
+                    sink_calendar=s,
+                    sink_event_id=cleaned_event["id"],
+                    content_hash=content_hash,
+                    field_hashes=field_hashes)
+                # A 409 means an earlier attempt got as far as Google, the batcher
+                # turns it into a patch of the same (deterministic) id.
+                batcher.add(SinkWrite(s, "insert", cleaned_event, link=link))
+            elif link.content_hash == content_hash:
+                # e.g. an RSVP change on the source, the sink copy is the same.
+                continue
             else:
-                if cleaned_event["source"] == "https://www.pigscanfly.ca/calendars/":
-                    s.patch_event(cleaned_event)
-                else:
-                    print("Skipping sync back, looks like OG event.")
+                body = changed_fields(cleaned_event, field_hashes, link.field_hashes)
+                link.content_hash = content_hash
+                link.field_hashes = field_hashes
+                batcher.add(SinkWrite(
+                    s, "patch", body, event_id=link.sink_event_id, link=link))
+
     class Meta:
         app_label = "cal_sync_magic"
 
 
+class EventLink(models.Model):
+    """
+    Which sink event a sync config made from which source event, and the hashes of
+    what we last wrote to it.
+    """
+    sync_config = models.ForeignKey(SyncConfigs, on_delete=models.CASCADE)
+    source_calendar = models.ForeignKey(
+        'UserCalendar', on_delete=models.CASCADE, related_name='source_links')
+    source_event_id = models.CharField(max_length=1024)
+    sink_calendar = models.ForeignKey(
+        'UserCalendar', on_delete=models.CASCADE, related_name='sink_links')
+    sink_event_id = models.CharField(max_length=1024)
+    content_hash = models.CharField(max_length=64, null=True, blank=True)
+    field_hashes = models.JSONField(default=dict)
+
+    class Meta:
+        app_label = "cal_sync_magic"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sync_config", "source_calendar", "source_event_id", "sink_calendar"],
+                name="unique_event_link"),
+        ]
+        indexes = [
+            models.Index(fields=["sink_calendar", "sink_event_id"],
+                         name="event_link_sink_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.source_event_id} -> {self.sink_event_id} on {self.sink_calendar_id}"
+
+
+class CalendarEvent(models.Model):
+    """
+    Local mirror of the events on a calendar, kept current from get_changes deltas
+    and our own writes so we don't have to ask Google what's there.
+    """
+    calendar = models.ForeignKey(
+        UserCalendar,
+        on_delete=models.CASCADE,
+        related_name="events")
+    event_id = models.CharField(max_length=1024)
+    updated = models.DateTimeField(null=True, blank=True)
+    etag = models.CharField(max_length=100, null=True, blank=True)
+    status = models.CharField(max_length=20, default="confirmed")
+    # The subset of the event (MIRRORED_EVENT_FIELDS) we actually look at.
+    payload = models.JSONField(default=dict)
+    synced_at = models.DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        app_label = "cal_sync_magic"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["calendar", "event_id"],
+                name="unique_calendar_event"),
+        ]
+
+    def __str__(self):
+        return f"{self.event_id} on {self.calendar_id}"
+
+    @classmethod
+    def from_event(cls, calendar, event, synced_at):
+        return cls(
+            calendar=calendar,
+            event_id=event["id"],
+            updated=parse_google_datetime(event.get("updated")),
+            etag=event.get("etag"),
+            status=event.get("status", "confirmed"),
+            payload={k: event[k] for k in MIRRORED_EVENT_FIELDS if k in event},
+            synced_at=synced_at)
+
+
 class CalendarRules(models.Model):
     """
     Configuration for rules to attempt to apply to calendar events as they come in.
@@ -327,23 +898,149 @@ class CalendarRules(models.Model):
         """Evaluate a rule and take the configured action on it."""
         self.evaluate_schedule(event)
 
-    def evaluate_schedule(self, event):
-        if self.min_sched is not None:
+    def is_short_notice(self, event, now=None):
+        """Is event an invite (from someone not on the allow list) starting sooner
+        than min_sched from now?"""
+        plan = rule_plans.get(self)
+        if plan.min_sched is None or event.get("status") == "cancelled":
+            return False
+        if is_synced_event(event):
+            return False
+        creator = event.get("creator") or {}
+        email = creator.get("email")
+        if email is None or creator.get("self") or email in plan.min_sched_allow:
+            return False
+        # All day events don't have a dateTime, we don't worry about those.
+        start = parse_google_datetime(event.get("start", {}).get("dateTime"))
+        if start is None:
+            return False
+        if now is None:
             now = datetime.utcnow()
-            event_start = iso8601.parse_date(event.start.dateTime)
-            if ((now - event_start) < self.min_sched and
-                creator.email not in self.get_min_sched_allow() and
-                event["source"] is None and event["creator"] is not None and
-                event["creator"]["email"] is not None):
-
-                from django.core.mail import send_mail
-                subject_line = f"Invite to {event.summary}"
-                if event["creator"]["DisplayName"] is not None:
-                    subject_line = f"Invite to {event.summary} from {event.creator.DisplayName}"
-                send_email(
-                    subject_line,
-                    event["creator"]["email"],
-                    "calendar-magic@pigscanfly.ca",
-                    f"FYI the invite to this event was sent with less than {self.min_sched} " +
-                    f" notice so {self.google_user_email} may not make it."
-                )
+        return timedelta(0) <= start - now < plan.min_sched
+
+    @classmethod
+    def evaluate_rules(cls, rules, events, calendar=None):
+        """Evaluate rules over a page of events at once, see rule_eval. With the
+        calendar the events are on we also answer conflicting invites, see conflicts."""
+        from cal_sync_magic.conflicts import conflict_responses
+        from cal_sync_magic.rule_eval import short_notice_events
+        for rule, short_notice in short_notice_events(rules, events).items():
+            for event in short_notice:
+                rule.warn_short_notice(event)
+        if calendar is None:
+            return
+        for event, response in conflict_responses(rules, calendar, events).values():
+            calendar.respond_to_event(event, response)
+
+    def evaluate_schedule(self, event):
+        if self.is_short_notice(event):
+            self.warn_short_notice(event)
+
+    def warn_short_notice(self, event):
+        """Let the creator of event know we may not make it, once per event."""
+        from django.core.mail import send_mail
+        _, first = ShortNoticeWarning.objects.get_or_create(rule=self, event_id=event["id"])
+        if not first:
+            return
+        creator = event["creator"]
+        subject_line = f"Invite to {event.get('summary', '')}"
+        if creator.get("displayName") is not None:
+            subject_line = f"{subject_line} from {creator['displayName']}"
+        send_mail(
+            subject_line,
+            f"FYI the invite to this event was sent with less than {self.min_sched} " +
+            f"notice so {self.user.email} may not make it.",
+            "calendar-magic@pigscanfly.ca",
+            [creator["email"]])
+
+
+class ShortNoticeWarning(models.Model):
+    """
+    A short notice warning we've sent, so edits to the event (or resyncs) don't
+    send it again.
+    """
+    rule = models.ForeignKey(CalendarRules, on_delete=models.CASCADE)
+    event_id = models.CharField(max_length=1024)
+    sent_at = models.DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        app_label = "cal_sync_magic"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["rule", "event_id"],
+                name="unique_short_notice_warning"),
+        ]
+
+
+class SyncJob(models.Model):
+    """
+    A push notification waiting to be synced. GoogleCallBack queues these and the
+    run_sync_worker command works through them, so Google isn't kept waiting on a sync.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATUSES = [(PENDING, "Pending"), (RUNNING, "Running"), (FAILED, "Failed")]
+
+    calendar = models.ForeignKey(
+        UserCalendar,
+        on_delete=models.CASCADE,
+        related_name="sync_jobs")
+    channel_id = models.CharField(max_length=1024)
+    resource_state = models.CharField(max_length=20, null=True, blank=True)
+    # How many notifications this job covers.
+    notifications = models.PositiveIntegerField(default=1)
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    created = models.DateTimeField(default=datetime.utcnow)
+    # When the job can next be picked up, pushed back after a failure.
+    available_at = models.DateTimeField(default=datetime.utcnow)
+    attempts = models.PositiveIntegerField(default=0)
+    locked_by = models.CharField(max_length=100, null=True, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        app_label = "cal_sync_magic"
+        indexes = [
+            models.Index(fields=["status", "available_at"], name="sync_job_ready_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.status} sync of {self.calendar_id} ({self.attempts} attempts)"
+
+
+class ApiUsage(models.Model):
+    """
+    Google API calls made, rolled up per day, account, calendar, sync config, method
+    and error, see api_usage. Rows outlive what they're about so the ForeignKeys
+    aren't enforced.
+    """
+    day = models.DateField()
+    google_account = models.ForeignKey(
+        GoogleAccount, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True)
+    calendar = models.ForeignKey(
+        UserCalendar, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True)
+    sync_config = models.ForeignKey(
+        SyncConfigs, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True)
+    method = models.CharField(max_length=100)
+    # The error class (e.g. "HttpError 429"), blank for calls which worked.
+    error = models.CharField(max_length=100, blank=True, default="")
+    # Batch requests count as none, each request in them is counted on its own.
+    calls = models.PositiveBigIntegerField(default=0)
+    # Total seconds spent on the calls.
+    latency = models.FloatField(default=0)
+    request_bytes = models.PositiveBigIntegerField(default=0)
+    response_bytes = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        app_label = "cal_sync_magic"
+        verbose_name_plural = "API usage"
+        indexes = [
+            models.Index(fields=["day", "google_account"], name="api_usage_day_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.calls} {self.method} calls on {self.day}"
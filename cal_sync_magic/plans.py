@@ -0,0 +1,113 @@
+"""Compiled versions of SyncConfigs and CalendarRules.
+
+A plan holds everything about a config that's the same for every event (compiled
+regexes, allow lists as sets) so handling an event doesn't redo it. Plans are cached
+by config id, signals.py drops them when a config is saved or deleted, and a cached
+plan is only used if it was built from the same field values as the config in hand
+(so edits from another process, or unsaved ones, are never missed)."""
+import re
+import threading
+
+SYNC_PLAN_FIELDS = ("hide_details", "default_title", "match_title_regex",
+                    "match_creator_regex", "rewrite_regex", "invitee_skip_event_threshold")
+RULE_PLAN_FIELDS = ("min_sched", "allow_list_min_sched", "allow_list_conflict")
+
+
+def compile_regex(pattern):
+    if not pattern:
+        return None
+    return re.compile(pattern)
+
+
+class AllowList(object):
+    """A comma separated list of addresses. Besides exact addresses entries can be
+    "*@example.com" (or "@example.com") for anyone at example.com, or
+    "*.example.com" for anyone at any subdomain of it. Matching is case insensitive."""
+
+    def __init__(self, text):
+        exact, domains, subdomains = set(), set(), set()
+        for entry in (text or "").split(","):
+            entry = entry.strip().lower()
+            if not entry:
+                continue
+            if entry.startswith("*@") or entry.startswith("@"):
+                domains.add(entry.split("@", 1)[1])
+            elif entry.startswith("*."):
+                subdomains.add(entry[2:])
+            else:
+                exact.add(entry)
+        self.exact = frozenset(exact)
+        self.domains = frozenset(domains)
+        self.subdomains = frozenset(subdomains)
+
+    def __bool__(self):
+        return bool(self.exact or self.domains or self.subdomains)
+
+    def __contains__(self, email):
+        if not email:
+            return False
+        email = email.lower()
+        if email in self.exact:
+            return True
+        domain = email.rpartition("@")[2]
+        if domain in self.domains:
+            return True
+        if self.subdomains:
+            parts = domain.split(".")
+            for i in range(1, len(parts)):
+                if ".".join(parts[i:]) in self.subdomains:
+                    return True
+        return False
+
+
+class SyncPlan(object):
+    """A compiled SyncConfigs, see SyncConfigs.clean_event."""
+
+    def __init__(self, config):
+        self.hide_details = config.hide_details
+        self.default_title = config.default_title
+        self.title_regex = compile_regex(config.match_title_regex)
+        self.creator_regex = compile_regex(config.match_creator_regex)
+        self.rewrite_regex = compile_regex(config.rewrite_regex)
+        self.invitee_threshold = config.invitee_skip_event_threshold
+
+
+class RulePlan(object):
+    """A compiled CalendarRules."""
+
+    def __init__(self, rule):
+        self.min_sched = rule.min_sched
+        self.min_sched_allow = AllowList(rule.allow_list_min_sched)
+        self.conflict_allow = AllowList(rule.allow_list_conflict)
+
+
+class PlanCache(object):
+    def __init__(self, plan_class, fields):
+        self.plan_class = plan_class
+        self.fields = fields
+        self._lock = threading.Lock()
+        self._plans = {}
+
+    def get(self, config):
+        key = tuple(getattr(config, f) for f in self.fields)
+        with self._lock:
+            entry = self._plans.get(config.pk)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        plan = self.plan_class(config)
+        if config.pk is not None:
+            with self._lock:
+                self._plans[config.pk] = (key, plan)
+        return plan
+
+    def invalidate(self, config_id):
+        with self._lock:
+            self._plans.pop(config_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+sync_plans = PlanCache(SyncPlan, SYNC_PLAN_FIELDS)
+rule_plans = PlanCache(RulePlan, RULE_PLAN_FIELDS)
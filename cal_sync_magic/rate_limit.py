@@ -0,0 +1,148 @@
+"""Token bucket rate limits for Google API calls.
+
+Each call takes a token from its account's bucket and one from the project wide
+bucket. The buckets live in a small sqlite file so every process on the host (web
+workers, sync workers, cron jobs) draws from the same ones."""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+# (tokens per second, burst) for each kind of bucket.
+DEFAULT_RATE_LIMITS = {
+    "account": (10, 20),
+    "project": (100, 200),
+}
+
+
+def rate_limits():
+    """The configured rate limits, None if rate limiting is off."""
+    limits = getattr(settings, "GOOGLE_API_RATE_LIMITS", DEFAULT_RATE_LIMITS)
+    if limits is None:
+        return None
+    return dict(DEFAULT_RATE_LIMITS, **limits)
+
+
+def store_path():
+    return getattr(settings, "GOOGLE_API_RATE_LIMIT_DB", None) or os.path.join(
+        tempfile.gettempdir(), "cal_sync_magic_rate_limits.sqlite3")
+
+
+class TokenBucketStore(object):
+    """Token buckets in a sqlite file. Every read-modify-write happens inside a
+    BEGIN IMMEDIATE transaction so concurrent processes take turns."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads or across a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _update(self, buckets, fn):
+        """Run fn(current tokens) for buckets, a list of (key, rate, burst), in one
+        transaction. fn returns the new tokens, or None to leave them alone."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens = []
+            for key, rate, burst in buckets:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    tokens.append(burst)
+                else:
+                    tokens.append(min(burst, row[0] + (now - row[1]) * rate))
+            new_tokens = fn(tokens)
+            if new_tokens is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    [(key, t, now) for (key, _, _), t in zip(buckets, new_tokens)])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return tokens
+
+    def take(self, buckets, cost=1):
+        """Take cost tokens from every bucket if they all have them. Returns how
+        many seconds to wait before trying again, 0 if the tokens were taken."""
+        wait = []
+
+        def take_tokens(tokens):
+            for (_, rate, _), t in zip(buckets, tokens):
+                if t < cost:
+                    wait.append((cost - t) / rate)
+            if wait:
+                return None
+            return [t - cost for t in tokens]
+
+        self._update(buckets, take_tokens)
+        return max(wait, default=0)
+
+    def drain(self, buckets, seconds):
+        """Empty buckets so nobody gets a token for (at least) seconds."""
+        self._update(buckets, lambda tokens: [
+            min(t, -rate * seconds) for (_, rate, _), t in zip(buckets, tokens)])
+
+
+class RateLimiter(object):
+    """Per account and per project token buckets, see rate_limits()."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stores = {}
+
+    def _store(self):
+        path = store_path()
+        with self._lock:
+            if path not in self._stores:
+                self._stores[path] = TokenBucketStore(path)
+            return self._stores[path]
+
+    def _buckets(self, account_id, limits):
+        buckets = [("project", *limits["project"])]
+        if account_id is not None:
+            buckets.append((f"account:{account_id}", *limits["account"]))
+        return buckets
+
+    def acquire(self, account_id, cost=1):
+        """Block until cost calls for account_id are allowed."""
+        limits = rate_limits()
+        if limits is None:
+            return
+        buckets = self._buckets(account_id, limits)
+        # A batch can't take more than a full bucket at once.
+        cost = min([cost] + [burst for _, _, burst in buckets])
+        while True:
+            wait = self._store().take(buckets, cost)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def back_off(self, account_id, seconds, scope="account"):
+        """Google told us to slow down, hold off every process's calls for
+        account_id (or everyone's, if it's None or scope is "project") for seconds."""
+        limits = rate_limits()
+        if limits is None:
+            return
+        buckets = self._buckets(account_id, limits)
+        if scope != "project":
+            buckets = buckets[-1:]
+        self._store().drain(buckets, seconds)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,82 @@
+"""Which syncs and rules apply to a calendar's events.
+
+routing_index keeps, per user, a map from internal_calendar_id to the syncs that
+have the calendar as a source (with their sink calendars) and the rules that watch
+it, so handling an event doesn't go back to the database. A user's routes are built
+together with one prefetching query per model the first time one of their calendars
+needs them, signals.py drops them when any of the models involved change, and they
+are rebuilt after ROUTING_INDEX_TTL seconds regardless to pick up changes made by
+other processes."""
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Prefetch
+
+
+class Route(object):
+    def __init__(self):
+        # (SyncConfigs, [sink UserCalendar]) pairs.
+        self.syncs = []
+        self.rules = []
+
+
+EMPTY_ROUTE = Route()
+
+
+def build_routes(user_id):
+    """Build the {internal_calendar_id: Route} map for a user."""
+    from cal_sync_magic.models import CalendarRules, SyncConfigs, UserCalendar
+
+    calendars = UserCalendar.objects.filter(user_id=user_id)
+    syncs = SyncConfigs.objects.filter(user_id=user_id).order_by("pk").prefetch_related(
+        Prefetch("src_calendars", queryset=calendars.only("pk"), to_attr="routed_srcs"),
+        Prefetch("sink_calendars", queryset=calendars.select_related("google_account"),
+                 to_attr="routed_sinks"))
+    rules = CalendarRules.objects.filter(user_id=user_id).order_by("pk").select_related(
+        "user").prefetch_related(
+        Prefetch("calendars", queryset=calendars.only("pk"), to_attr="routed_calendars"))
+    routes = defaultdict(Route)
+    for sync in syncs:
+        for src in sync.routed_srcs:
+            routes[src.pk].syncs.append((sync, sync.routed_sinks))
+    for rule in rules:
+        for calendar in rule.routed_calendars:
+            routes[calendar.pk].rules.append(rule)
+    return dict(routes)
+
+
+class RoutingIndex(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._generation = 0
+
+    def route(self, calendar):
+        """The Route for calendar's events."""
+        user_id = calendar.user_id
+        ttl = getattr(settings, "ROUTING_INDEX_TTL", 60)
+        with self._lock:
+            entry = self._users.get(user_id)
+            generation = self._generation
+        if entry is None or (ttl is not None and time.monotonic() - entry[0] >= ttl):
+            entry = (time.monotonic(), build_routes(user_id))
+            with self._lock:
+                # Don't keep what we built if it was invalidated while we were at it.
+                if self._generation == generation:
+                    self._users[user_id] = entry
+        return entry[1].get(calendar.internal_calendar_id, EMPTY_ROUTE)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._users.clear()
+
+
+routing_index = RoutingIndex()
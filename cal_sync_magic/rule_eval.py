@@ -0,0 +1,54 @@
+"""Evaluating CalendarRules over a whole page of changes at once.
+
+A full resync hands us pages of up to 250 events, and every rule on the calendar
+looks at each of them. EventPage parses what the rules need out of a page once
+(start times into a datetime64 array, creators, whether the event is an invite
+at all) and each rule's min_sched threshold is then a couple of array operations
+over the page. The allow list is only consulted for the few events that are left."""
+from datetime import datetime
+
+import numpy as np
+
+from cal_sync_magic.models import is_synced_event, parse_google_datetime
+from cal_sync_magic.plans import rule_plans
+
+
+class EventPage(object):
+    def __init__(self, events):
+        self.events = list(events)
+        self.creators = []
+        starts = []
+        eligible = []
+        for event in self.events:
+            creator = event.get("creator") or {}
+            email = creator.get("email")
+            self.creators.append(email)
+            eligible.append(
+                event.get("status") != "cancelled" and not is_synced_event(event) and
+                email is not None and not creator.get("self"))
+            # All day events don't have a dateTime (NaT never matches).
+            starts.append(parse_google_datetime(event.get("start", {}).get("dateTime")))
+        self.starts = np.array(starts, dtype="datetime64[us]")
+        self.eligible = np.array(eligible, dtype=bool)
+
+
+def short_notice_events(rules, events, now=None):
+    """Map each of rules to the events (a page from iter_change_pages, or an
+    EventPage) that are invites starting sooner than its min_sched from now.
+    Same answer as CalendarRules.is_short_notice, event by event."""
+    page = events if isinstance(events, EventPage) else EventPage(events)
+    if now is None:
+        now = datetime.utcnow()
+    until_start = page.starts - np.datetime64(now, "us")
+    started = until_start < np.timedelta64(0, "us")
+    matches = {}
+    for rule in rules:
+        plan = rule_plans.get(rule)
+        if plan.min_sched is None or not len(page.events):
+            matches[rule] = []
+            continue
+        mask = page.eligible & ~started & (until_start < np.timedelta64(plan.min_sched, "us"))
+        matches[rule] = [
+            page.events[i] for i in np.flatnonzero(mask)
+            if page.creators[i] not in plan.min_sched_allow]
+    return matches
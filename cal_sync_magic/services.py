@@ -0,0 +1,275 @@
+import contextlib
+import contextvars
+import json
+import random
+import threading
+import time
+from typing import Callable
+
+from django.conf import settings
+
+import google_auth_httplib2
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+
+from cal_sync_magic.rate_limit import rate_limiter
+
+API_SERVICE_NAME = "calendar"
+API_VERSION = "v3"
+
+# Partial response masks (the `fields` parameter) for each call site, so Google only
+# sends what the sync and rule code reads. Override any of them with the
+# GOOGLE_API_FIELD_MASKS setting, a mask of None asks for the full resource.
+EVENT_FIELDS = ("id,status,updated,etag,summary,description,location,start,end,"
+                "transparency,visibility,source,recurringEventId,"
+                "creator(email,displayName,self),organizer(email,displayName,self),"
+                "attendees(email,responseStatus,self,organizer)")
+DEFAULT_FIELD_MASKS = {
+    "events.list": f"nextPageToken,nextSyncToken,items({EVENT_FIELDS})",
+    "events.get": EVENT_FIELDS,
+    # We only mirror what we wrote.
+    "events.write": EVENT_FIELDS,
+    # Patching attendees replaces the whole list, so answering an invite re-reads
+    # every attendee field to write back untouched.
+    "events.respond": "attendees",
+    "calendarList.list": "nextPageToken,nextSyncToken,items(id,summary,deleted)",
+    # Debug views want to see everything.
+    "debug.events.list": None,
+}
+
+_discovery_lock = threading.Lock()
+_discovery_docs: dict[tuple[str, str], dict] = {}
+
+
+def get_discovery_doc(service_name=API_SERVICE_NAME, version=API_VERSION):
+    """Load (once) the static discovery document bundled with googleapiclient.
+    This avoids re-reading & re-parsing (or worse fetching) it on every build."""
+    key = (service_name, version)
+    with _discovery_lock:
+        if key not in _discovery_docs:
+            doc = get_static_doc(service_name, version)
+            if doc is None:
+                raise Exception(f"No bundled discovery document for {service_name} {version}")
+            _discovery_docs[key] = json.loads(doc)
+        return _discovery_docs[key]
+
+
+# Errors worth retrying, everything else is our (or the user's) problem.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+# Rate limit reasons about the whole project rather than one user.
+PROJECT_LIMIT_REASONS = ("rateLimitExceeded", "quotaExceeded")
+
+
+def error_reasons(error):
+    """Get the reasons out of a googleapiclient HttpError."""
+    try:
+        content = json.loads(error.content)
+        return [e.get("reason") for e in content["error"].get("errors", [])]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def is_rate_limited(error):
+    status = error.resp.status
+    return status == 429 or (
+        status == 403 and any(r in RETRY_REASONS for r in error_reasons(error)))
+
+
+def rate_limit_scope(error):
+    """Which rate limit bucket a rate limit error is about, "project" or "account"."""
+    if any(r in PROJECT_LIMIT_REASONS for r in error_reasons(error)):
+        return "project"
+    return "account"
+
+
+def is_retryable(error):
+    return error.resp.status in RETRY_STATUSES or is_rate_limited(error)
+
+
+def backoff_delay(attempt, backoff=None):
+    """Jittered exponential backoff for the attempt'th retry (from 0)."""
+    if backoff is None:
+        backoff = getattr(settings, "GOOGLE_API_BACKOFF", 1.0)
+    return backoff * (2 ** attempt) * (0.5 + random.random())
+
+
+# What the API calls being made are for, see api_call_context.
+_api_call_labels: contextvars.ContextVar[dict[str, str]] = contextvars.ContextVar(
+    "api_call_labels", default={})
+
+
+@contextlib.contextmanager
+def api_call_context(**labels):
+    """Label the API calls made inside the block, e.g. with the calendar_id or
+    sync_config_id they're made for. Nested contexts add to the outer labels."""
+    token = _api_call_labels.set(dict(_api_call_labels.get(), **labels))
+    try:
+        yield
+    finally:
+        _api_call_labels.reset(token)
+
+
+class ApiCall(object):
+    """What an api_call_hooks hook is told about each API call."""
+
+    def __init__(self, method, account_id, latency, request_bytes=0, response_bytes=0,
+                 error=None, calls=1):
+        self.method = method
+        self.account_id = account_id
+        self.calendar_id = _api_call_labels.get().get("calendar_id")
+        self.sync_config_id = _api_call_labels.get().get("sync_config_id")
+        self.latency = latency
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+        # The error class, e.g. "HttpError 429" or "timeout", None on success.
+        self.error = error
+        # How many calls this counts as against the quota. A batch request counts
+        # as none, each request in it is reported (and counted) on its own.
+        self.calls = calls
+
+
+# Called with an ApiCall after every API call execute() makes (retries included).
+api_call_hooks: list[Callable[..., None]] = []
+
+
+def report_api_call(call):
+    for hook in api_call_hooks:
+        try:
+            hook(call)
+        except Exception as e:
+            # Never let bookkeeping break a sync.
+            print(f"API call hook {hook} failed: {e}")
+
+
+def error_class(error):
+    if isinstance(error, HttpError):
+        return f"HttpError {error.resp.status}"
+    return type(error).__name__
+
+
+class _MeasuredHttp(object):
+    """Wraps an HTTP client to count the bytes sent and received through it."""
+
+    def __init__(self, http):
+        self.http = http
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        resp, content = self.http.request(uri, method, body=body, headers=headers, **kwargs)
+        self.request_bytes += len(body or b"")
+        self.response_bytes += len(content or b"")
+        return resp, content
+
+    def __getattr__(self, name):
+        # Credentials and anything else googleapiclient looks for on the client.
+        return getattr(self.http, name)
+
+
+def _execute_once(request, account_id, http=None):
+    method = getattr(request, "methodId", None)
+    measured = _MeasuredHttp(http or request.http)
+    error = None
+    start = time.perf_counter()
+    try:
+        return request.execute(http=measured)
+    except Exception as e:
+        error = error_class(e)
+        raise
+    finally:
+        report_api_call(ApiCall(method or "batch", account_id, time.perf_counter() - start,
+                                measured.request_bytes, measured.response_bytes, error,
+                                calls=1 if method else 0))
+
+
+def execute(request, account_id=None, cost=1, retries=None, http=None):
+    """Execute a googleapiclient request for account_id, every API call should go
+    through here. Waits for the rate limiter (cost is how many calls the request
+    counts as, e.g. the size of a batch) and retries rate limit & server errors up
+    to retries (GOOGLE_API_MAX_RETRIES) times with jittered exponential backoff.
+    Rate limit errors also make every other process back off the account.
+    Each attempt is reported to api_call_hooks. Batch requests don't have an HTTP
+    client of their own, pass http (the one their requests were built with)."""
+    if retries is None:
+        retries = getattr(settings, "GOOGLE_API_MAX_RETRIES", 4)
+    attempt = 0
+    while True:
+        rate_limiter.acquire(account_id, cost)
+        try:
+            return _execute_once(request, account_id, http)
+        except HttpError as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            print(f"Retrying Google API call for account {account_id} in {delay:.1f}s: {e}")
+            if is_rate_limited(e):
+                # acquire() does the waiting, along with everyone else.
+                rate_limiter.back_off(account_id, delay, rate_limit_scope(e))
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+
+def field_mask(call_site):
+    """Get the partial response mask for a call site."""
+    masks = getattr(settings, "GOOGLE_API_FIELD_MASKS", {})
+    if call_site in masks:
+        return masks[call_site]
+    return DEFAULT_FIELD_MASKS[call_site]
+
+
+def default_http():
+    """An HTTP client with a socket timeout (GOOGLE_API_TIMEOUT seconds) so a hung
+    connection to Google can't tie up a worker forever."""
+    return httplib2.Http(timeout=getattr(settings, "GOOGLE_API_TIMEOUT", 60))
+
+
+class CalendarServicePool(object):
+    """Per account pool of calendar services.
+
+    httplib2 (and so the services built on top of it) is not thread safe, so each
+    thread gets its own service + keep-alive HTTP session per account. Invalidating
+    an account bumps a generation counter so every thread rebuilds on its next use."""
+
+    def __init__(self, http_factory=None):
+        self.http_factory = http_factory or default_http
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._generations = {}
+
+    def _services(self):
+        services = getattr(self._local, "services", None)
+        if services is None:
+            services = {}
+            self._local.services = services
+        return services
+
+    def _generation(self, account_id):
+        with self._lock:
+            return self._generations.get(account_id, 0)
+
+    def get(self, account_id, credentials):
+        """Get a calendar service for the account, authorized with credentials."""
+        services = self._services()
+        generation = self._generation(account_id)
+        entry = services.get(account_id)
+        if entry is None or entry[0] != generation:
+            authed_http = google_auth_httplib2.AuthorizedHttp(
+                credentials, http=self.http_factory())
+            service = build_from_document(get_discovery_doc(), http=authed_http)
+            entry = (generation, authed_http, service)
+            services[account_id] = entry
+        _, authed_http, service = entry
+        # Credentials may have been refreshed (and re-cached) since we built this.
+        authed_http.credentials = credentials
+        return service
+
+    def invalidate(self, account_id):
+        with self._lock:
+            self._generations[account_id] = self._generations.get(account_id, 0) + 1
+
+
+calendar_services = CalendarServicePool()
@@ -0,0 +1,48 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from cal_sync_magic.conflicts import conflict_index
+from cal_sync_magic.models import (
+    CalendarRules,
+    GoogleAccount,
+    SyncConfigs,
+    UserCalendar,
+)
+from cal_sync_magic.plans import rule_plans, sync_plans
+from cal_sync_magic.routing import routing_index
+
+
+@receiver(post_save, sender=SyncConfigs)
+@receiver(post_delete, sender=SyncConfigs)
+def drop_sync_plan(sender, instance, **kwargs):
+    sync_plans.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=CalendarRules)
+@receiver(post_delete, sender=CalendarRules)
+def drop_rule_plan(sender, instance, **kwargs):
+    rule_plans.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=SyncConfigs)
+@receiver(post_delete, sender=SyncConfigs)
+@receiver(post_save, sender=CalendarRules)
+@receiver(post_delete, sender=CalendarRules)
+@receiver(post_save, sender=UserCalendar)
+@receiver(post_delete, sender=UserCalendar)
+@receiver(post_save, sender=GoogleAccount)
+@receiver(post_delete, sender=GoogleAccount)
+@receiver(m2m_changed, sender=SyncConfigs.src_calendars.through)
+@receiver(m2m_changed, sender=SyncConfigs.sink_calendars.through)
+@receiver(m2m_changed, sender=CalendarRules.calendars.through)
+def drop_routes(sender, instance, **kwargs):
+    # Either side of an m2m change, all of them belong to a user.
+    routing_index.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=CalendarRules)
+@receiver(post_delete, sender=UserCalendar)
+@receiver(m2m_changed, sender=CalendarRules.calendars.through)
+def drop_conflicts(sender, instance, **kwargs):
+    # Which calendars are rule calendars changed.
+    conflict_index.invalidate(instance.user_id)
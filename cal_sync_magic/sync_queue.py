@@ -0,0 +1,196 @@
+import os
+import random
+import socket
+import traceback
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Mod
+
+from cal_sync_magic.coalesce import WriteGroup
+from cal_sync_magic.models import SyncJob, UserCalendar
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def enqueue_sync(calendar, channel_id, resource_state=None, debounce=None):
+    """Queue a sync of calendar for a push notification on channel_id.
+
+    Notifications within debounce seconds (SYNC_NOTIFICATION_DEBOUNCE) of the first
+    one are merged into its still pending job, since a single incremental sync picks
+    up all their changes. Jobs backing off after a failure don't take merges, the
+    change shouldn't wait out their backoff. Returns the job and whether it was
+    merged into."""
+    if debounce is None:
+        debounce = getattr(settings, "SYNC_NOTIFICATION_DEBOUNCE", 5)
+    now = datetime.utcnow()
+    with transaction.atomic():
+        # Lock the calendar so concurrent notifications don't both queue a job.
+        UserCalendar.objects.select_for_update().filter(pk=calendar.pk).first()
+        pending = SyncJob.objects.filter(
+            calendar=calendar, status=SyncJob.PENDING,
+            available_at__lte=now + timedelta(seconds=debounce))
+        if pending.update(notifications=F("notifications") + 1):
+            return pending.order_by("id").first(), True
+        job = SyncJob.objects.create(
+            calendar=calendar,
+            channel_id=channel_id,
+            resource_state=resource_state,
+            available_at=now + timedelta(seconds=debounce))
+    return job, False
+
+
+def handle_notification(calendar, channel_id, resource_state=None, message_number=None):
+    """Queue a sync for a push notification unless we don't need one.
+
+    Google sends a "sync" message when a channel is created (nothing changed) and may
+    deliver the same message number more than once, those are dropped. Returns
+    "dropped", "merged" or "queued"."""
+    counters = {"notifications": F("notifications") + 1}
+    outcome = None
+    if resource_state == "sync":
+        outcome = "dropped"
+    elif message_number is not None:
+        # Compare-and-set so concurrent deliveries of the same message only win once.
+        newer = UserCalendar.objects.filter(pk=calendar.pk).filter(
+            Q(last_message_number__isnull=True) | Q(last_message_number__lt=message_number))
+        if newer.update(last_message_number=message_number):
+            calendar.last_message_number = message_number
+        else:
+            outcome = "dropped"
+    if outcome is None:
+        _, merged = enqueue_sync(calendar, channel_id, resource_state)
+        outcome = "merged" if merged else "queued"
+    if outcome == "dropped":
+        counters["notifications_dropped"] = F("notifications_dropped") + 1
+    elif outcome == "merged":
+        counters["notifications_merged"] = F("notifications_merged") + 1
+    UserCalendar.objects.filter(pk=calendar.pk).update(**counters)
+    return outcome
+
+
+def partition_jobs(jobs, partition):
+    """Limit jobs to partition, an (index, count) pair, by google account.
+    An account's jobs all land in the same partition."""
+    index, count = partition
+    return jobs.annotate(
+        partition=Mod("calendar__google_account_id", count)).filter(partition=index)
+
+
+def claim_jobs(worker, limit=10, partition=None):
+    """Claim up to limit ready jobs for worker, only from partition if provided.
+
+    Claiming is a compare-and-set UPDATE on the job's status (rather than a row lock)
+    so it works the same on every database and two workers never run the same job.
+    Running jobs whose worker went quiet for SYNC_JOB_LOCK_TIMEOUT seconds are up for
+    grabs again."""
+    now = datetime.utcnow()
+    lock_timeout = timedelta(seconds=getattr(settings, "SYNC_JOB_LOCK_TIMEOUT", 600))
+    SyncJob.objects.filter(
+        status=SyncJob.RUNNING, locked_at__lt=now - lock_timeout,
+    ).update(status=SyncJob.PENDING, locked_by=None, locked_at=None)
+    candidates = SyncJob.objects.filter(status=SyncJob.PENDING, available_at__lte=now)
+    if partition is not None:
+        candidates = partition_jobs(candidates, partition)
+    candidates = candidates.order_by("available_at", "id").values_list("id", flat=True)[:limit]
+    claimed = []
+    for job_id in candidates:
+        if SyncJob.objects.filter(pk=job_id, status=SyncJob.PENDING).update(
+                status=SyncJob.RUNNING, locked_by=worker, locked_at=now):
+            claimed.append(job_id)
+    return list(SyncJob.objects.filter(pk__in=claimed).select_related(
+        "calendar", "calendar__google_account", "calendar__user").order_by("available_at", "id"))
+
+
+def retry_delay(attempts, backoff=None):
+    """Jittered exponential backoff before a failed job is tried again."""
+    if backoff is None:
+        backoff = getattr(settings, "SYNC_JOB_BACKOFF", 30)
+    return backoff * (2 ** (attempts - 1)) * (0.5 + random.random())
+
+
+class ClaimLost(Exception):
+    """Another worker took over a job we were running."""
+
+
+def _claimed(job):
+    return SyncJob.objects.filter(
+        pk=job.pk, status=SyncJob.RUNNING, locked_by=job.locked_by, locked_at=job.locked_at)
+
+
+def extend_claim(job):
+    """Renew our claim on a running job so it isn't taken over as stale while a
+    long sync is still going. Raises ClaimLost if it already was."""
+    now = datetime.utcnow()
+    if not _claimed(job).update(locked_at=now):
+        raise ClaimLost(f"Sync job {job.id} was claimed by another worker")
+    job.locked_at = now
+
+
+def run_job(job):
+    """Run a claimed job. Done jobs are deleted, failed ones go back on the queue
+    with a backoff until SYNC_JOB_MAX_ATTEMPTS and are then left as failed.
+    The claim is renewed after each page, if another worker took the job over
+    anyway we leave it to them. A job whose sink writes are held by the coalescer
+    stays claimed until they've gone out (with whatever later jobs coalesced into
+    them) and is deleted then. Returns True if the sync went through."""
+    max_attempts = getattr(settings, "SYNC_JOB_MAX_ATTEMPTS", 5)
+    group = WriteGroup(done=lambda: _claimed(job).delete())
+    try:
+        job.calendar.handle_sync_event(heartbeat=lambda: extend_claim(job), group=group)
+    except ClaimLost as e:
+        print(e)
+        return False
+    except Exception as e:
+        print(f"Sync job {job.id} for calendar {job.calendar_id} failed: {e}")
+        attempts = job.attempts + 1
+        if attempts >= max_attempts:
+            status = SyncJob.FAILED
+        else:
+            status = SyncJob.PENDING
+        _claimed(job).update(
+            status=status,
+            attempts=attempts,
+            available_at=datetime.utcnow() + timedelta(seconds=retry_delay(attempts)),
+            locked_by=None,
+            locked_at=None,
+            last_error=traceback.format_exc())
+        return False
+    group.close()
+    return True
+
+
+def release_jobs(jobs):
+    """Hand claimed jobs we won't get to back to the queue."""
+    SyncJob.objects.filter(pk__in=[j.pk for j in jobs], status=SyncJob.RUNNING).update(
+        status=SyncJob.PENDING, locked_by=None, locked_at=None)
+
+
+def drain_queue(worker=None, batch_size=10, partition=None, should_stop=None):
+    """Run ready jobs until there are none left, or should_stop() says to stop
+    (checked between jobs). Returns (succeeded, failed)."""
+    worker = worker or worker_name()
+    succeeded = failed = 0
+    while True:
+        claimed = claim_jobs(worker, limit=batch_size, partition=partition)
+        if not claimed:
+            return succeeded, failed
+        for i, job in enumerate(claimed):
+            if should_stop is not None and should_stop():
+                release_jobs(claimed[i:])
+                return succeeded, failed
+            if run_job(job):
+                succeeded += 1
+            else:
+                failed += 1
+
+
+def queue_depth(partition=None):
+    jobs = SyncJob.objects.filter(status=SyncJob.PENDING)
+    if partition is not None:
+        jobs = partition_jobs(jobs, partition)
+    return jobs.count()
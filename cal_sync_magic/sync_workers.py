@@ -0,0 +1,110 @@
+"""A pool of sync worker processes.
+
+Jobs are partitioned by google account (account id % processes) so each account's
+jobs run one at a time, in order, in the same process (which also keeps its cached
+credentials and HTTP sessions warm) while different accounts sync in parallel."""
+import multiprocessing
+import queue
+import signal
+import time
+
+
+def worker_main(index, count, batch_size, poll_interval, stop, stats):
+    """Entry point of a worker process. Drains partition index of count until stop
+    is set, putting (index, succeeded, failed, queue depth) on stats after each pass."""
+    import django
+    django.setup()
+    from django.db import connection
+
+    from cal_sync_magic.api_usage import api_usage_recorder
+    from cal_sync_magic.sync_queue import drain_queue, queue_depth, worker_name
+
+    # SIGTERM finishes the job in hand and exits, Ctrl-C is the parent's problem.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    partition = (index, count)
+    worker = f"{worker_name()}-{index}"
+    try:
+        while not stop.is_set():
+            succeeded, failed = drain_queue(
+                worker, batch_size=batch_size, partition=partition,
+                should_stop=stop.is_set)
+            stats.put((index, succeeded, failed, queue_depth(partition)))
+            stop.wait(poll_interval)
+    finally:
+        api_usage_recorder.flush()
+        connection.close()
+
+
+class WorkerStats(object):
+    """Per worker totals, for reporting throughput and queue depth."""
+
+    def __init__(self, count):
+        self.started = time.monotonic()
+        self.succeeded = [0] * count
+        self.failed = [0] * count
+        self.depth = [0] * count
+
+    def record(self, index, succeeded, failed, depth):
+        self.succeeded[index] += succeeded
+        self.failed[index] += failed
+        self.depth[index] = depth
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        lines = []
+        for i in range(len(self.succeeded)):
+            lines.append(
+                f"worker {i}: {self.succeeded[i]} synced ({self.succeeded[i] / elapsed:.2f}/s) "
+                f"{self.failed[i]} failed, {self.depth[i]} queued")
+        lines.append(f"total queued: {sum(self.depth)}")
+        return "\n".join(lines)
+
+
+def run_pool(processes, batch_size=10, poll_interval=1.0, report_interval=60,
+             report=print):
+    """Run processes workers until SIGTERM (or Ctrl-C), then let them finish the
+    jobs they're on and exit. Returns the final WorkerStats."""
+    # Fork and Django's DB connections don't mix, start workers fresh.
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    stats_queue = context.Queue()
+    stats = WorkerStats(processes)
+    workers = [
+        context.Process(
+            target=worker_main,
+            args=(i, processes, batch_size, poll_interval, stop, stats_queue),
+            name=f"sync-worker-{i}")
+        for i in range(processes)]
+    for w in workers:
+        w.start()
+
+    def request_stop(signum, frame):
+        report("Stopping, waiting for workers to finish their current jobs.")
+        stop.set()
+
+    previous = {s: signal.signal(s, request_stop) for s in (signal.SIGTERM, signal.SIGINT)}
+    last_report = time.monotonic()
+    try:
+        while any(w.is_alive() for w in workers):
+            try:
+                stats.record(*stats_queue.get(timeout=0.5))
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_report >= report_interval:
+                report(stats.summary())
+                last_report = time.monotonic()
+        # Pick up what the workers reported on their way out.
+        while True:
+            try:
+                stats.record(*stats_queue.get_nowait())
+            except queue.Empty:
+                break
+    finally:
+        stop.set()
+        for w in workers:
+            w.join()
+        for s, handler in previous.items():
+            signal.signal(s, handler)
+    report(stats.summary())
+    return stats
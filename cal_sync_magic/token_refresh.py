@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+from cal_sync_magic.expiring import RunStats, process_expiring
+from cal_sync_magic.models import GoogleAccount
+
+
+class RefreshStats(RunStats):
+    """Latency and failure stats for a token refresh run."""
+    counted = ("refreshed", "revoked")
+    succeeded = ("refreshed",)
+
+
+def expiring_account_ids(lead_time):
+    """Accounts whose tokens expire within lead_time, soonest first.
+    Uses the credential_expiry index."""
+    cutoff = datetime.utcnow() + lead_time
+    # Revoked accounts have their credentials emptied until they're re-added.
+    return list(GoogleAccount.objects.filter(
+        credential_expiry__lte=cutoff,
+    ).exclude(
+        credentials="",
+    ).order_by("credential_expiry").values_list("account_id", flat=True))
+
+
+def refresh_account(account_id, lead_time):
+    account = GoogleAccount.objects.get(account_id=account_id)
+    if account.get_credentials(min_validity=lead_time) is None:
+        return "revoked"
+    return "refreshed"
+
+
+def refresh_expiring_credentials(lead_time=timedelta(minutes=10), batch_size=100,
+                                 concurrency=4, stats=None):
+    """Refresh every token expiring within lead_time, batch_size accounts at a time
+    with at most concurrency refreshes in flight."""
+    if stats is None:
+        stats = RefreshStats()
+    return process_expiring(
+        expiring_account_ids(lead_time), lambda a: refresh_account(a, lead_time), stats,
+        batch_size=batch_size, concurrency=concurrency)
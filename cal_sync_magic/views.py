@@ -1,17 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponse
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    HttpResponseNotFound,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect, render
+from django.template import loader
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
 import google_auth_oauthlib
 from googleapiclient.discovery import build
 
+from cal_sync_magic.api_usage import render_metrics
+from cal_sync_magic.credential_cache import credential_cache
+from cal_sync_magic.expiring import pool_task
 from cal_sync_magic.forms import *
 from cal_sync_magic.models import *
+from cal_sync_magic.services import calendar_services
+from cal_sync_magic.sync_queue import handle_notification
 
 User=get_user_model()
 
@@ -60,7 +76,7 @@ class GoogleCallBackView(LoginRequiredMixin, View):
         user_info_service = build('oauth2', 'v2', credentials=credentials)
         user_info = user_info_service.userinfo().get().execute()
         google_user_email = user_info['email']
-        account = GoogleAccount.objects.update_or_create(
+        account, _ = GoogleAccount.objects.update_or_create(
             user = request.user,
             google_user_email=google_user_email,
             defaults={
@@ -68,13 +84,50 @@ class GoogleCallBackView(LoginRequiredMixin, View):
                 "credentials": credentials.to_json(),
                 "last_refreshed": datetime.now(),
             })
+        # Drop any credentials we were holding on to for the old grant.
+        credential_cache.invalidate(account.account_id)
+        calendar_services.invalidate(account.account_id)
         return redirect(reverse("update-user-calendars"))
 
+@pool_task
+def refresh_account_calendars(account):
+    account.refresh_calendars()
+
+
+def refresh_accounts_calendars(accounts, concurrency=4, timeout=30):
+    """Refresh the calendars of accounts with at most concurrency refreshes in flight.
+    Returns a list of (account, error) for the refreshes which failed or which had
+    not finished timeout seconds after we started. Refreshes still running then are
+    left to finish in the background, ones which hadn't started are cancelled."""
+    failures = []
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = {
+        executor.submit(refresh_account_calendars, account): account
+        for account in accounts}
+    done, not_done = wait(futures, timeout=timeout)
+    for f in futures:
+        if f in not_done:
+            if f.cancel():
+                failures.append((futures[f], f"timed out after {timeout}s before starting"))
+            else:
+                failures.append((futures[f], f"timed out after {timeout}s"))
+        elif f.exception() is not None:
+            failures.append((futures[f], f.exception()))
+    executor.shutdown(wait=False)
+    return failures
+
+
 class UpdateUserCalendars(LoginRequiredMixin, View):
     def get(self, request):
-        user = request.user
-        for account in GoogleAccount.objects.filter(user = request.user):
-            account.refresh_calendars()
+        accounts = GoogleAccount.objects.filter(user = request.user).select_related("user")
+        failures = refresh_accounts_calendars(
+            list(accounts),
+            concurrency=getattr(settings, "CALENDAR_REFRESH_CONCURRENCY", 4),
+            timeout=getattr(settings, "CALENDAR_REFRESH_TIMEOUT", 30))
+        for account, error in failures:
+            messages.warning(
+                request,
+                f"Could not refresh calendars for {account.google_user_email}: {error}")
         return redirect(reverse("sync-config"))
 
 
@@ -172,17 +225,55 @@ class ShowRawEvents(LoginRequiredMixin, View):
         calendar = UserCalendar.objects.filter(
             user = request.user,
             internal_calendar_id = internal_id).get()
-        events = map(lambda x: json.dumps(x), calendar.get_changes())
-        return render(request, 'debug_raw.html', context={
-            "events": events})
+        # Render and stream the events a page at a time so a huge calendar doesn't
+        # all end up in memory at once.
+        template = loader.get_template('debug_raw.html')
+        def render_events():
+            for page in calendar.iter_change_pages(
+                    commit_sync_token=False, fields="debug.events.list"):
+                yield template.render({"events": map(json.dumps, page)}, request)
+        return StreamingHttpResponse(render_events(), content_type="text/html")
 
+@method_decorator(csrf_exempt, name="dispatch")
 class GoogleCallBack(View):
-    def get(self, request):
+    """Push notification endpoint. Google only waits a few seconds for us, so all we
+    do here is check the notification is for a channel we made and queue a sync job
+    (unless it's a duplicate, see handle_notification) for run_sync_worker to pick up."""
+    def post(self, request):
         channel_id = request.headers.get(
             'X-Goog-Channel-ID',
             request.GET.get("channel_id")
         )
+        if not channel_id:
+            return HttpResponseBadRequest("Missing channel id")
         internal_calendar_id = channel_id.split("-")[0]
-        c = UserCalendar.objects.get(internal_calendar_id=channel_id)
-        c.handle_sync_event()
+        if not internal_calendar_id.isdigit():
+            return HttpResponseBadRequest("Bad channel id")
+        c = UserCalendar.objects.filter(internal_calendar_id=internal_calendar_id).first()
+        if c is None or c.make_channel_id() != channel_id:
+            return HttpResponseNotFound("Unknown channel")
+        message_number = request.headers.get('X-Goog-Message-Number')
+        if message_number is not None:
+            if not message_number.isdigit():
+                return HttpResponseBadRequest("Bad message number")
+            message_number = int(message_number)
+        handle_notification(
+            c, channel_id, request.headers.get('X-Goog-Resource-State'), message_number)
         return HttpResponse("Ok!")
+
+    def get(self, request):
+        return self.post(request)
+
+
+class Metrics(View):
+    """Google API usage in the Prometheus text format. Scrapers authenticate with
+    the METRICS_TOKEN setting as a bearer token, otherwise it's staff only."""
+    def get(self, request):
+        token = getattr(settings, "METRICS_TOKEN", None)
+        if token:
+            allowed = request.headers.get("Authorization") == f"Bearer {token}"
+        else:
+            allowed = request.user.is_authenticated and request.user.is_staff
+        if not allowed:
+            return HttpResponseForbidden("Forbidden")
+        return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,425 @@
+"""A tiny in memory stand-in for the parts of the Google Calendar API we use.
+
+FakeCalendarApi.http() hands back an httplib2.Http look-alike which can be plugged
+into the calendar service pool so tests (and benchmarks) never touch the network."""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import httplib2
+
+API_PREFIX = "/calendar/v3/"
+BATCH_PATH = "/batch/calendar/v3"
+
+
+def parse_fields(mask):
+    """Parse a partial response mask, e.g. "items(id,start/dateTime)", into a tree of
+    dicts where None means the whole value."""
+    tree = {}
+    stack = [tree]
+    name = ""
+
+    def add(name):
+        node = stack[-1]
+        for part in name.split("/")[:-1]:
+            node = node.setdefault(part, {})
+        node[name.split("/")[-1]] = None
+        return node, name.split("/")[-1]
+
+    i = 0
+    while i < len(mask):
+        c = mask[i]
+        if c == "(":
+            node, key = add(name)
+            node[key] = {}
+            stack.append(node[key])
+            name = ""
+        elif c == ")":
+            if name:
+                add(name)
+            name = ""
+            stack.pop()
+        elif c == ",":
+            if name:
+                add(name)
+            name = ""
+        else:
+            name += c.strip()
+        i += 1
+    if name:
+        add(name)
+    return tree
+
+
+def project(value, tree):
+    """Apply a parsed mask to a response like Google's partial responses do."""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(v, tree) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {k: project(v, tree[k]) for k, v in value.items() if k in tree}
+
+
+class FakeHttp(object):
+    def __init__(self, api):
+        self.api = api
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=1,
+                connection_type=None, **kwargs):
+        return self.api.handle(uri, method, body, headers or {})
+
+    def close(self):
+        return None
+
+
+class FakeCollection(object):
+    """A listable collection with page and sync tokens.
+
+    Every change bumps a global sequence number, a sync token is just the sequence
+    number at the time of the listing so a delta is everything changed after it."""
+
+    def __init__(self, api, removed):
+        self.api = api
+        # What a removed item looks like, e.g. {"status": "cancelled"}
+        self.removed = removed
+        self.items = {}
+
+    def put(self, item):
+        self.items[item["id"]] = (self.api.next_seq(), item)
+        return item
+
+    def remove(self, item_id):
+        item = dict(self.removed, id=item_id)
+        self.items[item_id] = (self.api.next_seq(), item)
+
+    def get(self, item_id):
+        if item_id not in self.items:
+            return None
+        item = self.items[item_id][1]
+        if self.is_removed(item):
+            return None
+        return item
+
+    def is_removed(self, item):
+        return all(item.get(k) == v for k, v in self.removed.items())
+
+    def list(self, query):
+        sync_token = query.get("syncToken")
+        if sync_token is not None:
+            if sync_token in self.api.expired_sync_tokens or not sync_token.startswith("sync-"):
+                return None
+            since = int(sync_token[len("sync-"):])
+            items = [item for seq, item in sorted(self.items.values(), key=lambda x: x[0])
+                     if seq > since]
+        else:
+            items = [item for seq, item in sorted(self.items.values(), key=lambda x: x[0])
+                     if query.get("showDeleted") == "true" or not self.is_removed(item)]
+        offset = int(query.get("pageToken", 0))
+        page_size = int(query.get("maxResults", 250))
+        page = items[offset:offset + page_size]
+        result = {"items": page}
+        if offset + page_size < len(items):
+            result["nextPageToken"] = str(offset + page_size)
+        else:
+            result["nextSyncToken"] = f"sync-{self.api.seq}"
+        return result
+
+
+class FakeCalendarApi(object):
+    """In memory calendar list and calendars (calendar id -> events)."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.seq = 0
+        self.calendar_list = FakeCollection(self, {"deleted": True})
+        self.calendars = {}
+        self.expired_sync_tokens = set()
+        # Requests (method, path, query), batch sub-requests included.
+        self.requests = []
+        # The JSON bodies sent with those requests.
+        self.bodies = []
+        self.batches = []
+        # Live push notification channels, id -> (calendar id, resource id, address).
+        self.channels = {}
+        # (status, reason) errors to hand back to the next requests.
+        self.fail_next = []
+        self._lock = threading.Lock()
+
+    def http(self):
+        return FakeHttp(self)
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def events(self, calendar_id):
+        if calendar_id not in self.calendars:
+            self.calendars[calendar_id] = FakeCollection(self, {"status": "cancelled"})
+        return self.calendars[calendar_id]
+
+    def add_calendar(self, calendar_id, summary):
+        return self.calendar_list.put({"id": calendar_id, "summary": summary})
+
+    def add_event(self, calendar_id, event):
+        event = dict(event)
+        event.setdefault("id", uuid.uuid4().hex)
+        event.setdefault("status", "confirmed")
+        return self.events(calendar_id).put(event)
+
+    def expire_sync_tokens(self):
+        """Make every sync token handed out so far return 410 Gone."""
+        self.expired_sync_tokens.update(f"sync-{i}" for i in range(self.seq + 1))
+
+    def _response(self, status, content=None):
+        if content is None:
+            data = b""
+        else:
+            data = json.dumps(content).encode("utf-8")
+        response = httplib2.Response({
+            "status": str(status),
+            "content-type": "application/json; charset=UTF-8"})
+        return response, data
+
+    def _error(self, status, reason):
+        return self._response(status, {
+            "error": {"code": status, "message": reason,
+                      "errors": [{"reason": reason, "message": reason}]}})
+
+    def handle(self, uri, method, body, headers):
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urlparse(uri)
+        if body is not None and not isinstance(body, (str, bytes)):
+            body = body.read()
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        if parsed.path == BATCH_PATH:
+            with self._lock:
+                self.batches.append(uri)
+            return self.batch(body, headers)
+        return self.dispatch(method, parsed.path, parsed.query, body)
+
+    def dispatch(self, method, path, query_string, body):
+        query = {k: v[-1] for k, v in parse_qs(query_string).items()}
+        with self._lock:
+            self.requests.append((method, path, query))
+            if self.fail_next:
+                return self._error(*self.fail_next.pop(0))
+        if not path.startswith(API_PREFIX):
+            return self._error(404, "notFound")
+        parts = [unquote(p) for p in path[len(API_PREFIX):].split("/")]
+        payload = json.loads(body) if body else None
+        with self._lock:
+            self.bodies.append(payload)
+            response, data = self.route(method, parts, query, payload)
+        if "fields" in query and data and response.status < 300:
+            data = json.dumps(project(json.loads(data), parse_fields(query["fields"])))
+            data = data.encode("utf-8")
+        return response, data
+
+    def batch(self, body, headers):
+        """Run each part of a multipart/mixed batch request through dispatch."""
+        message = Parser().parsestr(
+            f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            status_line, rest = request.split("\n", 1)
+            method, target, _ = status_line.split(" ", 2)
+            rest = rest.replace("\r\n", "\n")
+            sub_body = rest.split("\n\n", 1)[1] if "\n\n" in rest else None
+            parsed = urlparse(target)
+            response, data = self.dispatch(method, parsed.path, parsed.query, sub_body or None)
+            content_id = part["Content-ID"][1:-1]
+            out.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {response.status} OK\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{data.decode('utf-8')}\r\n")
+        out.append(f"--{boundary}--")
+        response = httplib2.Response({
+            "status": "200",
+            "content-type": f"multipart/mixed; boundary={boundary}"})
+        return response, "".join(out).encode("utf-8")
+
+    def route(self, method, parts, query, payload):
+        if parts == ["users", "me", "calendarList"] and method == "GET":
+            return self.list(self.calendar_list, query)
+        if parts == ["channels", "stop"] and method == "POST":
+            return self.stop(payload)
+        if len(parts) >= 3 and parts[0] == "calendars" and parts[2] == "events":
+            events = self.events(parts[1])
+            if parts[3:] == ["watch"] and method == "POST":
+                return self.watch(parts[1], payload)
+            if len(parts) == 3 and method == "GET":
+                return self.list(events, query)
+            if len(parts) == 3 and method == "POST":
+                return self.insert(events, payload)
+            if len(parts) == 4:
+                return self.event(events, parts[3], method, payload)
+        return self._error(404, "notFound")
+
+    def list(self, collection, query):
+        result = collection.list(query)
+        if result is None:
+            return self._error(410, "fullSyncRequired")
+        return self._response(200, result)
+
+    def insert(self, events, payload):
+        payload = dict(payload)
+        payload.setdefault("id", uuid.uuid4().hex)
+        # Like Google, ids of deleted events stay taken.
+        if payload["id"] in events.items:
+            return self._error(409, "duplicate")
+        payload.setdefault("status", "confirmed")
+        return self._response(200, events.put(payload))
+
+    def watch(self, calendar_id, payload):
+        if payload["id"] in self.channels:
+            return self._error(400, "channelIdNotUnique")
+        resource_id = f"resource-{calendar_id}"
+        self.channels[payload["id"]] = (calendar_id, resource_id, payload["address"])
+        ttl = int(payload.get("params", {}).get("ttl", 604800))
+        return self._response(200, {
+            "kind": "api#channel",
+            "id": payload["id"],
+            "resourceId": resource_id,
+            "expiration": str(int((time.time() + ttl) * 1000)),
+        })
+
+    def stop(self, payload):
+        channel = self.channels.get(payload["id"])
+        if channel is None or channel[1] != payload["resourceId"]:
+            return self._error(404, "notFound")
+        del self.channels[payload["id"]]
+        return self._response(204)
+
+    def event(self, events, event_id, method, payload):
+        if method == "PATCH" and event_id in events.items:
+            # Deleted events can still be patched (e.g. back to confirmed).
+            event = dict(events.items[event_id][1])
+            event.update(payload)
+            return self._response(200, events.put(event))
+        event = events.get(event_id)
+        if event is None:
+            return self._error(404, "notFound")
+        if method == "GET":
+            return self._response(200, event)
+        if method == "PATCH":
+            event = dict(event)
+            event.update(payload)
+            return self._response(200, events.put(event))
+        if method == "DELETE":
+            events.remove(event_id)
+            return self._response(204)
+        return self._error(405, "methodNotAllowed")
+
+
+class FakeTokenServer(object):
+    """A local OAuth token endpoint, counts refreshes and hands out new tokens
+    (or refuses to, if revoked). Use as a context manager, token_uri is where to
+    point the credentials."""
+
+    def __init__(self, delay=0.0, revoked=False):
+        self.delay = delay
+        self.revoked = revoked
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server._lock:
+                    server.refreshes += 1
+                    token = f"token-{server.refreshes}"
+                time.sleep(server.delay)
+                if server.revoked:
+                    status, data = 400, json.dumps({
+                        "error": "invalid_grant",
+                        "error_description": "Token has been expired or revoked."})
+                else:
+                    status, data = 200, json.dumps({
+                        "access_token": token,
+                        "expires_in": 3600,
+                        "token_type": "Bearer"})
+                data = data.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.token_uri = f"http://127.0.0.1:{self.httpd.server_address[1]}/token"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeGoogleMixin(object):
+    """TestCase mixin: a user with a google account whose API calls go to self.api."""
+
+    def setUp(self):
+        super().setUp()
+        # Imported here so the fake itself doesn't need Django set up.
+        from datetime import datetime, timedelta
+        from unittest import mock
+
+        from django.contrib.auth import get_user_model
+        from django.test import override_settings
+
+        from cal_sync_magic.conflicts import conflict_index
+        from cal_sync_magic.credential_cache import credential_cache
+        from cal_sync_magic.models import GoogleAccount
+        from cal_sync_magic.routing import routing_index
+        from cal_sync_magic.services import CalendarServicePool
+        from tests.test_credentials import make_credentials_json
+
+        self.api = FakeCalendarApi()
+        # Rate limit buckets of our own.
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings_override = override_settings(
+            GOOGLE_API_RATE_LIMIT_DB=os.path.join(tmp.name, "rate_limits.sqlite3"))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch(
+            "cal_sync_magic.models.calendar_services",
+            CalendarServicePool(http_factory=self.api.http))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        credential_cache.clear()
+        self.addCleanup(credential_cache.clear)
+        # Ids get reused once a test's transaction is rolled back.
+        routing_index.clear()
+        self.addCleanup(routing_index.clear)
+        conflict_index.clear()
+        self.addCleanup(conflict_index.clear)
+        self.user = get_user_model().objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.account = GoogleAccount.objects.create(
+            user=self.user,
+            google_user_email="lennon@thebeatles.com",
+            credentials=make_credentials_json(),
+            credential_expiry=datetime.utcnow() + timedelta(hours=1))
@@ -0,0 +1,103 @@
+from django.contrib.auth import get_user_model
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from cal_sync_magic.api_usage import api_usage_recorder, render_metrics, usage_summary
+from cal_sync_magic.models import ApiUsage, SyncConfigs, UserCalendar
+from tests.fake_google import FakeGoogleMixin
+
+
+class TestApiUsage(FakeGoogleMixin, TestCase):
+    """ Test API calls are counted per account, calendar and sync config. """
+    def setUp(self):
+        super().setUp()
+        # Start from a clean slate, other tests' calls may still be pending.
+        api_usage_recorder.flush()
+        ApiUsage.objects.all().delete()
+        self.src = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="src")
+        self.sink = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="sink")
+        self.sync = SyncConfigs.objects.create(user=self.user)
+        self.sync.src_calendars.add(self.src)
+        self.sync.sink_calendars.add(self.sink)
+
+    def usage(self, **filters):
+        api_usage_recorder.flush()
+        return ApiUsage.objects.filter(**filters)
+
+    def test_direct_calls(self):
+        self.src.add_event({"id": "abc", "summary": "Lunch"})
+        with self.assertRaises(Exception):
+            self.src.add_event({"id": "abc", "summary": "Lunch"})
+        self.src.get_event("abc")
+        insert_ok = self.usage(method="calendar.events.insert", error="").get()
+        self.assertEqual((insert_ok.google_account, insert_ok.calendar, insert_ok.calls),
+                         (self.account, self.src, 1))
+        self.assertGreater(insert_ok.request_bytes, 0)
+        self.assertGreater(insert_ok.response_bytes, 0)
+        self.assertGreater(insert_ok.latency, 0)
+        # The second insert was a duplicate.
+        self.assertEqual(self.usage(method="calendar.events.insert", error="HttpError 409")
+                         .get().calls, 1)
+        self.assertEqual(self.usage(method="calendar.events.get").get().calls, 1)
+
+    def test_sync_calls(self):
+        for i in range(3):
+            self.api.add_event("src", {"id": f"event{i}", "summary": f"Event {i}"})
+        self.src.handle_sync_event()
+        self.assertEqual(self.usage(method="calendar.events.list", calendar=self.src)
+                         .get().calls, 1)
+        # The batch carries the round trip, the writes in it are the calls.
+        batch = self.usage(method="batch").get()
+        self.assertEqual(batch.calls, 0)
+        self.assertGreater(batch.request_bytes, 0)
+        self.assertGreater(batch.response_bytes, 0)
+        writes = self.usage(method="calendar.events.insert").get()
+        self.assertEqual((writes.calendar, writes.sync_config, writes.calls),
+                         (self.sink, self.sync, 3))
+
+    def test_summary_and_metrics(self):
+        self.src.add_event({"summary": "Lunch"})
+        self.api.fail_next = [(400, "badRequest")]
+        with self.assertRaises(Exception):
+            self.src.add_event({"summary": "Lunch"})
+        summary = usage_summary(self.usage(), ["google_account_id"])
+        self.assertEqual(len(summary), 1)
+        self.assertEqual((summary[0]["total_calls"], summary[0]["errors"]), (2, 1))
+
+        metrics = render_metrics()
+        self.assertIn("# TYPE google_api_calls_total counter", metrics)
+        self.assertIn(
+            f'google_api_calls_total{{account="{self.account.pk}",'
+            'method="calendar.events.insert",error="HttpError 400"} 1', metrics)
+        self.assertIn("# TYPE sink_writes_pending gauge\nsink_writes_pending 0", metrics)
+
+    def test_metrics_view(self):
+        self.src.add_event({"summary": "Lunch"})
+        client = Client()
+        self.assertEqual(client.get(reverse("metrics")).status_code, 403)
+        client.force_login(self.user)
+        self.assertEqual(client.get(reverse("metrics")).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"google_api_calls_total", response.content)
+        with self.settings(METRICS_TOKEN="secret"):
+            response = Client().get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(ROOT_URLCONF="tests.urls")
+    def test_admin_summary(self):
+        self.src.add_event({"summary": "Lunch"})
+        client = Client()
+        client.force_login(get_user_model().objects.create_superuser(
+            "admin", "admin@example.com", "password"))
+        response = client.get(reverse("admin:cal_sync_magic_apiusage_changelist"))
+        self.assertEqual(response.status_code, 200)
+        summary = response.context["account_summary"]
+        self.assertEqual(summary[0]["google_account__google_user_email"],
+                         self.account.google_user_email)
+        self.assertEqual(summary[0]["total_calls"], 1)
+        self.assertIn(b"Per account", response.content)
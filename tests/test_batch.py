@@ -0,0 +1,90 @@
+from django.test import TestCase
+
+from cal_sync_magic.batch import SinkWrite, SinkWriteBatcher
+from cal_sync_magic.coalesce import WriteCoalescer, WriteGroup
+from cal_sync_magic.models import CalendarEvent, UserCalendar
+from tests.fake_google import FakeGoogleMixin
+
+
+class TestSinkWriteBatcher(FakeGoogleMixin, TestCase):
+    """ Test batching sink writes. """
+    def setUp(self):
+        super().setUp()
+        self.sinks = [
+            UserCalendar.objects.create(
+                user=self.user, google_account=self.account, google_calendar_id=f"sink-{i}")
+            for i in range(3)]
+        self.batcher = SinkWriteBatcher(max_batch_size=50, backoff=0)
+
+    def test_batches(self):
+        for i in range(40):
+            for sink in self.sinks:
+                self.batcher.add(SinkWrite(sink, "insert", {"id": f"event{i}", "summary": "E"}))
+        with self.settings(GOOGLE_API_RATE_LIMITS=None):
+            writes = self.batcher.flush()
+        self.assertEqual(len(self.api.batches), 3)
+        self.assertTrue(all(w.error is None for w in writes))
+        self.assertEqual(len(self.api.events("sink-0").items), 40)
+        self.assertEqual(CalendarEvent.objects.filter(calendar__in=self.sinks).count(), 120)
+
+    def test_retry(self):
+        self.api.fail_next = [(429, "rateLimitExceeded"), (403, "userRateLimitExceeded")]
+        for sink in self.sinks:
+            self.batcher.add(SinkWrite(sink, "insert", {"id": "event", "summary": "E"}))
+        writes = self.batcher.flush()
+        self.assertEqual([w.attempts for w in writes], [2, 2, 1])
+        self.assertTrue(all(w.error is None for w in writes))
+
+    def test_permanent_failure(self):
+        self.api.fail_next = [(400, "badRequest")]
+        for sink in self.sinks:
+            self.batcher.add(SinkWrite(sink, "insert", {"id": "event", "summary": "E"}))
+        writes = self.batcher.flush()
+        self.assertIsNotNone(writes[0].error)
+        self.assertEqual([w.attempts for w in writes], [1, 1, 1])
+        self.assertIsNone(writes[1].error)
+
+
+class TestWriteCoalescer(FakeGoogleMixin, TestCase):
+    """ Test holding sink writes to coalesce bursts. """
+    def setUp(self):
+        super().setUp()
+        self.sink = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="sink")
+        self.sent = []
+        self.coalescer = WriteCoalescer(send=self.sent.extend, window=60)
+
+    def test_coalesce(self):
+        self.coalescer.submit(SinkWrite(self.sink, "insert", {"id": "a", "summary": "1"}))
+        for i in range(2, 6):
+            self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "a", "summary": str(i)}))
+        self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "b", "summary": "b"}))
+        self.assertEqual(self.coalescer.flush_due(), [])
+        self.coalescer.flush_all()
+        self.assertEqual(
+            [(w.method, w.body["summary"]) for w in self.sent],
+            [("insert", "5"), ("patch", "b")])
+        self.assertEqual(self.coalescer.stats(), {
+            "submitted": 6, "coalesced": 4, "sent": 2, "pending": 0})
+
+    def test_window_per_submit(self):
+        self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "a"}), window=0)
+        self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "b"}))
+        self.assertEqual([w.event_id for w in self.coalescer.take_due()], ["a"])
+        self.assertEqual(self.coalescer.window, 60)
+
+    def test_groups(self):
+        done = []
+        first, second, empty = (WriteGroup(done=lambda n=n: done.append(n)) for n in range(3))
+        self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "a"}), group=first)
+        self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "b"}), group=first, window=0)
+        self.coalescer.submit(SinkWrite(self.sink, "patch", {"id": "a"}), group=second)
+        for group in (first, second, empty):
+            group.close()
+        self.assertEqual(done, [2])
+        self.coalescer.flush_due()
+        self.assertEqual(done, [2])
+        # Both groups' writes to a went out as one.
+        self.coalescer.flush_all()
+        self.assertEqual(done, [2, 0, 1])
+        self.assertEqual(len(self.sent), 2)
@@ -0,0 +1,128 @@
+import time
+from unittest import mock
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+
+from cal_sync_magic.models import UserCalendar
+from cal_sync_magic.views import refresh_accounts_calendars
+from tests.fake_google import FakeGoogleMixin
+
+
+class TestRefreshCalendars(FakeGoogleMixin, TestCase):
+    """ Test syncing the calendar list. """
+    def calendars(self):
+        return {c.google_calendar_id: (c.name, c.deleted)
+                for c in UserCalendar.objects.filter(google_account=self.account)}
+
+    def list_requests(self):
+        return [q for (m, p, q) in self.api.requests if p.endswith("calendarList")]
+
+    def test_full_then_delta(self):
+        for i in range(300):
+            self.api.add_calendar(f"cal-{i}", f"Calendar {i}")
+        self.account.refresh_calendars()
+        self.assertEqual(len(self.calendars()), 300)
+        # 300 calendars is more than one page.
+        self.assertEqual(len(self.list_requests()), 2)
+
+        self.api.add_calendar("cal-1", "Renamed")
+        self.api.calendar_list.remove("cal-2")
+        self.api.add_calendar("new", "New")
+        self.api.requests.clear()
+        self.account.refresh_calendars()
+        calendars = self.calendars()
+        self.assertEqual(calendars["cal-1"], ("Renamed", False))
+        self.assertEqual(calendars["cal-2"], ("Calendar 2", True))
+        self.assertEqual(calendars["new"], ("New", False))
+        self.assertEqual(len(calendars), 301)
+        self.assertIn("syncToken", self.list_requests()[0])
+
+    def test_without_upserts(self):
+        """ Databases without upserts on a conflict target (MySQL) go row by row. """
+        with mock.patch.object(
+                connection.features, "supports_update_conflicts_with_target", False):
+            self.test_full_then_delta()
+
+    def test_expired_sync_token(self):
+        self.api.add_calendar("cal", "Calendar")
+        self.account.refresh_calendars()
+        self.api.expire_sync_tokens()
+        self.api.add_calendar("other", "Other")
+        self.account.refresh_calendars()
+        self.assertEqual(set(self.calendars()), {"cal", "other"})
+
+
+class TestRefreshAccountsCalendars(TestCase):
+    """ Test refreshing several accounts at once. """
+    def make_account(self, account_id, refresh):
+        account = mock.Mock(account_id=account_id, google_user_email=f"{account_id}@example.com")
+        account.refresh_calendars.side_effect = refresh
+        return account
+
+    def test_partial_failure(self):
+        def fail():
+            raise Exception("boom")
+
+        ok = self.make_account(1, lambda: None)
+        failed = self.make_account(2, fail)
+        slow = self.make_account(3, lambda: time.sleep(1))
+        failures = refresh_accounts_calendars([ok, failed, slow], concurrency=3, timeout=0.2)
+        self.assertEqual(sorted(a.account_id for a, _ in failures), [2, 3])
+        ok.refresh_calendars.assert_called_once()
+
+    def test_timeout_covers_queued_accounts(self):
+        """ Accounts stuck behind a hung one time out too, from when we started. """
+        hung = self.make_account(1, lambda: time.sleep(1))
+        queued = self.make_account(2, lambda: None)
+        start = time.monotonic()
+        failures = refresh_accounts_calendars([hung, queued], concurrency=1, timeout=0.2)
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual([(a.account_id, str(e)) for a, e in failures], [
+            (1, "timed out after 0.2s"), (2, "timed out after 0.2s before starting")])
+        queued.refresh_calendars.assert_not_called()
+
+
+class TestUniqueCalendarMigration(TransactionTestCase):
+    """ Test duplicate calendars are merged before the unique constraint. """
+    before = [("cal_sync_magic", "0023_googleaccount_credential_expiry_index")]
+    after = [("cal_sync_magic", "0024_calendar_list_sync_token_unique_google_calendar")]
+
+    def tearDown(self):
+        MigrationExecutor(connection).migrate(
+            MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_duplicates_merged(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        User = apps.get_model("auth", "User")
+        GoogleAccount = apps.get_model("cal_sync_magic", "GoogleAccount")
+        UserCalendar = apps.get_model("cal_sync_magic", "UserCalendar")
+        SyncConfigs = apps.get_model("cal_sync_magic", "SyncConfigs")
+        user = User.objects.create(username="dup")
+        account = GoogleAccount.objects.create(user=user, google_user_email="dup@example.com")
+        stale = UserCalendar.objects.create(
+            user=user, google_account=account, google_calendar_id="cal", deleted=True)
+        live = UserCalendar.objects.create(
+            user=user, google_account=account, google_calendar_id="cal")
+        extra = UserCalendar.objects.create(
+            user=user, google_account=account, google_calendar_id="cal")
+        other = UserCalendar.objects.create(
+            user=user, google_account=account, google_calendar_id="other")
+        sync = SyncConfigs.objects.create(user=user)
+        sync.src_calendars.add(stale, other)
+        sync.sink_calendars.add(extra)
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        apps = executor.loader.project_state(self.after).apps
+        UserCalendar = apps.get_model("cal_sync_magic", "UserCalendar")
+        SyncConfigs = apps.get_model("cal_sync_magic", "SyncConfigs")
+        self.assertEqual(sorted(UserCalendar.objects.values_list("pk", flat=True)),
+                         [live.pk, other.pk])
+        sync = SyncConfigs.objects.get(pk=sync.pk)
+        self.assertEqual(sorted(sync.src_calendars.values_list("pk", flat=True)),
+                         [live.pk, other.pk])
+        self.assertEqual(list(sync.sink_calendars.values_list("pk", flat=True)), [live.pk])
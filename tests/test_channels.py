@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TransactionTestCase
+
+from cal_sync_magic.channels import (
+    expiring_channel_calendar_ids,
+    renew_expiring_channels,
+)
+from cal_sync_magic.models import UserCalendar
+from tests.fake_google import FakeGoogleMixin
+
+ADDRESS = "https://example.com/google-callback"
+
+
+class TestChannels(FakeGoogleMixin, TransactionTestCase):
+    """ Test watch channels are recorded and renewed before they expire. """
+    def make_calendar(self, google_calendar_id):
+        return UserCalendar.objects.create(
+            user=self.user, google_account=self.account,
+            google_calendar_id=google_calendar_id)
+
+    def test_subscribe_records_channel(self):
+        calendar = self.make_calendar("cal")
+        calendar.subscribe_if_needed(ADDRESS)
+        calendar.refresh_from_db()
+        self.assertTrue(calendar.webhook_enabled)
+        self.assertEqual(self.api.channels[calendar.channel_id],
+                         ("cal", calendar.channel_resource_id, ADDRESS))
+        self.assertEqual(calendar.make_channel_id(), calendar.channel_id)
+        self.assertLessEqual(len(calendar.channel_id), 64)
+        self.assertGreater(calendar.channel_expiration, datetime.utcnow() + timedelta(days=6))
+        # Already subscribed.
+        calendar.subscribe_if_needed(ADDRESS)
+        self.assertEqual(len(self.api.channels), 1)
+
+    def test_renew_expiring(self):
+        soon = self.make_calendar("soon")
+        later = self.make_calendar("later")
+        soon.subscribe_if_needed(ADDRESS)
+        later.subscribe_if_needed(ADDRESS)
+        UserCalendar.objects.filter(pk=soon.pk).update(
+            channel_expiration=datetime.utcnow() + timedelta(hours=1),
+            last_message_number=10)
+        # Subscribed before we kept track of channels.
+        legacy = self.make_calendar("legacy")
+        UserCalendar.objects.filter(pk=legacy.pk).update(webhook_enabled=True)
+        self.assertEqual(expiring_channel_calendar_ids(timedelta(hours=12)),
+                         [legacy.pk, soon.pk])
+
+        old_channel_id = UserCalendar.objects.get(pk=soon.pk).channel_id
+        stats = renew_expiring_channels(
+            lead_time=timedelta(hours=12), concurrency=2, address=ADDRESS)
+        self.assertEqual((stats.renewed, stats.failed), (2, 0))
+        soon.refresh_from_db()
+        self.assertNotEqual(soon.channel_id, old_channel_id)
+        self.assertIsNone(soon.last_message_number)
+        # The old channel was stopped, the legacy one wasn't ours to stop.
+        self.assertNotIn(old_channel_id, self.api.channels)
+        self.assertEqual(sorted(c for c, _, _ in self.api.channels.values()),
+                         ["later", "legacy", "soon"])
+        self.assertEqual(expiring_channel_calendar_ids(timedelta(hours=12)), [])
+
+    def test_renew_without_address(self):
+        calendar = self.make_calendar("legacy")
+        UserCalendar.objects.filter(pk=calendar.pk).update(webhook_enabled=True)
+        with self.settings(WEBHOOK_ADDRESS=None):
+            stats = renew_expiring_channels()
+        self.assertEqual(stats.errors, {"no address": 1})
+
+    def test_command(self):
+        calendar = self.make_calendar("legacy")
+        UserCalendar.objects.filter(pk=calendar.pk).update(webhook_enabled=True)
+        out, err = StringIO(), StringIO()
+        with self.settings(WEBHOOK_ADDRESS=None):
+            call_command("renew_channels", stdout=out, stderr=err)
+        self.assertIn("renewed 0 errors {'no address': 1}", out.getvalue())
+        self.assertIn("1 channels failed to renew.", err.getvalue())
@@ -0,0 +1,183 @@
+import random
+from datetime import datetime, timedelta
+
+from django.test import TestCase, override_settings
+
+from cal_sync_magic.conflicts import IntervalTreap, busy_interval, conflict_index
+from cal_sync_magic.models import CalendarRules, SyncConfigs, UserCalendar
+from tests.fake_google import FakeGoogleMixin
+
+START = datetime(2030, 1, 1, 9, 0)
+
+
+def at(hours):
+    return {"dateTime": (START + timedelta(hours=hours)).isoformat() + "Z"}
+
+
+def make_event(event_id, start, end, response=None, organizer="boss@example.com", **extra):
+    event = {"id": event_id, "summary": event_id, "start": at(start), "end": at(end),
+             "organizer": {"email": organizer},
+             "creator": {"email": organizer}}
+    if response is not None:
+        event["attendees"] = [
+            {"email": organizer, "organizer": True, "responseStatus": "accepted"},
+            {"email": "lennon@thebeatles.com", "self": True, "responseStatus": response}]
+    event.update(extra)
+    return event
+
+
+class TestIntervalTreap(TestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(42)
+        tree = IntervalTreap()
+        intervals = {}
+        for step in range(2000):
+            key = rng.randrange(300)
+            if rng.random() < 0.25:
+                tree.discard(key)
+                intervals.pop(key, None)
+            else:
+                start = rng.randrange(1000)
+                end = start + rng.randrange(1, 50)
+                tree.add(key, start, end, f"v{key}")
+                intervals[key] = (start, end)
+            if step % 50 == 0:
+                q_start = rng.randrange(1000)
+                q_end = q_start + rng.randrange(1, 100)
+                found = tree.overlapping(q_start, q_end)
+                self.assertEqual(tree.any_overlap(q_start, q_end), bool(found))
+                self.assertEqual(
+                    sorted(k for k, _, _, _ in found),
+                    sorted(k for k, (s, e) in intervals.items() if s < q_end and e > q_start))
+                self.assertEqual([s for _, s, _, _ in found], sorted(s for _, s, _, _ in found))
+        self.assertEqual(len(tree), len(intervals))
+
+    def test_half_open(self):
+        tree = IntervalTreap()
+        tree.add("a", 1, 2)
+        self.assertEqual(tree.overlapping(2, 3), [])
+        self.assertEqual(tree.overlapping(0, 1), [])
+        self.assertEqual(tree.overlapping(1, 2), [("a", 1, 2, None)])
+
+    def test_any_overlap_stops_early(self):
+        tree = IntervalTreap()
+        for i in range(100):
+            tree.add(i, 0, 10)
+        seen = []
+
+        def predicate(key, value):
+            seen.append(key)
+            return key % 2 == 1
+        self.assertTrue(tree.any_overlap(5, 6, predicate))
+        self.assertEqual(seen, [0, 1])
+        self.assertFalse(tree.any_overlap(5, 6, lambda key, value: False))
+        self.assertFalse(tree.any_overlap(10, 11))
+
+    def test_busy_interval(self):
+        self.assertIsNotNone(busy_interval(make_event("a", 0, 1)))
+        self.assertIsNotNone(busy_interval(make_event("a", 0, 1, response="accepted")))
+        self.assertIsNone(busy_interval(make_event("a", 0, 1, response="declined")))
+        self.assertIsNone(busy_interval(make_event("a", 0, 1, response="needsAction")))
+        self.assertIsNone(busy_interval(make_event("a", 0, 1, transparency="transparent")))
+        self.assertIsNone(busy_interval(make_event("a", 0, 1, status="cancelled")))
+        self.assertIsNone(busy_interval({"id": "a", "start": {"date": "2030-01-01"},
+                                         "end": {"date": "2030-01-02"}}))
+
+
+class TestConflicts(FakeGoogleMixin, TestCase):
+    """ Test answering invites which conflict with what's already on the calendar. """
+    def setUp(self):
+        super().setUp()
+        self.work = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="work")
+        self.home = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="home")
+        self.other = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="other")
+        self.rule = CalendarRules.objects.create(
+            user=self.user, decline_conflict=True, allow_list_conflict="*@friends.org")
+        self.rule.calendars.add(self.work, self.home)
+        self.api.add_event("home", make_event("dentist", 2, 3))
+        self.api.add_event("other", make_event("gym", 5, 6))
+        for calendar in (self.work, self.home, self.other):
+            calendar.handle_sync_event()
+
+    def response(self, event_id, calendar="work"):
+        attendees = self.api.events(calendar).get(event_id)["attendees"]
+        return [a["responseStatus"] for a in attendees if a.get("self")][0]
+
+    def invite(self, event_id, start, end, **kwargs):
+        self.api.add_event("work", make_event(event_id, start, end, response="needsAction",
+                                              **kwargs))
+        self.work.handle_sync_event()
+        return self.response(event_id)
+
+    def test_decline(self):
+        self.assertEqual(self.invite("overlaps", 2.5, 3.5), "declined")
+        self.assertEqual(self.invite("after", 3, 4), "needsAction")
+        # Not one of the rule's calendars.
+        self.assertEqual(self.invite("gym time", 5, 6), "needsAction")
+        self.assertEqual(self.invite("friend", 2, 3, organizer="paul@friends.org"),
+                         "needsAction")
+
+    def test_decline_keeps_attendee_fields(self):
+        event = make_event("overlaps", 2.5, 3.5, response="needsAction")
+        event["attendees"].append({"email": "ringo@thebeatles.com", "displayName": "Ringo",
+                                   "optional": True, "comment": "Running late",
+                                   "additionalGuests": 1, "responseStatus": "accepted"})
+        self.api.add_event("work", event)
+        self.work.handle_sync_event()
+        attendees = self.api.events("work").get("overlaps")["attendees"]
+        self.assertEqual([a["responseStatus"] for a in attendees],
+                         ["accepted", "declined", "accepted"])
+        self.assertEqual(attendees[2], event["attendees"][2])
+
+    def test_soft_maybe(self):
+        self.rule.decline_conflict = False
+        self.rule.soft_maybe_conflict = True
+        self.rule.save()
+        self.assertEqual(self.invite("overlaps", 2.5, 3.5), "tentative")
+
+    @override_settings(CONFLICT_INDEX_TTL=None)
+    def test_incremental(self):
+        self.assertEqual(self.invite("first", 0, 1), "needsAction")
+        self.api.add_event("home", make_event("lunch", 7, 8))
+        self.home.handle_sync_event()
+        self.assertEqual(self.invite("second", 7.5, 8.5), "declined")
+        # The dentist got cancelled.
+        self.api.events("home").remove("dentist")
+        self.home.handle_sync_event()
+        self.assertEqual(self.invite("third", 2, 3), "needsAction")
+        # Declined invites don't count as busy either.
+        self.assertEqual(self.invite("fourth", 8, 9), "needsAction")
+
+    def test_has_conflict(self):
+        event = make_event("x", 2.5, 3.5)
+        self.assertTrue(conflict_index.has_conflict(self.rule, self.work, event))
+        self.assertEqual(len(conflict_index.conflicts(self.rule, self.work, event)), 1)
+        self.assertFalse(conflict_index.has_conflict(
+            self.rule, self.work, event, exclude={(self.home.pk, "dentist")}))
+        self.assertFalse(conflict_index.has_conflict(self.rule, self.work, make_event("y", 5, 6)))
+
+    def test_rule_calendars_change(self):
+        conflict_index.conflicts(self.rule, self.work, make_event("x", 0, 1))
+        self.rule.calendars.add(self.other)
+        self.assertEqual(self.invite("gym time", 5, 6), "declined")
+
+    def sync(self, src, sink):
+        sync = SyncConfigs.objects.create(user=self.user)
+        sync.src_calendars.add(src)
+        sync.sink_calendars.add(sink)
+        src.last_sync_token = None
+        src.handle_sync_event()
+
+    def test_synced_busy_block(self):
+        """ Busy time copied in from another calendar counts. """
+        self.sync(self.other, self.home)
+        self.assertEqual(self.invite("gym time", 5.5, 6.5), "declined")
+
+    def test_own_copy_does_not_conflict(self):
+        self.sync(self.work, self.home)
+        self.assertEqual(self.invite("meeting", 9, 10), "needsAction")
+        # By now the invite's copy on home is mirrored, the next edit sees it.
+        self.assertEqual(self.invite("meeting", 9, 10, summary="Moved"), "needsAction")
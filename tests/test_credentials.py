@@ -0,0 +1,193 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+import google.oauth2.credentials
+
+from cal_sync_magic.credential_cache import credential_cache
+from cal_sync_magic.models import GoogleAccount
+from cal_sync_magic.token_refresh import (
+    expiring_account_ids,
+    refresh_expiring_credentials,
+)
+from tests.fake_google import FakeTokenServer
+
+User = get_user_model()
+
+
+def make_credentials_json(token="token", token_uri="https://oauth2.googleapis.com/token"):
+    return json.dumps({
+        "token": token,
+        "refresh_token": "refresh",
+        "token_uri": token_uri,
+        "client_id": "client",
+        "client_secret": "secret",
+        "scopes": ["openid"],
+    })
+
+
+class TestCredentialCache(TestCase):
+    """ Test that valid credentials are served without hitting the DB. """
+    def setUp(self):
+        credential_cache.clear()
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+        self.account = GoogleAccount.objects.create(
+            user=self.user,
+            google_user_email="lennon@thebeatles.com",
+            credentials=make_credentials_json(),
+            credential_expiry=datetime.utcnow() + timedelta(hours=1))
+
+    def tearDown(self):
+        credential_cache.clear()
+
+    def test_valid_credentials_do_not_save(self):
+        with mock.patch.object(GoogleAccount, "save") as save:
+            first = self.account.get_credentials()
+            second = self.account.get_credentials()
+        self.assertEqual(first.token, "token")
+        self.assertIs(first, second)
+        save.assert_not_called()
+
+    def test_invalidate(self):
+        first = self.account.get_credentials()
+        credential_cache.invalidate(self.account.account_id)
+        second = self.account.get_credentials()
+        self.assertIsNot(first, second)
+
+    def test_changed_credentials_miss(self):
+        first = self.account.get_credentials()
+        account = GoogleAccount.objects.get(account_id=self.account.account_id)
+        account.credentials = make_credentials_json(token="other")
+        self.assertEqual(account.get_credentials().token, "other")
+
+    def test_min_validity_forces_refresh(self):
+        def fake_refresh(credentials, request):
+            credentials.token = "refreshed"
+            credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        self.account.get_credentials()
+        with mock.patch.object(google.oauth2.credentials.Credentials, "refresh", fake_refresh):
+            self.assertEqual(self.account.get_credentials().token, "token")
+            credentials = self.account.get_credentials(min_validity=timedelta(hours=2))
+        self.assertEqual(credentials.token, "refreshed")
+        account = GoogleAccount.objects.get(account_id=self.account.account_id)
+        self.assertIn("refreshed", account.credentials)
+
+
+class TestSingleFlightRefresh(TransactionTestCase):
+    """ Concurrent callers with an expired token should refresh exactly once. """
+    def setUp(self):
+        credential_cache.clear()
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+
+    def tearDown(self):
+        credential_cache.clear()
+
+    def test_concurrent_refresh(self):
+        with FakeTokenServer(delay=0.2) as server:
+            account = GoogleAccount.objects.create(
+                user=self.user,
+                google_user_email="lennon@thebeatles.com",
+                credentials=make_credentials_json(token_uri=server.token_uri),
+                credential_expiry=datetime.utcnow() - timedelta(hours=1))
+            # Each caller gets its own (stale) copy of the row, like separate workers.
+            accounts = [GoogleAccount.objects.get(account_id=account.account_id)
+                        for _ in range(8)]
+            tokens = []
+
+            def get_token(a):
+                try:
+                    tokens.append(a.get_credentials().token)
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=get_token, args=(a,)) for a in accounts]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(server.refreshes, 1)
+        self.assertEqual(tokens, ["token-1"] * 8)
+        account.refresh_from_db()
+        self.assertIn("token-1", account.credentials)
+
+    def test_refreshed_elsewhere(self):
+        """ A caller holding a stale row picks up a token another process stored. """
+        with FakeTokenServer() as server:
+            account = GoogleAccount.objects.create(
+                user=self.user,
+                google_user_email="lennon@thebeatles.com",
+                credentials=make_credentials_json(token_uri=server.token_uri),
+                credential_expiry=datetime.utcnow() - timedelta(hours=1))
+            GoogleAccount.objects.filter(account_id=account.account_id).update(
+                credentials=make_credentials_json(token="other", token_uri=server.token_uri),
+                credential_expiry=datetime.utcnow() + timedelta(hours=1))
+            self.assertEqual(account.get_credentials().token, "other")
+        self.assertEqual(server.refreshes, 0)
+
+
+class TestRevokedRefresh(TestCase):
+    """ A token we can no longer refresh gets cleared, and revoked after commit. """
+    def setUp(self):
+        credential_cache.clear()
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+
+    def tearDown(self):
+        credential_cache.clear()
+
+    def test_revoked(self):
+        with FakeTokenServer(revoked=True) as server:
+            account = GoogleAccount.objects.create(
+                user=self.user,
+                google_user_email="lennon@thebeatles.com",
+                credentials=make_credentials_json(token_uri=server.token_uri),
+                credential_expiry=datetime.utcnow() - timedelta(hours=1))
+            with mock.patch("cal_sync_magic.models.requests.post") as post:
+                with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                    self.assertIsNone(account.get_credentials())
+                    post.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(post.call_args.kwargs["params"], {"token": "token"})
+        account.refresh_from_db()
+        self.assertEqual(account.credentials, "")
+        self.assertIsNone(account.get_credentials())
+        self.assertEqual(server.refreshes, 1)
+
+
+class TestRefreshExpiring(TransactionTestCase):
+    """ Test refreshing every token that's about to expire. """
+    def setUp(self):
+        credential_cache.clear()
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+
+    def tearDown(self):
+        credential_cache.clear()
+
+    def make_account(self, email, token_uri, expires_in):
+        return GoogleAccount.objects.create(
+            user=self.user,
+            google_user_email=email,
+            credentials=make_credentials_json(token_uri=token_uri),
+            credential_expiry=datetime.utcnow() + expires_in)
+
+    def test_refresh_and_revoked(self):
+        with FakeTokenServer() as ok, FakeTokenServer(revoked=True) as revoked:
+            self.make_account("fresh@example.com", ok.token_uri, timedelta(hours=1))
+            expiring = self.make_account("soon@example.com", ok.token_uri, timedelta(minutes=1))
+            gone = self.make_account("gone@example.com", revoked.token_uri, timedelta(minutes=1))
+            with mock.patch("cal_sync_magic.models.requests.post"):
+                # One at a time, the in-memory test database locks on concurrent writes.
+                stats = refresh_expiring_credentials(timedelta(minutes=10), concurrency=1)
+        self.assertEqual((stats.refreshed, stats.revoked, stats.errors), (1, 1, {}))
+        self.assertEqual(ok.refreshes, 1)
+        # Revoked accounts aren't picked up again until they're re-added.
+        self.assertEqual(expiring_account_ids(timedelta(minutes=10)), [])
+        gone.refresh_from_db()
+        self.assertEqual(gone.credentials, "")
+        expiring.refresh_from_db()
+        self.assertIn("token-1", expiring.credentials)
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.test import TestCase
+
+from cal_sync_magic.models import CalendarRules, SyncConfigs
+from cal_sync_magic.plans import AllowList, rule_plans, sync_plans
+
+
+class TestAllowList(TestCase):
+    def test_matching(self):
+        allow = AllowList(" Boss@Example.com, *@friends.org,@family.net, *.corp.com ,")
+        self.assertIn("boss@example.com", allow)
+        self.assertIn("BOSS@example.com", allow)
+        self.assertNotIn("other@example.com", allow)
+        self.assertIn("anyone@friends.org", allow)
+        self.assertIn("anyone@family.net", allow)
+        self.assertIn("a@eng.corp.com", allow)
+        self.assertIn("a@x.eng.corp.com", allow)
+        self.assertNotIn("a@corp.com", allow)
+        self.assertNotIn("a@notcorp.com", allow)
+        self.assertNotIn(None, allow)
+        self.assertFalse(AllowList(None))
+
+
+class TestPlans(TestCase):
+    """ Test compiled sync and rule plans. """
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.sync = SyncConfigs.objects.create(
+            user=self.user, rewrite_regex=r"\[.*?\]\s*", default_title="Busy",
+            match_title_regex="^Lunch")
+
+    def test_clean_event(self):
+        cleaned = self.sync.clean_event({"id": "a", "summary": "[ext] Lunch with Paul"})
+        self.assertEqual(cleaned["summary"], "Lunch with Paul")
+        cleaned = self.sync.clean_event({"id": "a", "summary": "[ext] Standup"})
+        self.assertEqual(cleaned["summary"], "Busy")
+
+    def test_cached_until_changed(self):
+        plan = sync_plans.get(self.sync)
+        self.assertIs(sync_plans.get(SyncConfigs.objects.get(pk=self.sync.pk)), plan)
+        # Unsaved edits (or ones saved by another process) get a fresh plan.
+        self.sync.default_title = "Away"
+        self.assertEqual(sync_plans.get(self.sync).default_title, "Away")
+
+        self.sync.save()
+        self.assertNotIn(self.sync.pk, sync_plans._plans)
+
+    def test_rule_plan(self):
+        rule = CalendarRules.objects.create(
+            user=self.user, min_sched=timedelta(hours=1), allow_list_min_sched="*@beatles.com")
+        plan = rule_plans.get(rule)
+        self.assertIn("ringo@beatles.com", plan.min_sched_allow)
+        rule.delete()
+        self.assertNotIn(plan, [p for _, p in rule_plans._plans.values()])
+
+
+class TestShortNotice(TestCase):
+    """ Test warning folks who invite us at short notice. """
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.rule = CalendarRules.objects.create(
+            user=self.user, min_sched=timedelta(hours=2), allow_list_min_sched="*@beatles.com")
+        self.now = datetime(2023, 1, 1, 12, 0)
+
+    def event(self, start, email="brian@example.com", **extra):
+        event = {"id": "abc", "summary": "Meeting",
+                 "creator": {"email": email, "displayName": "Brian"},
+                 "start": {"dateTime": start}}
+        event.update(extra)
+        return event
+
+    def test_is_short_notice(self):
+        self.assertTrue(self.rule.is_short_notice(
+            self.event("2023-01-01T13:00:00Z"), now=self.now))
+        # Time zones are respected, this is 15:00 UTC.
+        self.assertFalse(self.rule.is_short_notice(
+            self.event("2023-01-01T07:00:00-08:00"), now=self.now))
+        # Already started.
+        self.assertFalse(self.rule.is_short_notice(
+            self.event("2023-01-01T11:00:00Z"), now=self.now))
+        self.assertFalse(self.rule.is_short_notice(
+            self.event("2023-01-01T13:00:00Z", email="paul@beatles.com"), now=self.now))
+        self.assertFalse(self.rule.is_short_notice(
+            self.event("2023-01-01T13:00:00Z", status="cancelled"), now=self.now))
+        self.assertFalse(self.rule.is_short_notice(
+            {"id": "abc", "creator": {"email": "brian@example.com"},
+             "start": {"date": "2023-01-01"}}, now=self.now))
+
+    def test_evaluate_schedule_emails(self):
+        start = (datetime.utcnow() + timedelta(minutes=30)).isoformat() + "Z"
+        self.rule.evaluate_rule(self.event(start))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["brian@example.com"])
+        self.assertEqual(mail.outbox[0].subject, "Invite to Meeting from Brian")
+        # Once per event.
+        self.rule.evaluate_rule(self.event(start, summary="Meeting moved"))
+        self.assertEqual(len(mail.outbox), 1)
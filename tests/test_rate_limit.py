@@ -0,0 +1,107 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from cal_sync_magic.models import UserCalendar
+from cal_sync_magic.rate_limit import RateLimiter, TokenBucketStore
+from tests.fake_google import FakeGoogleMixin
+
+
+class TestTokenBuckets(TestCase):
+    """ Test the token buckets shared through the sqlite store. """
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "buckets.sqlite3")
+
+    def test_take_and_refill(self):
+        store = TokenBucketStore(self.path)
+        buckets = [("a", 10, 2)]
+        self.assertEqual(store.take(buckets), 0)
+        self.assertEqual(store.take(buckets), 0)
+        wait = store.take(buckets)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+        time.sleep(wait)
+        self.assertEqual(store.take(buckets), 0)
+
+    def test_shared_between_stores(self):
+        """ Separate stores on one file (like separate processes) share buckets. """
+        buckets = [("a", 1, 1)]
+        self.assertEqual(TokenBucketStore(self.path).take(buckets), 0)
+        self.assertGreater(TokenBucketStore(self.path).take(buckets), 0)
+
+    def test_all_or_nothing(self):
+        store = TokenBucketStore(self.path)
+        store.take([("b", 1, 1)])
+        self.assertGreater(store.take([("a", 1, 1), ("b", 1, 1)]), 0)
+        # "a" wasn't charged for the failed take.
+        self.assertEqual(store.take([("a", 1, 1)]), 0)
+
+    def test_back_off(self):
+        limiter = RateLimiter()
+        with override_settings(GOOGLE_API_RATE_LIMIT_DB=self.path,
+                               GOOGLE_API_RATE_LIMITS={"account": (100, 100)}):
+            limiter.back_off(1, 0.2)
+            start = time.monotonic()
+            limiter.acquire(1)
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+            # Other accounts are unaffected.
+            start = time.monotonic()
+            limiter.acquire(2)
+            self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_project_back_off(self):
+        limiter = RateLimiter()
+        with override_settings(GOOGLE_API_RATE_LIMIT_DB=self.path,
+                               GOOGLE_API_RATE_LIMITS={"project": (100, 100)}):
+            limiter.back_off(1, 0.2, "project")
+            start = time.monotonic()
+            limiter.acquire(2)
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+
+class TestExecute(FakeGoogleMixin, TestCase):
+    """ Test API calls go through the rate limiter and retry quota errors. """
+    def setUp(self):
+        super().setUp()
+        self.calendar = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="cal")
+
+    def test_retries_rate_limits(self):
+        self.api.fail_next = [(429, "rateLimitExceeded"), (503, "backendError")]
+        with self.settings(GOOGLE_API_BACKOFF=0.01):
+            event = self.calendar.add_event({"summary": "Lunch"})
+        self.assertEqual(event["summary"], "Lunch")
+        self.assertEqual(len(self.api.requests), 3)
+
+    def test_backs_off_the_limited_bucket(self):
+        self.api.fail_next = [(403, "userRateLimitExceeded"), (403, "quotaExceeded")]
+        with self.settings(GOOGLE_API_BACKOFF=0.01):
+            with mock.patch("cal_sync_magic.services.rate_limiter.back_off") as back_off:
+                self.calendar.add_event({"summary": "Lunch"})
+        self.assertEqual([c.args[2] for c in back_off.call_args_list], ["account", "project"])
+
+    def test_gives_up(self):
+        self.api.fail_next = [(503, "backendError")] * 3
+        with self.settings(GOOGLE_API_BACKOFF=0.01, GOOGLE_API_MAX_RETRIES=2):
+            with self.assertRaises(Exception):
+                self.calendar.add_event({"summary": "Lunch"})
+        self.assertEqual(len(self.api.requests), 3)
+
+    def test_no_retry_on_client_errors(self):
+        self.api.fail_next = [(400, "badRequest")]
+        with self.assertRaises(Exception):
+            self.calendar.add_event({"summary": "Lunch"})
+        self.assertEqual(len(self.api.requests), 1)
+
+    def test_rate_limited(self):
+        with self.settings(GOOGLE_API_RATE_LIMITS={"account": (20, 2)}):
+            with mock.patch("cal_sync_magic.rate_limit.time.sleep", wraps=time.sleep) as sleep:
+                for _ in range(3):
+                    self.calendar.add_event({"summary": "Lunch"})
+        # The third call had to wait for a token.
+        self.assertEqual(sleep.call_count, 1)
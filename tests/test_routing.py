@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+
+from cal_sync_magic.models import CalendarRules, EventLink, SyncConfigs, UserCalendar
+from cal_sync_magic.routing import routing_index
+from tests.fake_google import FakeGoogleMixin
+
+
+class TestRouting(FakeGoogleMixin, TestCase):
+    """ Test routing events to the syncs and rules for their calendar. """
+    def setUp(self):
+        super().setUp()
+        self.src = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="src")
+        self.sink = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="sink")
+        self.sync = SyncConfigs.objects.create(user=self.user)
+        self.sync.src_calendars.add(self.src)
+        self.sync.sink_calendars.add(self.sink)
+        self.rule = CalendarRules.objects.create(user=self.user, min_sched=timedelta(hours=1))
+        self.rule.calendars.add(self.src, self.sink)
+
+    def test_routes(self):
+        route = routing_index.route(self.src)
+        (sync, sinks), = route.syncs
+        self.assertEqual(sync, self.sync)
+        self.assertEqual(sinks, [self.sink])
+        self.assertEqual(route.rules, [self.rule])
+        route = routing_index.route(self.sink)
+        self.assertEqual((route.syncs, route.rules), ([], [self.rule]))
+
+    def test_no_queries_once_built(self):
+        routing_index.route(self.src)
+        with self.assertNumQueries(0):
+            route = routing_index.route(self.sink)
+            (sync, sinks), = routing_index.route(self.src).syncs
+            sinks[0].google_account
+            route.rules[0].user
+
+    def test_invalidated_on_change(self):
+        other = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="other")
+        self.assertEqual(routing_index.route(other).syncs, [])
+        self.sync.src_calendars.add(other)
+        self.assertEqual(len(routing_index.route(other).syncs), 1)
+        self.sync.sink_calendars.remove(self.sink)
+        self.assertEqual(routing_index.route(other).syncs[0][1], [])
+        self.rule.delete()
+        self.assertEqual(routing_index.route(self.src).rules, [])
+
+    @override_settings(ROUTING_INDEX_TTL=0)
+    def test_ttl(self):
+        routing_index.route(self.src)
+        # e.g. another process adding a sink, we don't get the signal.
+        SyncConfigs.sink_calendars.through.objects.filter(
+            syncconfigs=self.sync).delete()
+        self.assertEqual(routing_index.route(self.src).syncs[0][1], [])
+
+    def test_handle_sync_event(self):
+        for i in range(3):
+            self.api.add_event("src", {"id": f"event{i}", "summary": f"Event {i}"})
+        routing_index.route(self.src)
+        # Nothing for routing: one EventLink lookup for the page, plus the mirror of
+        # both calendars, the new links and the sync token.
+        with self.assertNumQueries(6):
+            self.src.handle_sync_event()
+        self.assertEqual(EventLink.objects.count(), 3)
+        self.assertEqual(len(self.api.events("sink").items), 3)
+
+    def test_cancellations(self):
+        other = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="other")
+        self.sync.sink_calendars.add(other)
+        for i in range(3):
+            self.api.add_event("src", {"id": f"event{i}", "summary": f"Event {i}"})
+        self.src.handle_sync_event()
+        for i in range(3):
+            self.api.events("src").remove(f"event{i}")
+        routing_index.route(self.src)
+        # The page's links come with their sink calendars and accounts in one query.
+        with self.assertNumQueries(6):
+            self.src.handle_sync_event()
+        self.assertFalse(EventLink.objects.exists())
+        self.assertEqual({e["status"] for _, e in self.api.events("sink").items.values()},
+                         {"cancelled"})
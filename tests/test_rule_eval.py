@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from django.core import mail
+from django.test import TestCase
+
+from cal_sync_magic.models import SYNC_SOURCE_URL, CalendarRules, UserCalendar
+from cal_sync_magic.rule_eval import EventPage, short_notice_events
+from tests.fake_google import FakeGoogleMixin
+
+NOW = datetime(2023, 1, 1, 12, 0)
+
+
+def make_page():
+    events = []
+    for i in range(40):
+        creator = {"email": f"person{i}@{'beatles.com' if i % 5 == 0 else 'example.com'}"}
+        if i % 7 == 0:
+            creator["self"] = True
+        start = NOW + timedelta(minutes=15 * i - 60)
+        event = {"id": f"event{i}", "summary": f"Event {i}", "creator": creator,
+                 "start": {"dateTime": start.isoformat() + "Z"}}
+        if i % 11 == 0:
+            event["status"] = "cancelled"
+        if i % 13 == 0:
+            event["source"] = {"url": SYNC_SOURCE_URL}
+        if i % 17 == 0:
+            event["start"] = {"date": "2023-01-01"}
+        events.append(event)
+    events.append({"id": "nobody", "start": {"dateTime": "2023-01-01T12:30:00Z"}})
+    return events
+
+
+class TestRuleEval(TestCase):
+    """ Test evaluating rules over whole pages. """
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        user = get_user_model().objects.create_user(
+            'john', 'lennon@thebeatles.com', 'johnpassword')
+        self.rules = [
+            CalendarRules.objects.create(user=user, min_sched=timedelta(hours=2)),
+            CalendarRules.objects.create(
+                user=user, min_sched=timedelta(hours=5), allow_list_min_sched="*@beatles.com"),
+            CalendarRules.objects.create(user=user),
+        ]
+
+    def test_matches_per_event(self):
+        page = make_page()
+        matches = short_notice_events(self.rules, page, now=NOW)
+        for rule in self.rules:
+            self.assertEqual(
+                [e["id"] for e in matches[rule]],
+                [e["id"] for e in page if rule.is_short_notice(e, now=NOW)])
+        self.assertEqual(len(matches[self.rules[0]]), 6)
+        self.assertEqual(matches[self.rules[2]], [])
+
+    def test_empty_page(self):
+        self.assertEqual(short_notice_events(self.rules, EventPage([]), now=NOW),
+                         {rule: [] for rule in self.rules})
+
+
+class TestPageRules(FakeGoogleMixin, TestCase):
+    def test_handle_sync_event(self):
+        calendar = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="cal")
+        rule = CalendarRules.objects.create(user=self.user, min_sched=timedelta(hours=1))
+        rule.calendars.add(calendar)
+        soon = (datetime.utcnow() + timedelta(minutes=30)).isoformat() + "Z"
+        later = (datetime.utcnow() + timedelta(days=2)).isoformat() + "Z"
+        for i, start in enumerate([soon, later, soon]):
+            self.api.add_event("cal", {
+                "id": f"event{i}", "summary": f"Event {i}",
+                "creator": {"email": f"person{i}@example.com"},
+                "start": {"dateTime": start}})
+        calendar.handle_sync_event()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ["person0@example.com", "person2@example.com"])
+        # Resyncing everything (or another edit) doesn't warn again.
+        self.api.expire_sync_tokens()
+        calendar.handle_sync_event()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_added_to_an_existing_meeting(self):
+        calendar = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="cal")
+        rule = CalendarRules.objects.create(user=self.user, min_sched=timedelta(hours=1))
+        rule.calendars.add(calendar)
+        calendar.handle_sync_event()
+        # Created long ago, we were only just invited.
+        self.api.add_event("cal", {
+            "id": "standup", "summary": "Standup",
+            "created": (datetime.utcnow() - timedelta(days=30)).isoformat() + "Z",
+            "creator": {"email": "boss@example.com"},
+            "start": {"dateTime": (datetime.utcnow() + timedelta(minutes=30)).isoformat() + "Z"}})
+        calendar.handle_sync_event()
+        self.assertEqual([m.to[0] for m in mail.outbox], ["boss@example.com"])
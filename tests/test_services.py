@@ -0,0 +1,36 @@
+import threading
+
+from django.test import TestCase, override_settings
+
+import google.oauth2.credentials
+
+from cal_sync_magic.services import CalendarServicePool, default_http
+from tests.fake_google import FakeCalendarApi
+
+
+class TestCalendarServicePool(TestCase):
+    def setUp(self):
+        self.pool = CalendarServicePool(http_factory=FakeCalendarApi().http)
+        self.credentials = google.oauth2.credentials.Credentials(token="token")
+
+    def test_reuses_service(self):
+        first = self.pool.get(1, self.credentials)
+        self.assertIs(first, self.pool.get(1, self.credentials))
+        self.assertIsNot(first, self.pool.get(2, self.credentials))
+
+    def test_invalidate(self):
+        first = self.pool.get(1, self.credentials)
+        self.pool.invalidate(1)
+        self.assertIsNot(first, self.pool.get(1, self.credentials))
+
+    def test_per_thread(self):
+        first = self.pool.get(1, self.credentials)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.pool.get(1, self.credentials)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(first, other[0])
+
+    @override_settings(GOOGLE_API_TIMEOUT=5)
+    def test_socket_timeout(self):
+        self.assertEqual(default_http().timeout, 5)
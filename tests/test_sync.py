@@ -0,0 +1,284 @@
+from unittest import mock
+
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from cal_sync_magic.models import (
+    CalendarEvent,
+    EventLink,
+    SyncConfigs,
+    UserCalendar,
+    make_sink_event_id,
+)
+from cal_sync_magic.services import DEFAULT_FIELD_MASKS
+from tests.fake_google import FakeGoogleMixin
+
+
+class TestChanges(FakeGoogleMixin, TestCase):
+    """ Test reading calendar changes. """
+    def setUp(self):
+        super().setUp()
+        self.calendar = UserCalendar.objects.create(
+            user=self.user,
+            google_account=self.account,
+            google_calendar_id="cal",
+            name="Calendar")
+
+    def stored_sync_token(self):
+        return UserCalendar.objects.get(pk=self.calendar.pk).last_sync_token
+
+    def test_pages(self):
+        for i in range(600):
+            self.api.add_event("cal", {"summary": f"Event {i}"})
+        pages = self.calendar.iter_change_pages()
+        first = next(pages)
+        self.assertEqual(len(first), 250)
+        self.assertIsNone(self.stored_sync_token())
+        rest = list(pages)
+        self.assertEqual([len(p) for p in rest], [250, 100])
+        self.assertIsNotNone(self.stored_sync_token())
+
+    def test_get_changes(self):
+        self.api.add_event("cal", {"summary": "Event"})
+        self.assertEqual([e["summary"] for e in self.calendar.get_changes()], ["Event"])
+
+    def test_raw_events_view(self):
+        for i in range(300):
+            self.api.add_event("cal", {"summary": f"<Event {i}>"})
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse("view-calendar-raw-events",
+                                      args=[self.calendar.internal_calendar_id]))
+        chunks = list(response.streaming_content)
+        # A chunk per page.
+        self.assertEqual(len(chunks), 2)
+        content = b"".join(chunks).decode("utf-8")
+        self.assertEqual(content.count("<br>"), 300)
+        self.assertIn("&quot;summary&quot;: &quot;&lt;Event 299&gt;&quot;", content)
+        self.assertIsNone(self.stored_sync_token())
+
+    def test_incremental(self):
+        self.api.add_event("cal", {"id": "a", "summary": "A"})
+        self.api.add_event("cal", {"id": "b", "summary": "B"})
+        self.assertEqual(len(self.calendar.get_changes()), 2)
+
+        self.api.add_event("cal", {"id": "a", "summary": "A moved"})
+        self.api.events("cal").remove("b")
+        self.api.requests.clear()
+        changes = {e["id"]: e for e in self.calendar.get_changes()}
+        self.assertEqual(changes["a"]["summary"], "A moved")
+        self.assertEqual(changes["b"]["status"], "cancelled")
+        (method, path, query), = self.api.requests
+        self.assertIn("syncToken", query)
+        for param in ["timeMin", "timeMax", "orderBy"]:
+            self.assertNotIn(param, query)
+
+        calendar = UserCalendar.objects.get(pk=self.calendar.pk)
+        self.assertEqual((calendar.full_syncs, calendar.full_sync_events), (1, 2))
+        self.assertEqual((calendar.delta_syncs, calendar.delta_sync_events), (1, 2))
+
+    def test_gone_full_resync(self):
+        self.api.add_event("cal", {"id": "a", "summary": "A"})
+        self.calendar.get_changes()
+        old_token = self.stored_sync_token()
+        self.api.expire_sync_tokens()
+        self.api.add_event("cal", {"id": "b", "summary": "B"})
+        self.assertEqual({e["id"] for e in self.calendar.get_changes()}, {"a", "b"})
+        self.assertNotEqual(self.stored_sync_token(), old_token)
+        self.assertEqual(UserCalendar.objects.get(pk=self.calendar.pk).full_syncs, 2)
+
+    def test_concurrent_sync_keeps_newer_token(self):
+        self.api.add_event("cal", {"id": "a", "summary": "A"})
+        stale = UserCalendar.objects.get(pk=self.calendar.pk)
+        self.calendar.get_changes()
+        token = self.stored_sync_token()
+        stale.get_changes()
+        self.assertEqual(self.stored_sync_token(), token)
+
+    def test_mirror(self):
+        self.api.add_event("cal", {"id": "a", "summary": "A", "updated": "2023-01-01T10:00:00.000Z"})
+        self.api.add_event("cal", {"id": "b", "summary": "B"})
+        self.calendar.get_changes()
+        mirrored = {e.event_id: e for e in CalendarEvent.objects.filter(calendar=self.calendar)}
+        self.assertEqual(set(mirrored), {"a", "b"})
+        self.assertEqual(mirrored["a"].payload["summary"], "A")
+        self.assertEqual(mirrored["a"].updated.hour, 10)
+
+        self.api.events("cal").remove("b")
+        self.calendar.get_changes()
+        self.assertEqual(
+            list(CalendarEvent.objects.filter(calendar=self.calendar).values_list(
+                "event_id", flat=True)), ["a"])
+
+
+    def test_mirror_without_upserts(self):
+        with mock.patch.object(
+                connection.features, "supports_update_conflicts_with_target", False):
+            self.test_mirror()
+            self.api.add_event("cal", {"id": "a", "summary": "A moved"})
+            self.calendar.get_changes()
+        self.assertEqual(CalendarEvent.objects.get(calendar=self.calendar).payload["summary"],
+                         "A moved")
+
+
+class TestFieldMasks(FakeGoogleMixin, TestCase):
+    """ Test the partial response masks sent with each call. """
+    def setUp(self):
+        super().setUp()
+        self.calendar = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="cal")
+        self.api.add_event("cal", {
+            "id": "a", "summary": "A", "htmlLink": "https://calendar/a",
+            "attendees": [{"email": "paul@example.com", "displayName": "Paul",
+                           "responseStatus": "accepted"}]})
+
+    def fields(self, method):
+        return [q.get("fields") for (m, p, q) in self.api.requests if m == method]
+
+    def test_default_masks(self):
+        [event] = self.calendar.get_changes()
+        self.assertEqual(self.fields("GET"), [DEFAULT_FIELD_MASKS["events.list"]])
+        self.assertNotIn("htmlLink", event)
+        self.assertEqual(event["attendees"],
+                         [{"email": "paul@example.com", "responseStatus": "accepted"}])
+        self.assertEqual(self.calendar.get_event("a")["summary"], "A")
+        self.assertEqual(self.fields("GET")[-1], DEFAULT_FIELD_MASKS["events.get"])
+        self.calendar.patch_event({"id": "a", "summary": "B"})
+        self.assertEqual(self.fields("PATCH"), [DEFAULT_FIELD_MASKS["events.write"]])
+
+    @override_settings(GOOGLE_API_FIELD_MASKS={"events.list": None, "events.get": "id"})
+    def test_override(self):
+        [event] = self.calendar.get_changes()
+        self.assertEqual(self.fields("GET"), [None])
+        self.assertEqual(event["htmlLink"], "https://calendar/a")
+        self.assertEqual(self.calendar.get_event("a"), {"id": "a"})
+        # Call sites without an override keep the default.
+        self.calendar.patch_event({"id": "a", "summary": "B"})
+        self.assertEqual(self.fields("PATCH"), [DEFAULT_FIELD_MASKS["events.write"]])
+
+
+class TestSyncConfigs(FakeGoogleMixin, TestCase):
+    """ Test copying events from source to sink calendars. """
+    def setUp(self):
+        super().setUp()
+        self.src = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="src")
+        self.sink = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="sink")
+        self.sync = SyncConfigs.objects.create(user=self.user, hide_details=True)
+        self.sync.src_calendars.add(self.src)
+        self.sync.sink_calendars.add(self.sink)
+        self.sink_id = make_sink_event_id(self.sync.id, self.src.internal_calendar_id, "abc")
+
+    def test_insert_then_patch(self):
+        event = {"id": "abc", "summary": "Lunch", "description": "Secret",
+                 "attendees": [{"email": "a@example.com"}]}
+        self.sync.handle_event(event, self.src)
+        copied = self.api.events("sink").get(self.sink_id)
+        self.assertEqual(copied["summary"], "Lunch")
+        self.assertEqual(copied["attendees"], [])
+        self.assertNotEqual(copied["description"], "Secret")
+
+        self.api.requests.clear()
+        self.sync.handle_event(dict(event, summary="Dinner"), self.src)
+        self.assertEqual(self.api.events("sink").get(self.sink_id)["summary"], "Dinner")
+        # No read before the write.
+        self.assertEqual([m for m, p, q in self.api.requests], ["PATCH"])
+
+    def test_no_loops(self):
+        self.sync.handle_event({"id": "abc", "summary": "Lunch"}, self.src)
+        copied = self.api.events("sink").get(self.sink_id)
+        self.api.requests.clear()
+        self.sync.handle_event(copied, self.src)
+        self.assertEqual(self.api.requests, [])
+
+    def test_skip_unchanged(self):
+        event = {"id": "abc", "summary": "Lunch",
+                 "attendees": [{"email": "a@example.com", "responseStatus": "needsAction"}]}
+        self.sync.handle_event(event, self.src)
+        self.api.requests.clear()
+        # An RSVP doesn't change the sink copy.
+        event["attendees"][0]["responseStatus"] = "accepted"
+        self.sync.handle_event(event, self.src)
+        self.assertEqual(self.api.requests, [])
+
+    def test_patch_changed_fields(self):
+        event = {"id": "abc", "summary": "Lunch", "location": "Cafe",
+                 "start": {"dateTime": "2023-01-01T12:00:00Z"}}
+        self.sync.hide_details = False
+        self.sync.handle_event(event, self.src)
+        self.api.bodies.clear()
+        self.sync.handle_event(dict(event, summary="Dinner"), self.src)
+        self.assertEqual(self.api.bodies, [{"summary": "Dinner"}])
+        self.api.bodies.clear()
+        del event["location"]
+        self.sync.handle_event(dict(event, summary="Dinner"), self.src)
+        self.assertEqual(self.api.bodies, [{"location": None}])
+
+    def test_links_without_upserts(self):
+        with mock.patch.object(
+                connection.features, "supports_update_conflicts_with_target", False):
+            self.test_insert_then_patch()
+        link = EventLink.objects.get(sync_config=self.sync, source_event_id="abc")
+        self.assertEqual(link.sink_event_id, self.sink_id)
+
+    def test_sink_ids_are_stable(self):
+        self.assertEqual(
+            self.sink_id, make_sink_event_id(self.sync.id, self.src.internal_calendar_id, "abc"))
+        self.assertNotEqual(
+            self.sink_id, make_sink_event_id(self.sync.id, self.sink.internal_calendar_id, "abc"))
+        self.assertRegex(self.sink_id, "^[a-v0-9]{5,1024}$")
+
+    def test_insert_conflict_patches(self):
+        """ A retried (or lost) insert lands on the existing copy instead of a duplicate. """
+        self.api.add_event("sink", {"id": self.sink_id, "summary": "Old"})
+        self.sync.handle_event({"id": "abc", "summary": "Lunch"}, self.src)
+        self.assertEqual(self.api.events("sink").get(self.sink_id)["summary"], "Lunch")
+        self.assertEqual(len(self.api.events("sink").items), 1)
+        self.assertEqual([m for m, p, q in self.api.requests], ["POST", "PATCH"])
+        self.assertTrue(EventLink.objects.filter(sink_event_id=self.sink_id).exists())
+
+    def test_reinsert_after_delete(self):
+        """ A copy we deleted comes back when its source matches the sync again. """
+        self.sync.match_creator_regex = "@example.com$"
+        self.sync.save()
+        event = {"id": "abc", "summary": "Lunch", "creator": {"email": "a@example.com"}}
+        self.sync.handle_event(event, self.src)
+        self.sync.handle_event(dict(event, creator={"email": "a@other.com"}), self.src)
+        self.assertIsNone(self.api.events("sink").get(self.sink_id))
+        self.assertFalse(EventLink.objects.exists())
+
+        self.api.requests.clear()
+        self.sync.handle_event(event, self.src)
+        self.assertEqual([m for m, p, q in self.api.requests], ["POST", "PATCH"])
+        copied = self.api.events("sink").get(self.sink_id)
+        self.assertEqual((copied["status"], copied["summary"]), ("confirmed", "Lunch"))
+        self.assertTrue(EventLink.objects.filter(sink_event_id=self.sink_id).exists())
+
+    def test_links_and_deletes(self):
+        self.sync.handle_event({"id": "abc", "summary": "Lunch"}, self.src)
+        link = EventLink.objects.get(sync_config=self.sync, source_event_id="abc")
+        self.assertEqual((link.sink_calendar, link.sink_event_id), (self.sink, self.sink_id))
+
+        self.sync.handle_event({"id": "abc", "status": "cancelled"}, self.src)
+        self.assertIsNone(self.api.events("sink").get(self.sink_id))
+        self.assertFalse(EventLink.objects.exists())
+        self.assertFalse(CalendarEvent.objects.filter(calendar=self.sink).exists())
+
+    def test_sync_event_dispatch(self):
+        """ A page of changes turns into one batch of writes. """
+        for i in range(10):
+            self.api.add_event("src", {"id": f"event{i}", "summary": f"Event {i}"})
+        self.src.handle_sync_event()
+        self.assertEqual(len(self.api.events("sink").items), 10)
+        self.assertEqual(len(self.api.batches), 1)
+        self.assertEqual(EventLink.objects.count(), 10)
+
+        self.api.events("src").remove("event1")
+        self.api.events("src").remove("event2")
+        self.src.handle_sync_event()
+        self.assertIsNone(self.api.events("sink").get(
+            make_sink_event_id(self.sync.id, self.src.internal_calendar_id, "event1")))
+        self.assertEqual(len(self.api.batches), 2)
+        self.assertEqual(EventLink.objects.count(), 8)
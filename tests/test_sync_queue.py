@@ -0,0 +1,257 @@
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from cal_sync_magic.models import (
+    GoogleAccount,
+    SyncConfigs,
+    SyncJob,
+    UserCalendar,
+    sink_write_coalescer,
+)
+from cal_sync_magic.sync_queue import (
+    claim_jobs,
+    drain_queue,
+    enqueue_sync,
+    handle_notification,
+    queue_depth,
+    run_job,
+)
+from cal_sync_magic.sync_workers import WorkerStats
+from tests.fake_google import FakeGoogleMixin
+
+
+@override_settings(SYNC_NOTIFICATION_DEBOUNCE=0)
+class TestSyncQueue(FakeGoogleMixin, TestCase):
+    """ Test push notifications are queued and synced by the worker. """
+    def setUp(self):
+        super().setUp()
+        self.src = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="src")
+        self.sink = UserCalendar.objects.create(
+            user=self.user, google_account=self.account, google_calendar_id="sink")
+        sync = SyncConfigs.objects.create(user=self.user)
+        sync.src_calendars.add(self.src)
+        sync.sink_calendars.add(self.sink)
+
+    def notify(self, **headers):
+        return Client().post(reverse("google-callback"), **headers)
+
+    def test_callback_queues(self):
+        self.api.add_event("src", {"id": "abc", "summary": "Lunch"})
+        response = self.notify(HTTP_X_GOOG_CHANNEL_ID=self.src.make_channel_id(),
+                               HTTP_X_GOOG_RESOURCE_STATE="exists")
+        self.assertEqual(response.status_code, 200)
+        # Nothing synced inside the request.
+        self.assertEqual(self.api.requests, [])
+        job = SyncJob.objects.get()
+        self.assertEqual((job.calendar, job.resource_state), (self.src, "exists"))
+
+        self.assertEqual(drain_queue("test"), (1, 0))
+        self.assertEqual(len(self.api.events("sink").items), 1)
+        self.assertFalse(SyncJob.objects.exists())
+
+    def test_jobs_wait_for_their_coalesced_writes(self):
+        self.api.add_event("src", {"id": "abc", "summary": "Lunch"})
+        enqueue_sync(self.src, self.src.make_channel_id())
+        with self.settings(SINK_WRITE_COALESCE_WINDOW=60):
+            self.assertEqual(drain_queue("test"), (1, 0))
+        self.assertEqual(self.api.events("sink").items, {})
+        self.assertEqual(SyncJob.objects.get().status, SyncJob.RUNNING)
+        sink_write_coalescer.flush_all()
+        self.assertEqual(len(self.api.events("sink").items), 1)
+        self.assertFalse(SyncJob.objects.exists())
+
+    def test_notifications_coalesce_across_jobs(self):
+        self.api.add_event("src", {"id": "abc", "summary": "Lunch"})
+        enqueue_sync(self.src, self.src.make_channel_id())
+        drain_queue("test")
+        self.api.requests.clear()
+        with self.settings(SINK_WRITE_COALESCE_WINDOW=60):
+            for summary in ("Brunch", "Dinner"):
+                self.api.add_event("src", {"id": "abc", "summary": summary})
+                self.notify(HTTP_X_GOOG_CHANNEL_ID=self.src.make_channel_id(),
+                            HTTP_X_GOOG_RESOURCE_STATE="exists")
+                [job] = claim_jobs("test")
+                self.assertTrue(run_job(job))
+        self.assertEqual(SyncJob.objects.count(), 2)
+        sink_write_coalescer.flush_all()
+        patches = [p for (m, p, q) in self.api.requests if m == "PATCH"]
+        self.assertEqual(len(patches), 1)
+        [(_, event)] = self.api.events("sink").items.values()
+        self.assertEqual(event["summary"], "Dinner")
+        self.assertFalse(SyncJob.objects.exists())
+
+    def test_callback_validates_channel(self):
+        self.assertEqual(self.notify().status_code, 400)
+        self.assertEqual(self.notify(HTTP_X_GOOG_CHANNEL_ID="nope").status_code, 400)
+        channel_id = f"{self.src.internal_calendar_id}-other"
+        self.assertEqual(self.notify(HTTP_X_GOOG_CHANNEL_ID=channel_id).status_code, 404)
+        self.assertFalse(SyncJob.objects.exists())
+
+    def test_claims_are_exclusive(self):
+        for _ in range(3):
+            SyncJob.objects.create(calendar=self.src, channel_id=self.src.make_channel_id())
+        first = claim_jobs("one", limit=2)
+        second = claim_jobs("two", limit=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({j.id for j in first} & {j.id for j in second})
+        self.assertEqual(claim_jobs("three"), [])
+
+    def test_stale_claims_are_released(self):
+        job, _ = enqueue_sync(self.src, self.src.make_channel_id())
+        SyncJob.objects.filter(pk=job.pk).update(
+            status=SyncJob.RUNNING, locked_by="gone",
+            locked_at=datetime.utcnow() - timedelta(hours=1))
+        self.assertEqual([j.id for j in claim_jobs("test")], [job.id])
+
+    def test_long_syncs_keep_their_claim(self):
+        enqueue_sync(self.src, self.src.make_channel_id())
+        [job] = claim_jobs("one")
+        stale = datetime.utcnow() - timedelta(hours=1)
+        SyncJob.objects.filter(pk=job.pk).update(locked_at=stale)
+        job.locked_at = stale
+
+        def sync(heartbeat, group):
+            heartbeat()
+            self.assertEqual(claim_jobs("two"), [])
+
+        with mock.patch.object(UserCalendar, "handle_sync_event", side_effect=sync):
+            self.assertTrue(run_job(job))
+        self.assertFalse(SyncJob.objects.exists())
+
+    def test_lost_claims_are_left_alone(self):
+        enqueue_sync(self.src, self.src.make_channel_id())
+        [job] = claim_jobs("one")
+        SyncJob.objects.filter(pk=job.pk).update(locked_at=datetime.utcnow() - timedelta(hours=1))
+        [taken] = claim_jobs("two")
+
+        # Finishing doesn't delete the job out from under the new worker.
+        with mock.patch.object(UserCalendar, "handle_sync_event"):
+            run_job(job)
+        self.assertTrue(SyncJob.objects.filter(pk=job.pk).exists())
+        with mock.patch.object(UserCalendar, "handle_sync_event",
+                               side_effect=lambda heartbeat, group: heartbeat()):
+            self.assertFalse(run_job(job))
+        taken.refresh_from_db()
+        self.assertEqual((taken.status, taken.locked_by, taken.attempts),
+                         (SyncJob.RUNNING, "two", 0))
+
+    def test_failures_back_off(self):
+        job, _ = enqueue_sync(self.src, self.src.make_channel_id())
+        with self.settings(SYNC_JOB_MAX_ATTEMPTS=2):
+            with mock.patch.object(UserCalendar, "handle_sync_event", side_effect=Exception("boom")):
+                self.assertEqual(drain_queue("test"), (0, 1))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts), (SyncJob.PENDING, 1))
+                self.assertGreater(job.available_at, datetime.utcnow())
+                self.assertIn("boom", job.last_error)
+
+                SyncJob.objects.filter(pk=job.pk).update(available_at=datetime.utcnow())
+                self.assertEqual(drain_queue("test"), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (SyncJob.FAILED, 2))
+
+    def test_worker_command(self):
+        enqueue_sync(self.src, self.src.make_channel_id())
+        out = StringIO()
+        call_command("run_sync_worker", "--once", stdout=out)
+        self.assertIn("1 synced, 0 failed, 0 still queued", out.getvalue())
+
+    def test_dedup_and_debounce(self):
+        channel_id = self.src.make_channel_id()
+        outcomes = [
+            handle_notification(self.src, channel_id, "sync", 1),
+            handle_notification(self.src, channel_id, "exists", 2),
+            # A retry of the same message.
+            handle_notification(self.src, channel_id, "exists", 2),
+            handle_notification(self.src, channel_id, "exists", 3),
+        ]
+        self.assertEqual(outcomes, ["dropped", "queued", "dropped", "merged"])
+        job = SyncJob.objects.get()
+        self.assertEqual(job.notifications, 2)
+        self.src.refresh_from_db()
+        self.assertEqual(
+            (self.src.notifications, self.src.notifications_dropped,
+             self.src.notifications_merged, self.src.last_message_number),
+            (4, 2, 1, 3))
+
+        # Once the job is running changes may land after its listing, so queue another.
+        claim_jobs("test")
+        self.assertEqual(handle_notification(self.src, channel_id, "exists", 4), "queued")
+
+    def test_debounce_window(self):
+        with self.settings(SYNC_NOTIFICATION_DEBOUNCE=60):
+            handle_notification(self.src, self.src.make_channel_id(), "exists", 1)
+        self.assertEqual(claim_jobs("test"), [])
+        SyncJob.objects.update(available_at=datetime.utcnow())
+        self.assertEqual(len(claim_jobs("test")), 1)
+
+    def test_backing_off_jobs_take_no_merges(self):
+        channel_id = self.src.make_channel_id()
+        job, _ = enqueue_sync(self.src, channel_id)
+        SyncJob.objects.filter(pk=job.pk).update(
+            attempts=1, available_at=datetime.utcnow() + timedelta(minutes=5))
+        new, merged = enqueue_sync(self.src, channel_id, debounce=60)
+        self.assertFalse(merged)
+        self.assertNotEqual(new.pk, job.pk)
+        self.assertEqual(enqueue_sync(self.src, channel_id, debounce=60), (new, True))
+        self.assertEqual(SyncJob.objects.get(pk=job.pk).notifications, 1)
+
+    def test_callback_dedup(self):
+        headers = {"HTTP_X_GOOG_CHANNEL_ID": self.src.make_channel_id(),
+                   "HTTP_X_GOOG_RESOURCE_STATE": "exists",
+                   "HTTP_X_GOOG_MESSAGE_NUMBER": "7"}
+        self.assertEqual(self.notify(**headers).status_code, 200)
+        self.assertEqual(self.notify(**headers).status_code, 200)
+        self.assertEqual(SyncJob.objects.get().notifications, 1)
+        headers["HTTP_X_GOOG_MESSAGE_NUMBER"] = "seven"
+        self.assertEqual(self.notify(**headers).status_code, 400)
+
+    def test_partitions(self):
+        other_account = GoogleAccount.objects.create(
+            user=self.user, google_user_email="other@example.com",
+            credentials=self.account.credentials,
+            credential_expiry=self.account.credential_expiry)
+        other = UserCalendar.objects.create(
+            user=self.user, google_account=other_account, google_calendar_id="other")
+        for calendar in (self.src, self.sink, other):
+            SyncJob.objects.create(calendar=calendar, channel_id=calendar.make_channel_id())
+        partitions = [(i, 2) for i in range(2)]
+        # The two accounts have consecutive ids so land in different partitions.
+        self.assertEqual(sorted(queue_depth(p) for p in partitions), [1, 2])
+        claimed = [[j.calendar.google_account_id for j in claim_jobs("test", partition=p)]
+                   for p in partitions]
+        # Each account's jobs all go to one worker.
+        self.assertEqual(sorted(claimed, key=len),
+                         [[other_account.pk], [self.account.pk, self.account.pk]])
+
+    def test_stop_releases_claimed_jobs(self):
+        for calendar in (self.src, self.sink):
+            SyncJob.objects.create(calendar=calendar, channel_id=calendar.make_channel_id())
+        calls = []
+
+        def should_stop():
+            calls.append(1)
+            return len(calls) > 1
+
+        self.assertEqual(drain_queue("test", should_stop=should_stop), (1, 0))
+        job = SyncJob.objects.get()
+        self.assertEqual((job.status, job.locked_by), (SyncJob.PENDING, None))
+
+
+class TestWorkerStats(TestCase):
+    def test_summary(self):
+        stats = WorkerStats(2)
+        stats.record(0, 3, 1, 5)
+        stats.record(0, 2, 0, 4)
+        stats.record(1, 1, 0, 0)
+        summary = stats.summary()
+        self.assertIn("worker 0: 5 synced", summary)
+        self.assertIn("1 failed, 4 queued", summary)
+        self.assertIn("total queued: 4", summary)
@@ -0,0 +1,9 @@
+from django.contrib import admin
+from django.urls import path
+
+from testapp.urls import urlpatterns as testapp_urlpatterns
+
+# testapp's urls plus the admin, for the admin tests.
+urlpatterns = testapp_urlpatterns + [
+    path("admin/", admin.site.urls),
+]